@@ -0,0 +1,121 @@
+# coding: utf-8
+"""
+    _zweig_async
+    ~~~~~~~~~~~~
+
+    The :mod:`asyncio` based API of zweig, which requires Python 3.6 or later
+    and is available through the :mod:`zweig` module on those versions.
+
+    :copyright: 2014 by Daniel Neuhäuser
+    :license: BSD, see LICENSE.rst for details
+"""
+import ast
+import asyncio
+
+# zweig imports this module, so it is imported lazily to avoid a circular
+# import, in particular when zweig is run with ``python -m zweig``.
+
+
+def _read(path):
+    with open(path, 'rb') as source_file:
+        return source_file.read()
+
+
+def _walk(tree):
+    import zweig
+    return list(zweig.walk_preorder(tree))
+
+
+def _parse_and_apply(source, path, function):
+    return function(ast.parse(source, path))
+
+
+async def _work(paths, function, executor, results):
+    # Processes the files of the `paths` iterator shared by all workers,
+    # which only run on the thread of the event loop, until it is exhausted.
+    # The results are put into the bounded `results` queue followed by
+    # `None`, so a consumer that is not keeping up blocks the workers.
+    loop = asyncio.get_event_loop()
+    try:
+        for index, path in paths:
+            source = await loop.run_in_executor(None, _read, path)
+            result = await loop.run_in_executor(
+                executor, _parse_and_apply, source, path, function
+            )
+            await results.put((index, path, result))
+    except asyncio.CancelledError:
+        raise
+    except Exception as error:
+        await results.put(error)
+    else:
+        await results.put(None)
+
+
+async def _iter_results(paths, function, concurrency, executor):
+    # Yields ``(index, path, result)`` tuples as they become available,
+    # processing the files with `concurrency` workers.
+    import zweig
+    paths = enumerate(zweig.iter_source_files(paths))
+    results = asyncio.Queue(concurrency)
+    workers = [
+        asyncio.ensure_future(_work(paths, function, executor, results))
+        for _ in range(concurrency)
+    ]
+    try:
+        running = len(workers)
+        while running:
+            result = await results.get()
+            if result is None:
+                running -= 1
+            elif isinstance(result, Exception):
+                raise result
+            else:
+                yield result
+    finally:
+        for worker in workers:
+            worker.cancel()
+
+
+async def aiter_trees(paths, function=_walk, concurrency=8, executor=None):
+    """
+    Asynchronously yields ``(path, result)`` tuples for every Python file in
+    `paths`, which may include directories, as soon as they are available.
+
+    The `result` is the return value of calling `function` with the tree of
+    the file, by default a list of all nodes in preorder. Files are read in
+    the default executor of the event loop, parsing and calling `function`
+    happen in `executor`, which for CPU bound work should be a
+    :class:`concurrent.futures.ProcessPoolExecutor`. In that case `function`
+    and its results must be picklable. At most `concurrency` files are
+    processed at the same time, by as many workers taking the paths one at
+    a time, so that the memory required does not depend on the number of
+    files.
+
+    Exceptions raised while processing a file are propagated.
+    """
+    async for _, path, result in _iter_results(
+            paths, function, concurrency, executor):
+        yield path, result
+
+
+async def aparse_and_walk(paths, function=_walk, concurrency=8,
+                          executor=None):
+    """
+    Like :func:`aiter_trees` but returns a list of all ``(path, result)``
+    tuples, in the order of the paths.
+    """
+    results = []
+    async for result in _iter_results(paths, function, concurrency, executor):
+        results.append(result)
+    results.sort(key=lambda result: result[0])
+    return [(path, result) for _, path, result in results]
+
+
+async def ato_source(tree, executor=None):
+    """
+    Like :func:`zweig.to_source` but runs in `executor`, so that the event
+    loop is not blocked.
+    """
+    import zweig
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor, zweig.to_source, tree)
@@ -0,0 +1,57 @@
+# coding: utf-8
+"""
+    bench_memory
+    ~~~~~~~~~~~~
+
+    Compares the memory required to hold the trees of the standard library
+    as :mod:`ast` nodes and as :class:`zweig.CompactNode` instances.
+
+    Run with ``python benchmarks/bench_memory.py [directory ...]`` after
+    ``make dev-env``.
+
+    :copyright: 2014 by Daniel Neuhäuser
+    :license: BSD, see LICENSE.rst for details
+"""
+from __future__ import print_function
+import sys
+import gc
+import tracemalloc
+
+import zweig
+
+from corpus import read_sources, parse_all, stdlib_directory
+
+
+def measure(create):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = create()
+        gc.collect()
+        current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, current
+
+
+def main(argv):
+    directories = argv or [stdlib_directory()]
+    sources = read_sources(directories)
+    trees, ast_size = measure(lambda: parse_all(sources))
+    compact_trees, compact_size = measure(
+        lambda: [zweig.to_compact(tree) for tree in trees]
+    )
+    nodes = sum(1 for tree in trees for _ in zweig.walk_preorder(tree))
+    print('files:   {:>14}'.format(len(trees)))
+    print('nodes:   {:>14}'.format(nodes))
+    print('ast:     {:>14} bytes ({:.1f} per node)'.format(
+        ast_size, ast_size / float(nodes)
+    ))
+    print('compact: {:>14} bytes ({:.1f} per node)'.format(
+        compact_size, compact_size / float(nodes)
+    ))
+    print('ratio:   {:>14.2f}'.format(ast_size / float(compact_size)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
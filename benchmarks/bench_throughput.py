@@ -0,0 +1,209 @@
+# coding: utf-8
+"""
+    bench_throughput
+    ~~~~~~~~~~~~~~~~
+
+    Measures the throughput and peak memory usage of
+    :func:`zweig.walk_preorder`, :func:`zweig.to_source`, :func:`zweig.dump`,
+    :func:`zweig.is_possible_target` and parsing round trips over the
+    standard library and synthetic deep and wide trees.
+
+    Run with ``make bench`` or ``python benchmarks/bench_throughput.py`` after
+    ``make dev-env``. Use ``--save results.json`` to store the results and
+    ``--compare results.json`` to fail, if any benchmark got slower by more
+    than ``--tolerance`` compared to stored results.
+
+    :copyright: 2014 by Daniel Neuhäuser
+    :license: BSD, see LICENSE.rst for details
+"""
+from __future__ import print_function, division
+import sys
+import ast
+import json
+import argparse
+import timeit
+import tracemalloc
+
+import zweig
+
+from corpus import (
+    read_sources, parse_all, stdlib_directory, deep_source, wide_source
+)
+
+
+def count_nodes(trees):
+    return sum(1 for tree in trees for _ in zweig.walk_preorder(tree))
+
+
+def run_walk_preorder(trees):
+    for tree in trees:
+        for _ in zweig.walk_preorder(tree):
+            pass
+    return 0
+
+
+def run_to_source(trees):
+    return sum(len(zweig.to_source(tree).encode('utf-8')) for tree in trees)
+
+
+def run_dump(trees):
+    return sum(len(zweig.dump(tree).encode('utf-8')) for tree in trees)
+
+
+def run_round_trip(trees):
+    size = 0
+    for tree in trees:
+        source = zweig.to_source(tree)
+        ast.parse(source)
+        size += len(source.encode('utf-8'))
+    return size
+
+
+def run_is_possible_target(expressions):
+    for expression in expressions:
+        zweig.is_possible_target(expression)
+    return 0
+
+
+def working_subset(function, trees):
+    # to_source does not support every construct of every Python version,
+    # the benchmarks only use the trees it can handle. Returns the subset and
+    # the last error encountered.
+    subset = []
+    error = None
+    for tree in trees:
+        try:
+            function([tree])
+        except Exception as exception:
+            error = exception
+            continue
+        subset.append(tree)
+    return subset, error
+
+
+def measure(function, inputs, repeat):
+    timer = timeit.Timer(lambda: function(inputs))
+    seconds = min(timer.repeat(repeat=repeat, number=1))
+    tracemalloc.start()
+    try:
+        output_size = function(inputs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return seconds, output_size, peak
+
+
+def load_corpora(directories):
+    return [
+        ('stdlib', parse_all(read_sources(directories))),
+        ('deep', [ast.parse(deep_source())]),
+        ('wide', [ast.parse(wide_source())])
+    ]
+
+
+def run(corpora, repeat):
+    benchmarks = [
+        ('walk_preorder', run_walk_preorder),
+        ('to_source', run_to_source),
+        ('dump', run_dump),
+        ('round_trip', run_round_trip)
+    ]
+    results = []
+    for corpus_name, trees in corpora:
+        for benchmark_name, function in benchmarks:
+            subset, error = working_subset(function, trees)
+            if not subset:
+                print('{}/{} skipped: {}: {}'.format(
+                    benchmark_name, corpus_name,
+                    error.__class__.__name__, error
+                ))
+                continue
+            nodes = count_nodes(subset)
+            seconds, output_size, peak = measure(function, subset, repeat)
+            results.append({
+                'name': '{}/{}'.format(benchmark_name, corpus_name),
+                'trees': len(subset),
+                'skipped': len(trees) - len(subset),
+                'nodes': nodes,
+                'seconds': seconds,
+                'nodes_per_second': nodes / seconds,
+                'bytes_per_second': output_size / seconds,
+                'peak_memory': peak
+            })
+        expressions = [
+            node for tree in trees for node in zweig.walk_preorder(tree)
+            if isinstance(node, ast.expr)
+        ]
+        seconds, _, peak = measure(run_is_possible_target, expressions, repeat)
+        results.append({
+            'name': 'is_possible_target/{}'.format(corpus_name),
+            'trees': len(trees),
+            'skipped': 0,
+            'nodes': len(expressions),
+            'seconds': seconds,
+            'nodes_per_second': len(expressions) / seconds,
+            'bytes_per_second': 0,
+            'peak_memory': peak
+        })
+    return results
+
+
+def report(results):
+    print('{:<28} {:>8} {:>9} {:>10} {:>14} {:>14} {:>12}'.format(
+        'benchmark', 'trees', 'nodes', 'seconds', 'nodes/s', 'bytes/s',
+        'peak memory'
+    ))
+    for result in results:
+        print(
+            '{name:<28} {trees:>8} {nodes:>9} {seconds:>10.4f} '
+            '{nodes_per_second:>14.0f} {bytes_per_second:>14.0f} '
+            '{peak_memory:>12}'.format(**result)
+        )
+        if result['skipped']:
+            print('    skipped {} unsupported trees'.format(
+                result['skipped']
+            ))
+
+
+def compare(results, baseline, tolerance):
+    baseline = dict((result['name'], result) for result in baseline)
+    regressions = []
+    for result in results:
+        previous = baseline.get(result['name'])
+        if previous is None:
+            continue
+        ratio = previous['nodes_per_second'] / result['nodes_per_second']
+        if ratio > 1 + tolerance:
+            regressions.append((result['name'], ratio))
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('directories', nargs='*')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--save', metavar='PATH')
+    parser.add_argument('--compare', metavar='PATH')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    arguments = parser.parse_args(argv)
+
+    corpora = load_corpora(arguments.directories or [stdlib_directory()])
+    results = run(corpora, arguments.repeat)
+    report(results)
+    if arguments.save:
+        with open(arguments.save, 'w') as results_file:
+            json.dump(results, results_file, indent=2)
+    if arguments.compare:
+        with open(arguments.compare) as baseline_file:
+            regressions = compare(
+                results, json.load(baseline_file), arguments.tolerance
+            )
+        for name, ratio in regressions:
+            print('regression: {} is {:.2f}x slower'.format(name, ratio))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,70 @@
+# coding: utf-8
+"""
+    corpus
+    ~~~~~~
+
+    Trees the benchmarks are run on.
+
+    :copyright: 2014 by Daniel Neuhäuser
+    :license: BSD, see LICENSE.rst for details
+"""
+import os
+import ast
+
+
+def read_sources(directories):
+    """
+    Returns a list of ``(path, source)`` pairs for all Python files in the
+    given `directories`.
+    """
+    sources = []
+    for directory in directories:
+        for root, dirnames, filenames in os.walk(directory):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename.endswith('.py'):
+                    path = os.path.join(root, filename)
+                    with open(path, 'rb') as source_file:
+                        sources.append((path, source_file.read()))
+    return sources
+
+
+def parse_all(sources):
+    """
+    Parses the `sources` returned by :func:`read_sources`, ignoring those
+    that cannot be parsed by the running interpreter.
+    """
+    trees = []
+    for path, source in sources:
+        try:
+            trees.append(ast.parse(source, path))
+        except (SyntaxError, ValueError):
+            pass
+    return trees
+
+
+def stdlib_directory():
+    return os.path.dirname(os.__file__)
+
+
+def deep_source(depth=190):
+    """
+    Returns the source of a module with a single, deeply nested expression.
+
+    :func:`zweig.to_source` parenthesizes each level of the expression and
+    the parser of Python 3.9 and later rejects more than 200 nested
+    parentheses, a deeper expression could not be used for round trips.
+    """
+    return 'result = ' + ' + '.join('a{}'.format(i) for i in range(depth))
+
+
+def wide_source(width=10000):
+    """
+    Returns the source of a module with many statements and a large dict
+    literal.
+    """
+    lines = ['a{0} = b{0}'.format(i) for i in range(width)]
+    lines.append('mapping = {{{}}}'.format(', '.join(
+        'k{0}: v{0}'.format(i) for i in range(width)
+    )))
+    return '\n'.join(lines) + '\n'
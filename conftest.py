@@ -0,0 +1,14 @@
+# coding: utf-8
+"""
+    conftest
+    ~~~~~~~~
+
+    :copyright: 2014 by Daniel Neuhäuser
+    :license: BSD, see LICENSE.rst for details
+"""
+import sys
+
+
+collect_ignore = []
+if sys.version_info < (3, 6):
+    collect_ignore.append('test_zweig_async.py')
@@ -22,5 +22,8 @@ setup(
     description='Utilities for dealing with the ast module',
     long_description=open('README.rst', 'r', encoding='utf-8').read(),
 
-    py_modules=['zweig']
+    py_modules=['zweig', '_zweig_async'],
+    entry_points={
+        'console_scripts': ['zweig = zweig:main']
+    }
 )
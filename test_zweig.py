@@ -8,7 +8,12 @@
 """
 from __future__ import unicode_literals
 import ast
+import gc
 import sys
+import pickle
+import weakref
+import cProfile
+import re
 import textwrap
 
 import pytest
@@ -556,3 +561,1519 @@ def test_set_target_contexts():
         assert isinstance(expression.elts[1].value.ctx, ast.Store)
         assert isinstance(expression.elts[1].value.elts[0].ctx, ast.Store)
         assert isinstance(expression.elts[1].value.elts[1].ctx, ast.Store)
+
+
+def test_compact():
+    source = textwrap.dedent("""
+        def f(foo, bar=baz):
+            foo, bar = bar, foo
+            return [spam for spam in eggs]
+    """)
+    tree = ast.parse(source)
+    compact = zweig.to_compact(tree)
+    assert isinstance(compact, zweig.CompactNode)
+    assert compact.__class__.__name__ == 'Module'
+    assert not hasattr(compact, '__dict__')
+
+    assert (
+        zweig.dump(compact, include_attributes=True) ==
+        zweig.dump(tree, include_attributes=True)
+    )
+    assert [
+        node.__class__.__name__ for node in zweig.walk_preorder(compact)
+    ] == [
+        node.__class__.__name__ for node in zweig.walk_preorder(tree)
+    ]
+    assert zweig.to_source(compact) == zweig.to_source(tree)
+
+    assignment = compact.body[0].body[0]
+    assert zweig.is_possible_target(assignment.targets[0])
+    assert not zweig.is_possible_target(assignment.value.elts[0].ctx)
+
+    restored = zweig.from_compact(compact)
+    assert isinstance(restored, ast.Module)
+    assert (
+        zweig.dump(restored, include_attributes=True) ==
+        zweig.dump(tree, include_attributes=True)
+    )
+
+    with pytest.raises(TypeError):
+        zweig.to_compact(compact)
+    with pytest.raises(TypeError):
+        zweig.from_compact(tree)
+
+
+def test_compact_shares_contexts():
+    compact = zweig.to_compact(ast.parse('foo, bar'))
+    foo, bar = compact.body[0].value.elts
+    assert foo.ctx is bar.ctx
+
+
+def test_compact_keeps_missing_attributes_missing():
+    node = zweig.from_compact(zweig.to_compact(ast.Name(id='foo')))
+    assert node.id == 'foo'
+    assert not hasattr(node, 'ctx')
+    assert not hasattr(node, 'lineno')
+
+
+def test_freeze():
+    tree = ast.parse(textwrap.dedent("""
+        foo = bar
+        def f():
+            return spam
+    """))
+    frozen = zweig.freeze(tree)
+    assert isinstance(frozen, zweig.FrozenNode)
+    assert zweig.dump(frozen) == zweig.dump(tree)
+    with pytest.raises(AttributeError):
+        frozen.body = []
+    with pytest.raises(AttributeError):
+        del frozen.body
+
+    changed = zweig.replace_at(
+        frozen,
+        ('body', 1, 'body', 0, 'value'),
+        ast.Name(id='eggs', ctx=ast.Load())
+    )
+    assert changed is not frozen
+    assert changed.body[0] is frozen.body[0]
+    assert changed.body[1] is not frozen.body[1]
+    assert changed.body[1].args is frozen.body[1].args
+    assert changed.body[1].body[0].value.id == 'eggs'
+    assert frozen.body[1].body[0].value.id == 'spam'
+    assert zweig.to_source(changed) == 'foo = bar\ndef f():\n    return eggs\n'
+
+    restored = zweig.from_compact(changed)
+    assert isinstance(restored, ast.Module)
+    assert restored.body[1].body[0].value.id == 'eggs'
+
+    renamed = changed.body[0].targets[0].replace(id='qux')
+    assert renamed.id == 'qux'
+    assert renamed.ctx is changed.body[0].targets[0].ctx
+    with pytest.raises(TypeError):
+        renamed.replace(unknown=None)
+
+    unpickled = pickle.loads(pickle.dumps(changed))
+    assert isinstance(unpickled, zweig.FrozenNode)
+    assert zweig.dump(unpickled) == zweig.dump(changed)
+    with pytest.raises(TypeError):
+        zweig.replace_at(tree, ('body', 0), ast.Pass())
+
+
+def test_clone():
+    tree = ast.parse(textwrap.dedent("""
+        def f(foo):
+            return [bar for bar in foo]
+    """))
+    copy = zweig.clone(tree)
+    assert (
+        zweig.dump(copy, include_attributes=True) ==
+        zweig.dump(tree, include_attributes=True)
+    )
+    copied_nodes = list(zweig.walk_preorder(copy))
+    original_ids = set(map(id, zweig.walk_preorder(tree)))
+    for node in copied_nodes:
+        if node._fields or node._attributes:
+            assert id(node) not in original_ids
+    assert copy.body[0].body is not tree.body[0].body
+
+    shifted = zweig.clone(tree, line_offset=10, column_offset=4)
+    function = shifted.body[0]
+    assert function.lineno == tree.body[0].lineno + 10
+    assert function.col_offset == 4
+    assert function.body[0].lineno == tree.body[0].body[0].lineno + 10
+    assert function.body[0].col_offset == tree.body[0].body[0].col_offset + 4
+    assert tree.body[0].col_offset == 0
+
+    stripped = zweig.clone(tree, strip_locations=True)
+    assert all(
+        not hasattr(node, 'lineno') or node.lineno is None
+        for node in zweig.walk_preorder(stripped)
+    )
+    assert zweig.dump(stripped) == zweig.dump(tree)
+
+    with pytest.raises(TypeError):
+        zweig.clone([tree])
+
+
+def test_template():
+    template = zweig.template('return $x + $y')
+    assert zweig.template('return $x + $y') is template
+    assert template.placeholders == frozenset(['x', 'y'])
+
+    first = template.instantiate(x='foo', y=ast.Name(id='bar', ctx=ast.Load()))
+    second = template.instantiate(x='spam', y='eggs')
+    assert zweig.to_source(first) == 'return foo + bar\n'
+    assert zweig.to_source(second) == 'return spam + eggs\n'
+
+    with pytest.raises(TypeError):
+        template.instantiate(x='foo')
+    with pytest.raises(TypeError):
+        template.instantiate(x='foo', y='bar', z='baz')
+    with pytest.raises(TypeError):
+        template.instantiate(x='foo', y=[ast.Pass()])
+
+
+def test_template_targets():
+    template = zweig.template(textwrap.dedent("""\
+        def $name($argument):
+            $target = $argument
+            del $target
+            $body
+    """))
+    target = ast.parse('foo, bar', mode='eval').body
+    tree = template.instantiate(
+        name='f',
+        argument='spam',
+        target=target,
+        body=ast.parse('eggs\nreturn spam').body
+    )
+    assert zweig.to_source(tree) == textwrap.dedent("""\
+        def f(spam):
+            foo, bar = spam
+            del foo, bar
+            eggs
+            return spam
+    """)
+    assignment, deletion = tree.body[0].body[:2]
+    assert isinstance(assignment.targets[0].ctx, ast.Store)
+    assert all(
+        isinstance(element.ctx, ast.Store)
+        for element in assignment.targets[0].elts
+    )
+    assert isinstance(deletion.targets[0].ctx, ast.Del)
+    assert all(
+        isinstance(element.ctx, ast.Del)
+        for element in deletion.targets[0].elts
+    )
+    assert isinstance(target.ctx, ast.Load)
+    compile(tree, '<template>', 'exec')
+
+    with pytest.raises(ValueError):
+        template.instantiate(
+            name='f',
+            argument='spam',
+            target=ast.parse('foo()', mode='eval').body,
+            body=[]
+        )
+
+
+def test_template_ignores_strings():
+    template = zweig.template('$foo = "$foo"')
+    tree = template.instantiate(foo='bar')
+    assert tree.body[0].targets[0].id == 'bar'
+    assert ast.literal_eval(tree.body[0].value) == '$foo'
+
+    template = zweig.template('$foo = "$bar"')
+    assert template.placeholders == frozenset(['foo'])
+    tree = template.instantiate(foo='x')
+    assert ast.literal_eval(tree.body[0].value) == '$bar'
+    with pytest.raises(TypeError):
+        template.instantiate(foo='x', bar='y')
+
+
+def test_fix_contexts():
+    source = textwrap.dedent("""\
+        foo, [bar, baz] = spam[eggs] = spam.eggs = qux
+        for foo, bar in baz:
+            pass
+        with foo as (bar, baz), spam:
+            pass
+        foo += [bar for bar, baz in spam if baz]
+        del foo, bar[baz], spam.eggs
+    """)
+    if not PY2:
+        source += 'foo, *bar = baz\n'
+    tree = ast.parse(source)
+    expected = zweig.dump(tree)
+    for node in zweig.walk_preorder(tree):
+        if 'ctx' in node._fields:
+            node.ctx = ast.Load()
+    assert zweig.dump(tree) != expected
+
+    zweig.fix_contexts(tree)
+    assert zweig.dump(tree) == expected
+    contexts = dict(
+        (node.ctx.__class__, node.ctx) for node in zweig.walk_preorder(tree)
+        if 'ctx' in node._fields
+    )
+    assert all(
+        node.ctx is contexts[node.ctx.__class__]
+        for node in zweig.walk_preorder(tree)
+        if 'ctx' in node._fields
+    )
+
+
+@pytest.mark.parametrize('source', [
+    'foo = bar',
+    'foo += bar',
+    'for foo in bar: pass',
+    'del foo',
+])
+def test_fix_contexts_invalid_target(source):
+    tree = ast.parse(source)
+    statement = tree.body[0]
+    field = 'targets' if hasattr(statement, 'targets') else 'target'
+
+    def set_target(source):
+        target = ast.parse(source, mode='eval').body
+        setattr(statement, field, [target] if field == 'targets' else target)
+
+    set_target('foo()')
+    with pytest.raises(ValueError):
+        zweig.fix_contexts(tree)
+
+    set_target('foo, bar')
+    if isinstance(statement, ast.AugAssign):
+        with pytest.raises(ValueError):
+            zweig.fix_contexts(tree)
+    else:
+        zweig.fix_contexts(tree)
+
+
+@pytest.mark.skipif(
+    sys.version_info < (3, 8), reason='assignment expressions require 3.8'
+)
+def test_fix_contexts_named_expression_target():
+    tree = ast.parse('(foo := bar)')
+    zweig.fix_contexts(tree)
+    for source in ['foo.bar', 'foo[bar]', 'foo, bar']:
+        tree.body[0].value.target = ast.parse(source, mode='eval').body
+        with pytest.raises(ValueError):
+            zweig.fix_contexts(tree)
+
+
+def test_to_source_stats():
+    tree = ast.parse('foo = bar + baz * qux\n')
+    stats = zweig.NodeStats()
+    visits = []
+    source = zweig.to_source(
+        tree,
+        stats=stats,
+        callback=lambda node, time, emitted: visits.append((node, emitted))
+    )
+    assert source == zweig.to_source(tree)
+    assert stats.calls['Name'] == 4
+    assert stats.calls['BinOp'] == 2
+    assert stats.emitted['Module'] == len(source)
+    assert stats.emitted['Name'] == len('foobarbazqux')
+    assert stats.time['Module'] >= stats.time['Assign'] >= 0
+    assert stats.self_time['Module'] <= stats.time['Module']
+    assert visits[-1] == (tree, len(source))
+    assert 'BinOp' in stats.report()
+    assert len(stats.report(limit=1).splitlines()) == 2
+
+
+def test_walk_preorder_stats():
+    tree = ast.parse('foo, bar = baz')
+    stats = zweig.NodeStats()
+    nodes = list(zweig.walk_preorder(tree, stats))
+    assert sum(stats.calls.values()) == len(nodes)
+    assert stats.calls['Name'] == 3
+
+
+def test_iter_source_files(tmpdir):
+    tmpdir.join('b.py').write('')
+    tmpdir.join('a.py').write('')
+    tmpdir.join('c.txt').write('')
+    tmpdir.mkdir('package').join('d.py').write('')
+    other = tmpdir.join('other.txt')
+    assert list(zweig.iter_source_files([str(tmpdir), str(other)])) == [
+        str(tmpdir.join('a.py')),
+        str(tmpdir.join('b.py')),
+        str(tmpdir.join('package', 'd.py')),
+        str(other)
+    ]
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_verify(tmpdir, processes):
+    tmpdir.join('good.py').write('foo = bar\nspam.eggs = foo\n')
+    tmpdir.join('invalid.py').write('def foo(:\n')
+    results = []
+    report = zweig.verify(
+        [str(tmpdir)], processes=processes, callback=results.append
+    )
+    assert sorted(results, key=lambda result: result.path) == sorted(
+        report.results, key=lambda result: result.path
+    )
+    assert len(report.results) == 2
+    assert [failure.path for failure in report.failures] == [
+        str(tmpdir.join('invalid.py'))
+    ]
+    assert report.nodes == sum(
+        1 for _ in zweig.walk_preorder(ast.parse('foo = bar\nspam.eggs = foo'))
+    )
+    assert '2 files, 1 failures' in report.summary()
+
+
+def test_verify_detects_differences(tmpdir, monkeypatch):
+    path = tmpdir.join('module.py')
+    path.write('foo = bar\n')
+    monkeypatch.setattr(zweig, 'to_source', lambda tree: 'foo = baz\n')
+    result = zweig.verify_file(str(path))
+    assert not result.ok
+    assert "'bar' became 'baz'" in result.error
+
+
+def test_verify_unparsable_source(tmpdir, monkeypatch):
+    path = tmpdir.join('module.py')
+    path.write('foo = bar\n')
+    monkeypatch.setattr(zweig, 'to_source', lambda tree: 'foo = (\n')
+    result = zweig.verify_file(str(path))
+    assert not result.ok
+    assert result.error.startswith('cannot parse generated source: ')
+
+
+@pytest.mark.parametrize('jobs', ['1', '2'])
+def test_main(tmpdir, capsys, jobs):
+    tmpdir.join('a.py').write('foo = bar\n')
+    tmpdir.join('b.py').write('spam.eggs = foo\n')
+    nodes_a = len(list(zweig.walk_preorder(ast.parse('foo = bar'))))
+    nodes_b = len(list(zweig.walk_preorder(ast.parse('spam.eggs = foo'))))
+
+    assert zweig.main(['regenerate', '--jobs', jobs, str(tmpdir)]) == 0
+    out, err = capsys.readouterr()
+    assert out == '# {}\nfoo = bar\n# {}\nspam.eggs = foo\n'.format(
+        tmpdir.join('a.py'), tmpdir.join('b.py')
+    )
+    assert '2 files, 0 errors, {} nodes'.format(nodes_a + nodes_b) in err
+
+    assert zweig.main(['dump', str(tmpdir.join('a.py'))]) == 0
+    out, err = capsys.readouterr()
+    assert out == zweig.dump(ast.parse('foo = bar')) + '\n'
+
+    assert zweig.main(['stats', '-j', jobs, str(tmpdir)]) == 0
+    out, err = capsys.readouterr()
+    assert '{}: {} nodes'.format(tmpdir.join('a.py'), nodes_a) in out
+    assert re.search(r'^Name\s+4$', out, re.MULTILINE)
+    assert 'time' not in out
+
+    tmpdir.join('c.py').write('def foo(:\n')
+    assert zweig.main(['verify', '-j', jobs, str(tmpdir)]) == 1
+    out, err = capsys.readouterr()
+    assert out.startswith('{}: '.format(tmpdir.join('c.py')))
+    assert '3 files, 1 failures' in err
+
+
+def _statistics_source():
+    return textwrap.dedent("""\
+        def f(foo):
+            for bar in foo:
+                if bar:
+                    return lambda: bar
+
+        class C:
+            def method(self):
+                pass
+    """)
+
+
+@pytest.mark.parametrize('use_numpy', [False, True])
+def test_collect_statistics(monkeypatch, use_numpy):
+    if use_numpy:
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(zweig, '_import_numpy', lambda: None)
+    trees = [ast.parse(_statistics_source()), ast.parse('foo = bar')]
+    statistics = zweig.collect_statistics(trees)
+
+    nodes = [node for tree in trees for node in zweig.walk_preorder(tree)]
+    counts = statistics.counts()
+    assert sum(counts.values()) == len(nodes)
+    assert counts['Name'] == sum(isinstance(node, ast.Name) for node in nodes)
+    assert counts['Module'] == 2
+    assert sum(statistics.depth_histogram) == len(nodes)
+    assert statistics.depth_histogram[0] == 2
+
+    assert [name for _, name, _ in statistics.functions] == [
+        'f', 'f.<lambda>', 'C.method'
+    ]
+    assert [lineno for _, _, lineno in statistics.functions] == [1, 4, 7]
+    assert list(statistics.function_max_nesting) == [2, 0, 0]
+    function = trees[0].body[0]
+    lambda_ = function.body[0].body[0].body[0].value
+    assert list(statistics.function_node_counts) == [
+        len(list(zweig.walk_preorder(function))) -
+        len(list(zweig.walk_preorder(lambda_))),
+        len(list(zweig.walk_preorder(lambda_))),
+        len(list(zweig.walk_preorder(trees[0].body[1].body[0])))
+    ]
+
+
+@pytest.mark.parametrize('use_numpy', [False, True])
+def test_collect_statistics_deep(monkeypatch, use_numpy):
+    if use_numpy:
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(zweig, '_import_numpy', lambda: None)
+    tree = ast.parse('def deep():\n    pass')
+    statement = tree.body[0].body[0]
+    for _ in range(70000):
+        statement = ast.If(
+            test=ast.Name(id='foo', ctx=ast.Load()), body=[statement],
+            orelse=[]
+        )
+    tree.body[0].body = [statement]
+    statistics = zweig.collect_statistics([tree])
+    assert statistics.max_depth == 70003
+    assert list(statistics.function_max_nesting) == [70000]
+
+
+def test_collect_statistics_empty():
+    statistics = zweig.collect_statistics([])
+    assert statistics.counts() == {}
+    assert len(statistics.functions) == 0
+    assert statistics.max_depth == -1
+
+
+def test_parse_lazy():
+    source = textwrap.dedent('''\
+        import foo
+
+        @decorator(
+            argument
+        )
+        def function(a, b=(1,
+        2)):
+            """
+        def not_a_function():
+            pass
+            """
+            return a + \\
+        b
+
+        def one_liner(): return 1
+
+        class Class(Base):
+            # comment
+            def method(self):
+                pass
+        # trailing comment
+    ''')
+    tree = zweig.parse_lazy(source, '<lazy>')
+    function = tree.body[1]
+    assert function.name == 'function'
+    assert isinstance(function, ast.FunctionDef)
+    assert '_body_source' in function.__dict__
+    assert [node.name for node in tree.body[1:]] == [
+        'function', 'one_liner', 'Class'
+    ]
+    assert '_body_source' not in tree.body[2].__dict__
+
+    assert isinstance(function.body[0], ast.Expr)
+    assert '_body_source' not in function.__dict__
+    assert (
+        zweig.dump(tree, include_attributes=True) ==
+        zweig.dump(ast.parse(source), include_attributes=True)
+    )
+
+    tree = zweig.parse_lazy(source.encode('utf-8'))
+    assert [node.__class__.__name__ for node in zweig.walk_preorder(tree)] == [
+        node.__class__.__name__
+        for node in zweig.walk_preorder(ast.parse(source))
+    ]
+    compile(zweig.parse_lazy(source), '<lazy>', 'exec')
+
+
+def test_parse_lazy_replace_body():
+    tree = zweig.parse_lazy('def f():\n    return foo\n')
+    tree.body[0].body = [ast.Pass()]
+    assert zweig.to_source(tree) == 'def f():\n    pass\n'
+
+
+def test_parse_lazy_errors():
+    with pytest.raises(SyntaxError):
+        zweig.parse_lazy('def f(:\n    pass\n')
+    tree = zweig.parse_lazy('def f():\n    return (\n')
+    with pytest.raises(SyntaxError):
+        tree.body[0].body
+    tree = zweig.parse_lazy('def f():\n    return (foo,\nbar)\n')
+    assert '_body_source' not in tree.body[0].__dict__
+    assert len(tree.body) == 1
+
+
+@pytest.mark.skipif(
+    sys.version_info < (3, 8), reason='end positions require Python 3.8'
+)
+def test_node_source():
+    source = textwrap.dedent(u"""\
+        x = 'äöü' + y  # comment
+        def f(a,
+              b):
+            return (a +
+                    b)
+    """)
+    tree = ast.parse(source)
+    assign, function = tree.body
+    assert zweig.node_source(assign.value.left, source) == u"'äöü'"
+    assert zweig.node_source(assign.value.right, source) == u'y'
+    assert zweig.node_source(assign, source) == u"x = 'äöü' + y"
+    assert zweig.node_source(function.body[0].value, source) == (
+        u'a +\n            b'
+    )
+    assert zweig.node_source(function, source) == source.split('\n', 1)[1][:-1]
+    for node in ast.walk(tree):
+        if hasattr(node, 'end_lineno'):
+            expected = ast.get_source_segment(source, node)
+            assert zweig.node_source(node, source) == expected
+    assert zweig.node_source(ast.Name(id='x', ctx=ast.Load()), source) is None
+    assert zweig.node_source(tree, source) is None
+
+
+def test_source_index():
+    index = zweig.SourceIndex(u'foo\nbär = baz\n')
+    assert index.line_offsets == [0, 4, 14]
+    assert not index.is_ascii
+    assert index.offset(1, 1) == 1
+    assert index.offset(2, 5) == 8
+    assert index.offset(3, 0) == 14
+
+
+def test_identifier_index(tmpdir):
+    def lines(occurrences):
+        return [(path, lineno) for path, lineno, _ in occurrences]
+
+    package = tmpdir.mkdir('package')
+    a = package.join('a.py')
+    a.write(textwrap.dedent("""\
+        import os.path
+        from collections import OrderedDict as odict
+
+        def spam(eggs, *args, **kwargs):
+            global counter
+            counter = eggs.bacon
+            eggs.bacon = odict(key=os.path.join('a', 'b'))
+            return spam(eggs)
+    """))
+    b = package.join('b.py')
+    b.write('from a import spam\nspam(None)\n')
+    package.join('broken.py').write('def (\n')
+    index = zweig.IdentifierIndex(str(tmpdir.join('index.db')))
+    updated = index.update([str(package)])
+    assert sorted(updated) == sorted(
+        str(path) for path in [a, b, package.join('broken.py')]
+    )
+    # Aliases have positions of their own only on Python 3.10 and later.
+    assert lines(index.definitions('spam')) == [(str(a), 4), (str(b), 1)]
+    assert index.usages('spam') == [(str(a), 8, 11), (str(b), 2, 0)]
+    assert index.definitions('eggs') == [(str(a), 4, 9)]
+    assert index.definitions('bacon') == [(str(a), 7, 4)]
+    assert index.usages('bacon') == [(str(a), 6, 14)]
+    assert lines(index.definitions('odict')) == [(str(a), 2)]
+    assert lines(index.usages('OrderedDict')) == [(str(a), 2)]
+    assert index.usages('collections') == [(str(a), 2, 0)]
+    assert lines(index.definitions('os')) == [(str(a), 1)]
+    assert index.usages('counter') == [(str(a), 5, 4)]
+    assert index.definitions('counter') == [(str(a), 6, 4)]
+    assert lines(index.usages('key')) == [(str(a), 7)]
+    assert index.definitions('missing') == []
+    index.close()
+
+    index = zweig.IdentifierIndex(str(tmpdir.join('index.db')))
+    assert index.update([str(package)]) == []
+    b.write('from a import spam as ham\n')
+    package.join('broken.py').remove()
+    assert index.update([str(package)]) == [str(b)]
+    assert index.definitions('spam') == [(str(a), 4, 0)]
+    assert lines(index.usages('spam')) == [(str(a), 8), (str(b), 1)]
+    assert lines(index.definitions('ham')) == [(str(b), 1)]
+    assert index.connection.execute(
+        'SELECT COUNT(*) FROM files'
+    ).fetchone() == (2, )
+
+
+def test_analyze_scopes():
+    tree = ast.parse(textwrap.dedent("""\
+        import os.path as p, sys
+        counter = 0
+
+        def outer(a, b=counter):
+            global counter
+            c = [a for a in range(b) if a != c]
+            def middle():
+                def inner(d):
+                    nonlocal c
+                    c = d + b
+                    return lambda: c + a
+                return inner
+            return middle
+
+        class Spam(object):
+            eggs = 1
+            def method(self):
+                return super().method(eggs)
+    """))
+    scopes = zweig.analyze_scopes(tree)
+    module = scopes[tree]
+    assert module.kind == 'module'
+    assert module.locals == {'p', 'sys', 'counter', 'outer', 'Spam'}
+    assert [child.node.name for child in module.children] == ['outer', 'Spam']
+
+    outer = scopes[tree.body[2]]
+    assert outer.kind == 'function'
+    assert outer.parent is module
+    assert outer.locals == {'a', 'b', 'c', 'middle'}
+    assert outer.globals == {'counter'}
+    assert outer.cells == {'a', 'b', 'c'}
+    assert outer.free == set()
+
+    comprehension = scopes[tree.body[2].body[1].value]
+    assert comprehension.kind == 'comprehension'
+    assert comprehension.locals == {'a'}
+    assert comprehension.free == {'c'}
+    # The first iterable is evaluated in the enclosing scope.
+    assert 'range' not in comprehension.uses
+    assert 'range' in outer.uses
+
+    middle = scopes[tree.body[2].body[2]]
+    assert middle.locals == {'inner'}
+    assert middle.free == {'a', 'b', 'c'}
+
+    inner = scopes[tree.body[2].body[2].body[0]]
+    assert inner.locals == {'d'}
+    assert inner.nonlocals == {'c'}
+    assert inner.free == {'a', 'b', 'c'}
+    assert inner.cells == set()
+
+    spam = scopes[tree.body[3]]
+    assert spam.kind == 'class'
+    assert spam.locals == {'eggs', 'method'}
+    assert spam.cells == {'__class__'}
+    method = scopes[tree.body[3].body[1]]
+    assert method.free == {'__class__'}
+    assert 'eggs' in method.uses and 'eggs' not in method.free
+
+
+def test_analyze_scopes_releases_tree():
+    tree = ast.parse('def f(a):\n    return a')
+    zweig.analyze_scopes(tree)
+    reference = weakref.ref(tree)
+    del tree
+    gc.collect()
+    assert reference() is None
+
+
+@pytest.mark.skipif(
+    sys.version_info < (3, 8), reason='assignment expressions require 3.8'
+)
+def test_analyze_scopes_named_expressions():
+    tree = ast.parse(textwrap.dedent("""\
+        def f(items):
+            if any((last := item) for item in items):
+                return last
+    """))
+    scopes = zweig.analyze_scopes(tree)
+    function = scopes[tree.body[0]]
+    assert function.locals == {'items', 'last'}
+    assert function.cells == {'last'}
+    generator = scopes[tree.body[0].body[0].test.args[0]]
+    assert generator.locals == {'item'}
+    assert generator.free == {'last'}
+
+
+def test_analyze_scopes_nonlocal_without_binding():
+    tree = ast.parse('def f():\n    nonlocal x\n    x = 1\n')
+    with pytest.raises(SyntaxError):
+        zweig.analyze_scopes(tree)
+
+
+def test_fold_constants():
+    tree = ast.parse(textwrap.dedent("""\
+        KILOBYTE = 1024
+        def f(n):
+            size = 4 * KILOBYTE
+            name = 'spam' + '-' * 3
+            flags = (1, 2) + (3, )
+            if size and n:
+                return name[0], -size, size * 2 + n, flags
+            return not 0, 1 < 2 < 3, None or 0 or n, n and True and False
+    """))
+    assert zweig.fold_constants(tree) is tree
+    assert zweig.to_source(tree) == textwrap.dedent("""\
+        KILOBYTE = 1024
+        def f(n):
+            size = 4 * KILOBYTE
+            name = 'spam---'
+            flags = (1, 2, 3)
+            if size and n:
+                return 's', -size, size * 2 + n, (1, 2, 3)
+            return True, True, n, n and False
+    """)
+    namespace = {}
+    exec(compile(tree, '<folded>', 'exec'), namespace)
+    assert namespace['f'](1) == ('s', -4096, 8193, (1, 2, 3))
+    assert namespace['f'](0) == (True, True, 0, 0)
+
+
+def test_fold_constants_propagation():
+    tree = ast.parse(textwrap.dedent("""\
+        def f(a):
+            b = a
+            c = 1
+            d = 2
+            d += 1
+            if a:
+                e = 3
+            else:
+                e = 4
+            g = 5
+            h = 6
+            return b + c + d + e + g + h + (lambda: g)()
+    """))
+    zweig.fold_constants(tree)
+    returned = tree.body[0].body[-1].value
+    names = [
+        node.id for node in zweig.walk_preorder(returned)
+        if isinstance(node, ast.Name)
+    ]
+    assert sorted(names) == ['b', 'd', 'e', 'g', 'g']
+    assert zweig.to_source(returned.left.right) == '6'
+    assert zweig.to_source(returned.left.left.left.left.left.right) == '1'
+
+
+def test_fold_constants_limits():
+    source = textwrap.dedent("""\
+        'x' * 10 ** 9
+        1 / 0
+        2 ** 1000
+        '%s' % 1
+        1 << 2 ** 20
+        (1).real
+    """)
+    tree = zweig.fold_constants(ast.parse(source))
+    assert zweig.to_source(tree) == source.replace(
+        '10 ** 9', '1000000000'
+    ).replace('2 ** 20', '1048576')
+
+
+def test_eliminate_dead_code():
+    tree = ast.parse(textwrap.dedent("""\
+        def f(a):
+            unused = []
+            used = 1
+            if 0:
+                import pdb
+            if True:
+                x = a
+            else:
+                x = 2
+            while False:
+                pass
+            for i in a:
+                if i:
+                    continue
+                    x = i
+                break
+                x = 3
+            try:
+                pass
+            finally:
+                if False:
+                    pass
+            return x + used
+            x = 4
+    """))
+    assert zweig.eliminate_dead_code(tree) is tree
+    assert zweig.to_source(tree) == textwrap.dedent("""\
+        def f(a):
+            used = 1
+            x = a
+            for i in a:
+                if i:
+                    continue
+                break
+            return x + used
+    """)
+
+
+def test_eliminate_dead_code_preserves_scopes():
+    source = textwrap.dedent("""\
+        def generator():
+            return
+            yield
+
+        def unbound():
+            if False:
+                value = 1
+            return value
+
+        def closure():
+            if 0:
+                pass
+            else:
+                cell = 1
+            return lambda : cell
+    """)
+    tree = zweig.eliminate_dead_code(ast.parse(source))
+    assert zweig.to_source(tree) == source.replace(
+        '    if 0:\n        pass\n    else:\n        cell = 1\n',
+        '    cell = 1\n'
+    )
+
+
+def test_hoist_lookups():
+    source = textwrap.dedent("""\
+        import math
+        def f(values, self):
+            result = []
+            for value in values:
+                while len(result) > 10:
+                    result.pop()
+                result.append(math.sqrt(abs(value)))
+                self.items.append(value)
+                math.pi = value
+            else:
+                print(len(result))
+            return result
+    """)
+    tree = zweig.hoist_lookups(ast.parse(source))
+    function = tree.body[1]
+    assert [
+        zweig.to_source(statement).strip()
+        for statement in function.body[1:7]
+    ] == [
+        '_len = len',
+        '_result_pop = result.pop',
+        '_result_append = result.append',
+        '_math_sqrt = math.sqrt',
+        '_abs = abs',
+        '_math = math',
+    ]
+    loop = function.body[-2]
+    assert zweig.to_source(loop.body[0].test) == '_len(result) > 10'
+    assert zweig.to_source(loop.body[1]).strip() == (
+        '_result_append(_math_sqrt(_abs(value)))'
+    )
+    assert zweig.to_source(loop.body[2]).strip() == (
+        'self.items.append(value)'
+    )
+    assert zweig.to_source(loop.body[3]).strip() == '_math.pi = value'
+    assert zweig.to_source(loop.orelse[0]).strip() == 'print(len(result))'
+
+    namespace = {}
+    exec(compile(tree, '<hoisted>', 'exec'), namespace)
+
+    class Items(object):
+        items = []
+    assert namespace['f']([4, -9], Items()) == [2.0, 3.0]
+
+
+def test_hoist_lookups_rebinding():
+    source = textwrap.dedent("""\
+        counter = 0
+        counter = 1
+        def increment():
+            global total
+            total += 1
+        def f(items, _len):
+            for item in items:
+                item = item.strip()
+                item.lower()
+                increment(total, counter, _len, len(item))
+                items = []
+                items.append(item)
+                def nested():
+                    return len
+    """)
+    tree = zweig.hoist_lookups(ast.parse(source))
+    function = tree.body[3]
+    assert zweig.to_source(function.body[0]).strip() == (
+        '_increment = increment'
+    )
+    assert zweig.to_source(function.body[1]).strip() == '_len_2 = len'
+    loop = function.body[2]
+    assert zweig.to_source(loop.body[1]).strip() == 'item.lower()'
+    assert zweig.to_source(loop.body[2]).strip() == (
+        '_increment(total, counter, _len, _len_2(item))'
+    )
+    assert zweig.to_source(loop.body[4]).strip() == 'items.append(item)'
+    assert zweig.to_source(loop.body[5].body[0]).strip() == 'return len'
+
+
+def test_hoist_lookups_mutable_attributes():
+    source = textwrap.dedent("""\
+        class State(object):
+            n = 0
+            def handle(self):
+                return self.n
+        state = State()
+        def increment():
+            state.n += 1
+        def replace():
+            state.handle = lambda: -1
+        def f():
+            result = []
+            for _ in range(3):
+                increment()
+                result.append(state.n)
+            return result
+        def g():
+            result = []
+            for _ in range(2):
+                result.append(state.handle())
+                replace()
+            return result
+    """)
+    tree = zweig.hoist_lookups(ast.parse(source))
+    namespace = {}
+    exec(compile(tree, '<hoisted>', 'exec'), namespace)
+    assert namespace['f']() == [1, 2, 3]
+    assert namespace['g']() == [3, -1]
+    assert '_state_2.handle()' in zweig.to_source(tree.body[5])
+
+    source = textwrap.dedent("""\
+        import os
+        def f(paths):
+            for path in paths:
+                os.path.join(path, os.sep)
+    """)
+    tree = zweig.hoist_lookups(ast.parse(source))
+    assert [
+        zweig.to_source(statement).strip() for statement in tree.body[1].body
+    ][:2] == ['_os_path_join = os.path.join', '_os = os']
+
+
+def test_inline_functions():
+    source = textwrap.dedent("""\
+        def square(x):
+            return x * x
+
+        def clamp(value, low, high):
+            \"\"\"Clamps the value.\"\"\"
+            if value < low:
+                value = low
+            if value > high:
+                value = high
+            return value
+
+        def validate(items):
+            total = 0
+            for item in items:
+                total += square(item) + square(2)
+                clamp(item, 0, 1)
+                item = clamp(item + 1, 0, high=10)
+            return clamp(total, 0, 100)
+    """)
+    tree = zweig.inline_functions(ast.parse(source))
+    assert zweig.to_source(tree.body[2]) == textwrap.dedent("""\
+        def validate(items):
+            total = 0
+            for item in items:
+                total += item * item + 2 * 2
+                _clamp_value = item
+                _clamp_low = 0
+                _clamp_high = 1
+                if _clamp_value < _clamp_low:
+                    _clamp_value = _clamp_low
+                if _clamp_value > _clamp_high:
+                    _clamp_value = _clamp_high
+                _clamp_value = item + 1
+                _clamp_low = 0
+                _clamp_high = 10
+                if _clamp_value < _clamp_low:
+                    _clamp_value = _clamp_low
+                if _clamp_value > _clamp_high:
+                    _clamp_value = _clamp_high
+                item = _clamp_value
+            _clamp_value = total
+            _clamp_low = 0
+            _clamp_high = 100
+            if _clamp_value < _clamp_low:
+                _clamp_value = _clamp_low
+            if _clamp_value > _clamp_high:
+                _clamp_value = _clamp_high
+            return _clamp_value
+    """)
+    namespace = {}
+    exec(compile(tree, '<inlined>', 'exec'), namespace)
+    assert namespace['validate']([1, 2, 30]) == 100
+
+
+def test_inline_functions_restrictions():
+    source = textwrap.dedent("""\
+        def recursive(n):
+            return recursive(n - 1) if n else 0
+
+        def early(n):
+            if n:
+                return 1
+            return 2
+
+        def square(x):
+            return x * x
+
+        def large(x):
+            return x + x + x + x + x + x + x + x + x + x + x
+
+        def f(square, n):
+            square(n)
+            recursive(n)
+            early(n)
+            large(n)
+
+        def scale(x):
+            return x * FACTOR
+
+        def g(n):
+            FACTOR = 1
+            return scale(n + 1)
+    """)
+    tree = ast.parse(source)
+    zweig.inline_functions(tree, threshold=20)
+    assert zweig.to_source(tree) == zweig.to_source(ast.parse(source))
+
+
+@pytest.mark.skipif(
+    sys.version_info < (3, 8), reason='assignment expressions require 3.8'
+)
+def test_inline_functions_named_expressions():
+    source = textwrap.dedent("""\
+        def double(x):
+            return (t := x * 2) + t - x * 2
+
+        def f(x):
+            t = 100
+            y = double(x)
+            return t, y, [double(x)]
+    """)
+    tree = zweig.inline_functions(ast.parse(source))
+    inlined = zweig.to_source(tree.body[1])
+    assert '_double_t' in inlined and '[double(x)]' in inlined
+    namespace = {}
+    exec(compile(tree, '<inlined>', 'exec'), namespace)
+    assert namespace['f'](1) == (100, 2, [2])
+
+
+def test_use_comprehensions():
+    source = textwrap.dedent("""\
+        def transform(items, table):
+            doubled = []
+            for item in items:
+                if item:
+                    doubled.append(item * 2)
+            squares = set()
+            for row in table:
+                for value in row:
+                    squares.add((value, value ** 2))
+            inverted = {}
+            for key, value in table:
+                inverted[value] = key
+            return doubled, squares, inverted
+    """)
+    tree = zweig.use_comprehensions(ast.parse(source))
+    assert zweig.to_source(tree) == textwrap.dedent("""\
+        def transform(items, table):
+            doubled = [item * 2 for item in items if item]
+            squares = {(value, value ** 2) for row in table for value in row}
+            inverted = {value: key for key, value in table}
+            return doubled, squares, inverted
+    """)
+    namespace = {}
+    exec(compile(tree, '<comprehensions>', 'exec'), namespace)
+    assert namespace['transform']([0, 1], [(1, 2)]) == (
+        [2], set([(1, 1), (2, 4)]), {2: 1}
+    )
+
+
+def test_use_comprehensions_restrictions():
+    source = textwrap.dedent("""\
+        def f(items, set):
+            leaked = []
+            for item in items:
+                leaked.append(item)
+            print(item)
+            guarded = []
+            try:
+                for item in items:
+                    guarded.append(item)
+            except ValueError:
+                pass
+            shadowed = set()
+            for item in items:
+                shadowed.add(item)
+            ordered = {}
+            for item in items:
+                ordered[str(item)] = repr(item)
+            recursive = []
+            for item in items:
+                recursive.append(len(recursive))
+            filtered = []
+            for item in items:
+                if item:
+                    filtered.append(item)
+                else:
+                    pass
+    """)
+    tree = zweig.use_comprehensions(ast.parse(source))
+    assert zweig.to_source(tree) == zweig.to_source(ast.parse(source))
+
+
+@min_python3
+def test_memoize_functions():
+    source = textwrap.dedent("""\
+        \"\"\"Docstring.\"\"\"
+        from __future__ import division
+        import os
+
+        SCALE = 3
+
+        def fib(n: int) -> int:
+            return n if n < 2 else fib(n - 1) + fib(n - 2)
+
+        def scaled(n: int) -> int:
+            return fib(n) * SCALE
+
+        def unannotated(n):
+            return n
+
+        def environment(name: str) -> str:
+            return os.environ[name]
+
+        def indirect(name: str) -> str:
+            return environment(name)
+    """)
+    report = zweig.MemoizationReport()
+    tree = zweig.memoize_functions(
+        ast.parse(source), maxsize=64, report=report
+    )
+    assert zweig.to_source(tree.body[2]).strip() == (
+        'from functools import lru_cache as _lru_cache'
+    )
+    assert [
+        zweig.to_source(statement.decorator_list[0]) if
+        isinstance(statement, ast.FunctionDef) and statement.decorator_list
+        else None
+        for statement in tree.body
+    ] == [None] * 5 + ['_lru_cache(maxsize=64, typed=True)'] * 2 + [None] * 3
+    assert report.memoized == ['fib', 'scaled']
+    assert report.rejected == {
+        'unannotated': 'not annotated with hashable types',
+        'environment': "uses 'os'",
+        'indirect': "calls 'environment'"
+    }
+    namespace = {}
+    exec(compile(tree, '<memoized>', 'exec'), namespace)
+    assert namespace['scaled'](60) == 1548008755920 * 3
+    assert namespace['fib'].cache_info().hits > 0
+
+    # Equal arguments of different types are cached separately.
+    tree = zweig.memoize_functions(ast.parse(
+        'def join(x: float, y: int) -> str:\n    return repr(x) + repr(y)'
+    ))
+    namespace = {}
+    exec(compile(tree, '<memoized>', 'exec'), namespace)
+    assert namespace['join'](1, True) == '1True'
+    assert namespace['join'](1.0, 1) == '1.01'
+    assert namespace['join'](True, 1.0) == 'True1.0'
+
+    # Tuples may contain unhashable items.
+    report = zweig.MemoizationReport()
+    zweig.memoize_functions(ast.parse(
+        'def count(items: tuple) -> int:\n    return len(items)'
+    ), report=report)
+    assert report.rejected == {'count': 'not annotated with hashable types'}
+
+
+def test_memoize_functions_marker():
+    source = textwrap.dedent("""\
+        @pure
+        def lookup(key):
+            return {'a': 1}.get(key)
+
+        class Table(object):
+            @staticmethod
+            @pure
+            def lookup(key):
+                return key
+    """)
+    report = zweig.MemoizationReport()
+    tree = zweig.memoize_functions(
+        ast.parse(source), marker='pure', report=report
+    )
+    assert zweig.to_source(tree) == textwrap.dedent("""\
+        from functools import lru_cache as _lru_cache
+        @_lru_cache(maxsize=128, typed=True)
+        def lookup(key):
+            return {'a': 1}.get(key)
+
+        class Table(object):
+            @staticmethod
+            @_lru_cache(maxsize=128, typed=True)
+            def lookup(key):
+                return key
+    """)
+    assert report.memoized == ['lookup', 'lookup']
+    # Modules without memoized functions are left alone.
+    assert len(zweig.memoize_functions(ast.parse('x = 1')).body) == 1
+
+
+def test_instrument_functions():
+    source = textwrap.dedent("""\
+        def handle(n):
+            \"\"\"Handles n.\"\"\"
+            return sum([helper(i) for i in range(n)])
+
+        def helper(i):
+            return i * 2
+
+        def generate():
+            yield 1
+
+        class Service(object):
+            @probe
+            def method(self):
+                return 1
+    """)
+    tree = zweig.instrument_functions(
+        ast.parse(source), pattern='h*', marker='probe', table='test'
+    )
+    assert zweig.to_source(tree.body[5]) == textwrap.dedent("""\
+        def handle(n):
+            'Handles n.'
+            _probe_start = _probe_timer()
+            try:
+                return sum([helper(i) for i in range(n)])
+            finally:
+                _probe_counts[_probe_offset + 0] += 1
+                _probe_times[_probe_offset + 0] += _probe_timer() - _probe_start
+    """)
+    assert tree.body[8].body[0].decorator_list == []
+    namespace = {'__name__': 'service'}
+    exec(compile(tree, '<instrumented>', 'exec'), namespace)
+    assert namespace['handle'](10) == 90
+    namespace['Service']().method()
+    table = zweig.probe_table('test')
+    assert table.names == [
+        'service.handle', 'service.helper', 'service.Service.method'
+    ]
+    assert list(table.counts[:3]) == [1, 10, 1]
+    assert table.times[0] >= table.times[1] > 0
+    lines = table.report().splitlines()
+    assert lines[1].split()[:2] == ['service.handle', '1']
+    assert len(lines) == 4
+    table.reset()
+    assert not any(table.counts) and not any(table.times)
+    with pytest.raises(TypeError):
+        zweig.instrument_functions(ast.parse(source))
+
+
+@pytest.mark.skipif(
+    sys.version_info < (3, 8), reason='assignment expressions require 3.8'
+)
+def test_instrument_functions_bodies():
+    source = textwrap.dedent("""\
+        def documented():
+            \"\"\"Only a docstring.\"\"\"
+
+        def assigning(items):
+            if (n := len(items)) > 1:
+                return n
+            return 0
+    """)
+    tree = zweig.instrument_functions(
+        ast.parse(source), pattern='*', table='bodies'
+    )
+    namespace = {'__name__': 'bodies'}
+    exec(compile(tree, '<instrumented>', 'exec'), namespace)
+    assert namespace['documented']() is None
+    assert namespace['documented'].__doc__ == 'Only a docstring.'
+    assert namespace['assigning']([1, 2]) == 2
+    table = zweig.probe_table('bodies')
+    assert table.names == ['bodies.documented', 'bodies.assigning']
+    assert list(table.counts[:2]) == [1, 1]
+
+
+def test_comments():
+    tree = ast.parse('def f(x):\n    y = 1\n    return x\n')
+    comments = {tree.body[0]: 'function\nhot', tree.body[0].body[1]: 'return'}
+    assert zweig.to_source(tree, comments=comments) == textwrap.dedent("""\
+        # function
+        # hot
+        def f(x):
+            y = 1
+            # return
+            return x
+    """)
+    lines = zweig.dump(tree, comments=comments).splitlines()
+    assert lines[1:3] == ['    # function', '    # hot']
+    assert lines[3].startswith("    FunctionDef(name='f'")
+    assert '        # return' in lines
+
+
+def test_annotate_profile():
+    source = textwrap.dedent("""\
+        def square(n):
+            result = 0
+            for _ in range(n):
+                result += n
+            return result
+
+        def main():
+            return square(1000) + square(2)
+    """)
+    tree = ast.parse(source)
+    namespace = {}
+    exec(compile(tree, '<profiled>', 'exec'), namespace)
+    profile = cProfile.Profile()
+    profile.runcall(namespace['main'])
+    profiles = zweig.annotate_profile(tree, '<profiled>', stats=profile)
+    assert list(profiles) == tree.body
+    assert [profile.calls for profile in profiles.values()] == [2, 1]
+    square, main = profiles.values()
+    assert main.cumulative_time >= square.cumulative_time > 0
+
+    samples = (
+        [[('<profiled>', 8), ('<profiled>', 4)]] * 3 +
+        [[('<profiled>', 8), ('<profiled>', 3)]] +
+        [[('<profiled>', 8), ('other.py', 1)]] +
+        [[('other.py', 1)]]
+    )
+    profiles = zweig.annotate_profile(
+        tree, '<profiled>', samples=samples, interval=0.5
+    )
+    function, loop, statement = tree.body[0], tree.body[0].body[1], (
+        tree.body[0].body[1].body[0]
+    )
+    assert list(profiles) == [
+        function, loop, statement, tree.body[1], tree.body[1].body[0]
+    ]
+    assert [
+        (profile.cumulative_time, profile.self_time, profile.calls)
+        for profile in profiles.values()
+    ] == [
+        (2.0, 2.0, None), (2.0, 0.5, None), (1.5, 1.5, None),
+        (2.5, 0.0, None), (2.5, 0.0, None)
+    ]
+    assert profiles[loop].describe() == 'cumulative 2.000000s, self 0.500000s'
+    with pytest.raises(TypeError):
+        zweig.annotate_profile(tree, '<profiled>')
+
+
+class _CountNames(zweig.Pass):
+    def __init__(self):
+        self.names = []
+
+    def visit_Name(self, node):
+        self.names.append(node.id)
+        return node
+
+
+class _RenameNames(zweig.Pass):
+    requires = ('_CountNames', )
+
+    def visit_Name(self, node):
+        node.id = node.id.upper()
+        return node
+
+
+class _RemovePass(zweig.Pass):
+    def visit_Pass(self, node):
+        return None
+
+
+class _ExpandAugAssign(zweig.Pass):
+    def visit_AugAssign(self, node):
+        self.generic_visit(node)
+        value = ast.BinOp(
+            left=ast.Name(id=node.target.id, ctx=ast.Load()),
+            op=node.op, right=node.value
+        )
+        return ast.copy_location(ast.Assign(
+            targets=[node.target], value=value
+        ), node)
+
+
+def test_pass_manager():
+    source = textwrap.dedent("""\
+        def f(a):
+            pass
+            a += b
+            return a
+    """)
+    counter = _CountNames()
+    manager = zweig.PassManager(
+        [_RenameNames(), _RemovePass(), counter, _ExpandAugAssign()],
+        timing=True
+    )
+    assert [transform.name for transform in manager.ordered()] == [
+        '_RemovePass', '_CountNames', '_RenameNames', '_ExpandAugAssign'
+    ]
+    tree = manager.run(ast.parse(source))
+    assert zweig.to_source(tree) == textwrap.dedent("""\
+        def f(a):
+            A = A + B
+            return A
+    """)
+    # The names are counted before they are renamed and the name created by
+    # _ExpandAugAssign is not passed to the other passes.
+    assert counter.names == ['a', 'b', 'a']
+    assert list(manager.timings) == [
+        '_RenameNames', '_RemovePass', '_CountNames', '_ExpandAugAssign'
+    ]
+    assert all(time >= 0 for time in manager.timings.values())
+
+    manager = zweig.PassManager([zweig.fold_constants, _RemovePass()])
+    tree = manager.run(ast.parse('if 1 + 1:\n    x = 2 * 3\n    pass'))
+    assert zweig.to_source(tree) == 'if 2:\n    x = 6\n'
+    assert manager.timings == {'fold_constants': 0.0, '_RemovePass': 0.0}
+
+
+def test_pass_manager_requirements():
+    manager = zweig.PassManager([_RenameNames()])
+    with pytest.raises(ValueError):
+        manager.ordered()
+    manager.add(_CountNames())
+    assert [transform.name for transform in manager.ordered()] == [
+        '_CountNames', '_RenameNames'
+    ]
+    manager = zweig.PassManager([_RenameNames(), _CountNames()])
+    manager.passes[1].requires = ('_RenameNames', )
+    with pytest.raises(ValueError):
+        manager.ordered()
+
+
+def test_compile_cached(tmpdir):
+    cache = zweig.CodeCache(str(tmpdir), maxsize=2)
+    tree = ast.parse('def f(a):\n    return a + 1\n')
+    code = zweig.compile_cached(tree, '<cached>', cache=cache)
+    namespace = {}
+    exec(code, namespace)
+    assert namespace['f'](1) == 2
+    assert (cache.hits, cache.misses) == (0, 1)
+    # The locations of the nodes do not matter.
+    moved = zweig.clone(tree, line_offset=10)
+    assert zweig.compile_cached(moved, '<cached>', cache=cache) is code
+    assert (cache.hits, cache.misses) == (1, 1)
+    for source in ['x = 1', 'x = 1.0', 'x = True', "x = '1'"]:
+        zweig.compile_cached(ast.parse(source), '<cached>', cache=cache)
+    assert cache.misses == 5
+    assert zweig.compile_cached(ast.parse('x = 1.0'), cache=cache) is not (
+        zweig.compile_cached(ast.parse('x = 1.0'), '<cached>', cache=cache)
+    )
+    assert len(tmpdir.listdir()) == 6
+
+    # A new cache, as in another process, loads the code from disk, unless
+    # it has been written by another version of Python.
+    cache = zweig.CodeCache(str(tmpdir))
+    loaded = zweig.compile_cached(tree, '<cached>', cache=cache)
+    assert loaded == code
+    assert (cache.hits, cache.misses) == (1, 0)
+    for path in tmpdir.listdir():
+        path.write_binary(b'invalid' + path.read_binary())
+    cache = zweig.CodeCache(str(tmpdir))
+    assert zweig.compile_cached(tree, '<cached>', cache=cache) == code
+    assert (cache.hits, cache.misses) == (0, 1)
+
+
+def test_compile_cached_eviction():
+    cache = zweig.CodeCache(maxsize=2)
+    trees = [ast.parse('x = {}'.format(number)) for number in range(3)]
+    codes = [zweig.compile_cached(tree, cache=cache) for tree in trees]
+    assert zweig.compile_cached(trees[2], cache=cache) is codes[2]
+    assert zweig.compile_cached(trees[1], cache=cache) is codes[1]
+    assert zweig.compile_cached(trees[0], cache=cache) is not codes[0]
+    assert (cache.hits, cache.misses) == (2, 4)
+    # Calls without a cache share one.
+    code = zweig.compile_cached(trees[0])
+    assert zweig.compile_cached(ast.parse('x = 0')) is code
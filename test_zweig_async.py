@@ -0,0 +1,87 @@
+# coding: utf-8
+"""
+    test_zweig_async
+    ~~~~~~~~~~~~~~~~
+
+    :copyright: 2014 by Daniel Neuhäuser
+    :license: BSD, see LICENSE.rst for details
+"""
+import ast
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+import zweig
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_aparse_and_walk(tmpdir):
+    tmpdir.join('a.py').write('foo = bar\n')
+    tmpdir.join('b.py').write('spam.eggs = foo\n')
+
+    results = run(zweig.aparse_and_walk([str(tmpdir)]))
+    assert [path for path, _ in results] == [
+        str(tmpdir.join('a.py')), str(tmpdir.join('b.py'))
+    ]
+    assert [len(nodes) for _, nodes in results] == [
+        len(list(zweig.walk_preorder(ast.parse(source))))
+        for source in ['foo = bar', 'spam.eggs = foo']
+    ]
+
+
+def test_aiter_trees(tmpdir):
+    tmpdir.join('a.py').write('foo = bar\n')
+    tmpdir.join('b.py').write('spam.eggs = foo\n')
+    paths = [str(tmpdir.join('a.py')), str(tmpdir.join('b.py'))]
+
+    async def collect(executor):
+        results = []
+        async for result in zweig.aiter_trees(
+                paths, function=zweig.to_source, concurrency=1,
+                executor=executor):
+            results.append(result)
+        return results
+
+    with ProcessPoolExecutor(2) as executor:
+        results = run(collect(executor))
+    assert sorted(results) == [
+        (paths[0], 'foo = bar\n'), (paths[1], 'spam.eggs = foo\n')
+    ]
+
+
+
+def test_aiter_trees_bounded(tmpdir):
+    paths = []
+    for index in range(50):
+        path = tmpdir.join('{:02}.py'.format(index))
+        path.write('foo = {}\n'.format(index))
+        paths.append(str(path))
+    task_counts = []
+
+    async def collect():
+        results = []
+        async for path, _ in zweig.aiter_trees([str(tmpdir)], concurrency=3):
+            results.append(path)
+            task_counts.append(len(asyncio.all_tasks()))
+        return results
+
+    assert sorted(run(collect())) == paths
+    # The workers and the task running collect.
+    assert max(task_counts) <= 4
+    assert [path for path, _ in run(zweig.aparse_and_walk(
+        [str(tmpdir)], concurrency=3
+    ))] == paths
+
+    tmpdir.join('25.py').write('foo =\n')
+    with pytest.raises(SyntaxError):
+        run(zweig.aparse_and_walk([str(tmpdir)], concurrency=3))
+def test_ato_source():
+    source = run(zweig.ato_source(ast.parse('foo = bar')))
+    assert source == 'foo = bar\n'
@@ -8,12 +8,29 @@
 """
 from __future__ import unicode_literals
 import os
+import re
 import sys
 import ast
-from io import StringIO
+import math
+import signal
+import hashlib
+import operator
+import argparse
+import tokenize
+from io import StringIO, BytesIO
 from contextlib import contextmanager
+from array import array
+from types import CodeType
+from fnmatch import fnmatchcase
 from itertools import chain
-from functools import reduce
+from collections import OrderedDict
+from functools import reduce, partial
+from timeit import default_timer
+try:
+    from importlib.util import MAGIC_NUMBER as _magic_number
+except ImportError:  # Python 2
+    from imp import get_magic
+    _magic_number = get_magic()
 
 
 __version__ = '0.1.0'
@@ -23,30 +40,130 @@ __version_info__ = (0, 1, 0)
 PY2 = sys.version_info[0] == 2
 
 
-def walk_preorder(tree):
+def walk_preorder(tree, stats=None):
     """
     Yields the nodes in the `tree` in preorder.
+
+    If a :class:`NodeStats` instance is passed as `stats`, the yielded nodes
+    are counted in it.
     """
+    if stats is not None:
+        stats.record(tree)
     yield tree
-    for child in ast.iter_child_nodes(tree):
-        for descendent in walk_preorder(child):
+    for child in _iter_child_nodes(tree):
+        for descendent in walk_preorder(child, stats):
             yield descendent
 
 
-def to_source(tree):
+def _iter_child_nodes(node):
+    if isinstance(node, CompactNode):
+        for name in node._fields:
+            value = getattr(node, name, None)
+            if isinstance(value, CompactNode):
+                yield value
+            elif isinstance(value, _NodeList):
+                for item in value:
+                    if isinstance(item, CompactNode):
+                        yield item
+    else:
+        for child in ast.iter_child_nodes(node):
+            yield child
+
+
+def to_source(tree, stats=None, callback=None, comments=None):
     """
     Returns the Python source code representation of the `tree`.
+
+    If a :class:`NodeStats` instance is passed as `stats`, the number of
+    visits, the time spent and the number of characters emitted are recorded
+    in it for every node class. If a `callback` is given, it is called after
+    each node has been written with the node, the time spent on it in
+    seconds and the number of characters emitted for it.
+
+    `comments` may map statement nodes to strings, which are written as
+    comments in the lines before the statements.
     """
-    writer = _SourceWriter()
+    if isinstance(tree, CompactNode):
+        tree = from_compact(tree)
+    if stats is None and callback is None:
+        writer = _SourceWriter(comments)
+    else:
+        writer = _ProfilingSourceWriter(stats, callback, comments)
     writer.visit(tree)
     return writer.output.getvalue()
 
 
-class _SourceWriter(ast.NodeVisitor):
+class NodeStats(object):
+    """
+    Collects statistics per node class, such as the number of visits, the
+    time spent and the number of characters emitted by :func:`to_source`.
+
+    All mappings use the names of the node classes as keys. Times and
+    characters are cumulative, they include the children of a node, except
+    for :attr:`self_time`.
+    """
+
     def __init__(self):
+        #: Maps node class names to the number of visits.
+        self.calls = {}
+        #: Maps node class names to the time spent in seconds.
+        self.time = {}
+        #: Maps node class names to the time spent in seconds excluding the
+        #: time spent on children.
+        self.self_time = {}
+        #: Maps node class names to the number of characters emitted.
+        self.emitted = {}
+
+    def record(self, node, time=0.0, self_time=0.0, emitted=0):
+        """
+        Records a visit of the `node`.
+        """
+        name = node.__class__.__name__
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if time:
+            self.time[name] = self.time.get(name, 0.0) + time
+        if self_time:
+            self.self_time[name] = self.self_time.get(name, 0.0) + self_time
+        if emitted:
+            self.emitted[name] = self.emitted.get(name, 0) + emitted
+
+    def report(self, limit=None):
+        """
+        Returns a table of the recorded statistics as a string, sorted by
+        the time spent excluding children and the number of visits.
+        """
+        names = sorted(
+            self.calls,
+            key=lambda name: (
+                self.self_time.get(name, 0.0), self.calls[name], name
+            ),
+            reverse=True
+        )[:limit]
+        lines = ['{:<20} {:>10} {:>12} {:>12} {:>12}'.format(
+            'node', 'calls', 'time', 'self time', 'emitted'
+        )]
+        for name in names:
+            lines.append('{:<20} {:>10} {:>12.6f} {:>12.6f} {:>12}'.format(
+                name,
+                self.calls[name],
+                self.time.get(name, 0.0),
+                self.self_time.get(name, 0.0),
+                self.emitted.get(name, 0)
+            ))
+        return '\n'.join(lines)
+
+
+# Attribute references, subscriptions and calls can be chained without
+# parentheses.
+_trailer_classes = (ast.Attribute, ast.Subscript, ast.Call)
+
+
+class _SourceWriter(ast.NodeVisitor):
+    def __init__(self, comments=None):
         self.output = StringIO()
         self.indentation_level = 0
         self.newline = True
+        self.comments = comments
 
     @contextmanager
     def indented(self):
@@ -98,16 +215,31 @@ class _SourceWriter(ast.NodeVisitor):
         for node in self.writing_comma_separated(nodes):
             self.visit(node)
 
+    def visit_parenthesized(self, node, node_classes):
+        if isinstance(node, node_classes):
+            self.write('(')
+            self.visit(node)
+            self.write(')')
+        else:
+            self.visit(node)
+
     @contextmanager
     def writing_statement(self):
         yield
         self.write_newline()
 
+    def write_comment(self, node):
+        if self.comments and node in self.comments:
+            for line in self.comments[node].splitlines():
+                self.write_line('# ' + line)
+
     def visit_statements(self, statements):
         for statement in statements[:-1]:
+            self.write_comment(statement)
             self.visit(statement)
             if isinstance(statement, (ast.FunctionDef, ast.ClassDef)):
                 self.write_newline()
+        self.write_comment(statements[-1])
         self.visit(statements[-1])
 
     def visit_Module(self, node):
@@ -138,9 +270,13 @@ class _SourceWriter(ast.NodeVisitor):
             self.write_newline()
         self.write('class ')
         self.write_identifier(node.name)
+        # Python 3.5 removed starargs and kwargs in favour of starred bases
+        # and keywords without a name.
+        starargs = getattr(node, 'starargs', None)
+        kwargs = getattr(node, 'kwargs', None)
         if (
             node.bases or
-            (not PY2 and (node.keywords or node.starargs or node.kwargs))
+            (not PY2 and (node.keywords or starargs or kwargs))
         ):
             self.write('(')
             self.write_comma_separated_nodes(node.bases)
@@ -149,16 +285,16 @@ class _SourceWriter(ast.NodeVisitor):
                     if node.bases:
                         self.write(', ')
                     self.write_comma_separated_nodes(node.keywords)
-                if node.starargs is not None:
+                if starargs is not None:
                     if node.bases or node.keywords:
                         self.write(', ')
                     self.write('*')
-                    self.visit(node.starargs)
-                if node.kwargs is not None:
-                    if node.bases or node.keywords or node.starargs:
+                    self.visit(starargs)
+                if kwargs is not None:
+                    if node.bases or node.keywords or starargs:
                         self.write(', ')
                     self.write('**')
-                    self.visit(node.kwargs)
+                    self.visit(kwargs)
             self.write(')')
         self.write(':')
         self.write_newline()
@@ -442,30 +578,30 @@ class _SourceWriter(ast.NodeVisitor):
 
     def visit_ListComp(self, node):
         self.write('[')
-        self.visit(node.elt)
+        self.visit_parenthesized(node.elt, ast.Tuple)
         for generator in node.generators:
             self.visit(generator)
         self.write(']')
 
     def visit_SetComp(self, node):
         self.write('{')
-        self.visit(node.elt)
+        self.visit_parenthesized(node.elt, ast.Tuple)
         for generator in node.generators:
             self.visit(generator)
         self.write('}')
 
     def visit_DictComp(self, node):
         self.write('{')
-        self.visit(node.key)
+        self.visit_parenthesized(node.key, ast.Tuple)
         self.write(': ')
-        self.visit(node.value)
+        self.visit_parenthesized(node.value, ast.Tuple)
         for generator in node.generators:
             self.visit(generator)
         self.write('}')
 
     def visit_GeneratorExp(self, node):
         self.write('(')
-        self.visit(node.elt)
+        self.visit_parenthesized(node.elt, ast.Tuple)
         for generator in node.generators:
             self.visit(generator)
         self.write(')')
@@ -489,7 +625,10 @@ class _SourceWriter(ast.NodeVisitor):
             self.visit(comparator)
 
     def visit_Call(self, node):
-        if _requires_parentheses(node, node.func):
+        if (
+            _requires_parentheses(node, node.func) and
+            not isinstance(node.func, _trailer_classes)
+        ):
             self.write('(')
             self.visit(node.func)
             self.write(')')
@@ -501,16 +640,18 @@ class _SourceWriter(ast.NodeVisitor):
             if node.args:
                 self.write(', ')
             self.write_comma_separated_nodes(node.keywords)
-        if node.starargs is not None:
+        starargs = getattr(node, 'starargs', None)
+        kwargs = getattr(node, 'kwargs', None)
+        if starargs is not None:
             if node.args or node.keywords:
                 self.write(', ')
             self.write('*')
-            self.visit(node.starargs)
-        if node.kwargs:
-            if node.args or node.keywords or node.starargs:
+            self.visit(starargs)
+        if kwargs:
+            if node.args or node.keywords or starargs:
                 self.write(', ')
             self.write('**')
-            self.visit(node.kwargs)
+            self.visit(kwargs)
         self.write(')')
 
     if PY2:
@@ -531,10 +672,21 @@ class _SourceWriter(ast.NodeVisitor):
     def visit_Ellipsis(self, node):
         self.write('...')
 
+    def visit_NameConstant(self, node):
+        self.write_repr(node.value)
+
+    def visit_Constant(self, node):
+        if node.value is Ellipsis:
+            self.write('...')
+        else:
+            self.write_repr(node.value)
+
     def visit_Attribute(self, node):
         if (
             _requires_parentheses(node, node.value) and
-            not isinstance(node.value, ast.Attribute)
+            not isinstance(node.value, _trailer_classes) or
+            # The dot would be part of the literal.
+            isinstance(_constant_value(node.value), _integer_types)
         ):
             self.write('(')
             self.visit(node.value)
@@ -547,7 +699,7 @@ class _SourceWriter(ast.NodeVisitor):
     def visit_Subscript(self, node):
         if (
             _requires_parentheses(node, node.value) and
-            not isinstance(node.value, ast.Subscript)
+            not isinstance(node.value, _trailer_classes)
         ):
             self.write('(')
             self.visit(node.value)
@@ -678,13 +830,12 @@ class _SourceWriter(ast.NodeVisitor):
         self.write(' for ')
         self.visit(node.target)
         self.write(' in ')
-        self.visit(node.iter)
-        if node.ifs:
+        self.visit_parenthesized(
+            node.iter, (ast.Tuple, ast.IfExp, ast.Lambda)
+        )
+        for filter in node.ifs:
             self.write(' if ')
-            for filter in node.ifs[:-1]:
-                self.visit(filter)
-                self.write(' if ')
-            self.visit(node.ifs[-1])
+            self.visit_parenthesized(filter, (ast.IfExp, ast.Lambda))
 
     def visit_ExceptHandler(self, node):
         self.write('except')
@@ -747,8 +898,11 @@ class _SourceWriter(ast.NodeVisitor):
             self.visit(node.annotation)
 
     def visit_keyword(self, node):
-        self.write_identifier(node.arg)
-        self.write('=')
+        if node.arg is None:
+            self.write('**')
+        else:
+            self.write_identifier(node.arg)
+            self.write('=')
         self.visit(node.value)
 
     def visit_alias(self, node):
@@ -764,6 +918,37 @@ class _SourceWriter(ast.NodeVisitor):
             self.visit(node.optional_vars)
 
 
+class _ProfilingSourceWriter(_SourceWriter):
+    def __init__(self, stats=None, callback=None, comments=None):
+        _SourceWriter.__init__(self, comments)
+        self.stats = stats
+        self.callback = callback
+        self.emitted = 0
+        # Time spent on the children of the nodes currently being visited.
+        self.child_times = []
+
+    def write(self, source):
+        self.emitted += len(source)
+        _SourceWriter.write(self, source)
+
+    def visit(self, node):
+        emitted = self.emitted
+        self.child_times.append(0.0)
+        start = default_timer()
+        try:
+            return _SourceWriter.visit(self, node)
+        finally:
+            time = default_timer() - start
+            self_time = time - self.child_times.pop()
+            if self.child_times:
+                self.child_times[-1] += time
+            emitted = self.emitted - emitted
+            if self.stats is not None:
+                self.stats.record(node, time, self_time, emitted)
+            if self.callback is not None:
+                self.callback(node, time, emitted)
+
+
 _precedence_tower = [
     {ast.Lambda},
     {ast.IfExp},
@@ -809,13 +994,25 @@ def _requires_parentheses(parent, child):
     return child in lower | equal
 
 
-def dump(node, annotate_fields=True, include_attributes=False):
+def dump(node, annotate_fields=True, include_attributes=False,
+         comments=None):
     """
     Like :func:`ast.dump` but with a more readable return value, making the
     output actually useful for debugging purposes.
+
+    `comments` may map nodes to strings, which are written as comments in
+    the lines before the nodes, if they are on a line of their own.
     """
+    def _comment(node, indentation):
+        if not comments or node not in comments:
+            return ''
+        return ''.join(
+            '# {}\n{}'.format(line, indentation)
+            for line in comments[node].splitlines()
+        )
+
     def _format(node, level=0):
-        if isinstance(node, ast.AST):
+        if isinstance(node, (ast.AST, CompactNode)):
             fields = [
                 (name, _format(value, level))
                 for name, value in ast.iter_fields(node)
@@ -831,22 +1028,24 @@ def dump(node, annotate_fields=True, include_attributes=False):
                     (value for _, value in fields)
                 )
             )
-        elif isinstance(node, list):
+        elif isinstance(node, (list, _NodeList)):
             if node:
                 indentation = '    ' * (level + 1)
                 lines = ['[']
                 lines.extend(
-                    indentation + _format(n, level + 1) + ',' for n in node
+                    indentation + _comment(n, indentation) +
+                    _format(n, level + 1) + ','
+                    for n in node
                 )
                 lines.append(indentation + ']')
                 return '\n'.join(lines)
             return '[]'
         return repr(node).decode('ascii') if PY2 else repr(node)
-    if not isinstance(node, ast.AST):
+    if not isinstance(node, (ast.AST, CompactNode)):
         raise TypeError(
             'expected AST, got {!r}'.format(node.__class__.__name__)
         )
-    return _format(node)
+    return _comment(node, '') + _format(node)
 
 
 def is_possible_target(node):
@@ -854,6 +1053,8 @@ def is_possible_target(node):
     Returns `True`, if the `node` could be a target for example in an
     assignment statement ignoring the expression contexts.
     """
+    if isinstance(node, CompactNode):
+        node = from_compact(node)
     return (
         isinstance(node, (ast.Name, ast.Subscript, ast.Attribute)) or
         isinstance(node, (ast.Tuple, ast.List)) and
@@ -878,3 +1079,3908 @@ def set_target_contexts(node):
             set_target_contexts(element)
     elif not PY2 and isinstance(node, ast.Starred):
         set_target_contexts(node.value)
+
+
+_load = ast.Load()
+_store = ast.Store()
+_delete = ast.Del()
+
+_single_target_classes = (ast.Name, ast.Subscript, ast.Attribute)
+
+# Maps (node class, field) pairs to the context of the targets in that
+# field and the classes of the nodes allowed as a single target, or `None`,
+# if the field allows any target.
+_target_fields = dict(
+    ((getattr(ast, class_name), field), (context, target_classes))
+    for class_name, field, context, target_classes in [
+        ('Assign', 'targets', _store, None),
+        ('AugAssign', 'target', _store, _single_target_classes),
+        ('AnnAssign', 'target', _store, _single_target_classes),
+        ('NamedExpr', 'target', _store, (ast.Name, )),
+        ('For', 'target', _store, None),
+        ('AsyncFor', 'target', _store, None),
+        ('withitem', 'optional_vars', _store, None),
+        ('With', 'optional_vars', _store, None),
+        ('comprehension', 'target', _store, None),
+        ('Delete', 'targets', _delete, None)
+    ]
+    if hasattr(ast, class_name)
+)
+
+
+def _check_target(node, target_classes):
+    if target_classes is not None:
+        valid = isinstance(node, target_classes)
+    else:
+        valid = is_possible_target(node)
+    if not valid:
+        raise ValueError(
+            '{} at line {} is not a valid target'.format(
+                node.__class__.__name__, getattr(node, 'lineno', '?')
+            )
+        )
+
+
+def fix_contexts(tree):
+    """
+    Sets the `.ctx` attribute of every node in the `tree` to
+    :class:`ast.Load`, :class:`ast.Store` or :class:`ast.Del` as appropriate.
+
+    In contrast to :func:`set_target_contexts` this handles all targets in
+    the tree, for example of assignments, loops, with statements,
+    comprehensions and del statements, in a single pass. The context
+    instances are shared among all nodes. Raises :exc:`ValueError` if a
+    target is not valid.
+    """
+    stack = [(tree, _load)]
+    while stack:
+        node, context = stack.pop()
+        if 'ctx' in node._fields:
+            node.ctx = context
+        if context is not _load and isinstance(node, (ast.Tuple, ast.List)):
+            stack.extend((element, context) for element in node.elts)
+            continue
+        elif context is not _load and node.__class__.__name__ == 'Starred':
+            stack.append((node.value, context))
+            continue
+        node_class = node.__class__
+        for name, value in ast.iter_fields(node):
+            try:
+                target_context, target_classes = _target_fields[
+                    node_class, name
+                ]
+            except KeyError:
+                target_context = None
+            if isinstance(value, ast.AST):
+                if target_context is not None:
+                    _check_target(value, target_classes)
+                    stack.append((value, target_context))
+                else:
+                    stack.append((value, _load))
+            elif isinstance(value, list):
+                for item in value:
+                    if isinstance(item, ast.AST):
+                        if target_context is not None:
+                            _check_target(item, target_classes)
+                            stack.append((item, target_context))
+                        else:
+                            stack.append((item, _load))
+    return tree
+
+
+_line_attributes = ('lineno', 'end_lineno')
+_column_attributes = ('col_offset', 'end_col_offset')
+
+
+def clone(tree, strip_locations=False, line_offset=0, column_offset=0):
+    """
+    Returns a deep copy of the `tree`.
+
+    This is considerably faster than :func:`copy.deepcopy`. Nodes without
+    fields or attributes, like :class:`ast.Load`, are not copied but shared.
+
+    If `strip_locations` is `True`, the copy has no location attributes.
+    Otherwise `line_offset` and `column_offset` are added to the line numbers
+    and column offsets of all nodes in the copy, which avoids a separate
+    :func:`ast.increment_lineno` pass when splicing the copy into another
+    tree.
+    """
+    if not isinstance(tree, ast.AST):
+        raise TypeError(
+            'expected AST, got {!r}'.format(tree.__class__.__name__)
+        )
+    result = [None]
+    stack = [(tree, result, 0)]
+    while stack:
+        node, container, key = stack.pop()
+        node_class = node.__class__
+        if not node_class._fields and not node_class._attributes:
+            container[key] = node
+            continue
+        copy = container[key] = node_class.__new__(node_class)
+        state = copy.__dict__
+        state.update(node.__dict__)
+        if strip_locations:
+            for name in node_class._attributes:
+                state.pop(name, None)
+        else:
+            if line_offset:
+                for name in _line_attributes:
+                    if state.get(name) is not None:
+                        state[name] += line_offset
+            if column_offset:
+                for name in _column_attributes:
+                    if state.get(name) is not None:
+                        state[name] += column_offset
+        for name, value in state.items():
+            if isinstance(value, ast.AST):
+                stack.append((value, state, name))
+            elif isinstance(value, list):
+                value = state[name] = list(value)
+                for index, item in enumerate(value):
+                    if isinstance(item, ast.AST):
+                        stack.append((item, value, index))
+    return result[0]
+
+
+class Scope(object):
+    """
+    The names of a module, function, class or comprehension as determined by
+    :func:`analyze_scopes`.
+    """
+
+    def __init__(self, node, kind, parent=None):
+        #: The node defining the scope.
+        self.node = node
+        #: One of ``'module'``, ``'function'``, ``'class'`` or
+        #: ``'comprehension'``.
+        self.kind = kind
+        #: The enclosing :class:`Scope` or `None` for the module.
+        self.parent = parent
+        #: The scopes directly nested in this scope.
+        self.children = []
+        #: The names bound in this scope.
+        self.locals = set()
+        #: The names declared ``global`` in this scope.
+        self.globals = set()
+        #: The names declared ``nonlocal`` in this scope.
+        self.nonlocals = set()
+        #: The names of enclosing functions referenced by this scope.
+        self.free = set()
+        #: The locals of this scope referenced by nested scopes.
+        self.cells = set()
+        #: The names referenced in this scope.
+        self.uses = set()
+        #: A dictionary mapping the names bound in this scope, including
+        #: those declared global or nonlocal, to the number of times they
+        #: are bound.
+        self.bindings = {}
+        if parent is not None:
+            parent.children.append(self)
+
+    def _bind(self, name):
+        self.locals.add(name)
+        self.bindings[name] = self.bindings.get(name, 0) + 1
+
+    def __repr__(self):
+        return '<{} {} {}>'.format(
+            self.__class__.__name__,
+            self.kind,
+            getattr(self.node, 'name', self.node.__class__.__name__)
+        )
+
+
+_comprehension_classes = frozenset(
+    ['SetComp', 'DictComp', 'GeneratorExp'] +
+    # List comprehensions have no scope of their own on Python 2.
+    (['ListComp'] if sys.version_info >= (3, ) else [])
+)
+_argument_fields = ('posonlyargs', 'args', 'vararg', 'kwonlyargs', 'kwarg')
+
+
+def analyze_scopes(tree):
+    """
+    Returns a dictionary mapping the module, function, class and
+    comprehension nodes in `tree` to the :class:`Scope` they define.
+
+    The tree is walked once. The result refers to the nodes, so keep it
+    while the tree is not modified instead of calling this again.
+
+    Names are given as they appear in the source, private names are not
+    mangled. Like the compiler, this raises a :exc:`SyntaxError`, if a name
+    is declared ``nonlocal`` without a binding in an enclosing function.
+    """
+    scopes = OrderedDict()
+    stack = [(tree, None)]
+    while stack:
+        node, scope = stack.pop()
+        name = node.__class__.__name__
+        children = None
+        if scope is None:
+            scope = scopes[node] = Scope(node, 'module')
+        elif name in _function_classes:
+            inner = scopes[node] = Scope(node, 'function', scope)
+            if name != 'Lambda':
+                scope._bind(node.name)
+            arguments = node.args
+            children = list(getattr(node, 'decorator_list', []))
+            children.append(getattr(node, 'returns', None))
+            children.extend(arguments.defaults)
+            children.extend(getattr(arguments, 'kw_defaults', []))
+            for field in _argument_fields:
+                values = getattr(arguments, field, None)
+                if not isinstance(values, list):
+                    values = [values]
+                for argument in values:
+                    if argument is None:
+                        continue
+                    if not isinstance(argument, ast.AST):
+                        # The names of varargs on Python 2.
+                        inner._bind(argument)
+                    elif argument.__class__.__name__ == 'arg':
+                        inner._bind(argument.arg)
+                        children.append(argument.annotation)
+                    else:
+                        # The names and tuples of arguments on Python 2.
+                        stack.append((argument, inner))
+            body = node.body if isinstance(node.body, list) else [node.body]
+            stack.extend((statement, inner) for statement in reversed(body))
+        elif name == 'ClassDef':
+            inner = scopes[node] = Scope(node, 'class', scope)
+            scope._bind(node.name)
+            children = node.decorator_list + node.bases
+            children.extend(getattr(node, 'keywords', []))
+            for attribute in ('starargs', 'kwargs'):
+                children.append(getattr(node, attribute, None))
+            stack.extend(
+                (statement, inner) for statement in reversed(node.body)
+            )
+        elif name in _comprehension_classes:
+            inner = scopes[node] = Scope(node, 'comprehension', scope)
+            # The first iterable is evaluated in the enclosing scope.
+            children = [node.generators[0].iter]
+            for index, generator in enumerate(node.generators):
+                stack.append((generator.target, inner))
+                stack.extend((condition, inner) for condition in generator.ifs)
+                if index:
+                    stack.append((generator.iter, inner))
+            for field in ('elt', 'key', 'value'):
+                if hasattr(node, field):
+                    stack.append((getattr(node, field), inner))
+        elif name == 'Name':
+            if node.ctx.__class__.__name__ == 'Load':
+                scope.uses.add(node.id)
+            else:
+                scope._bind(node.id)
+        elif name == 'NamedExpr':
+            # Assignment expressions in comprehensions bind in the enclosing
+            # function or module.
+            target = scope
+            while target.kind == 'comprehension':
+                target.uses.add(node.target.id)
+                target = target.parent
+            target._bind(node.target.id)
+            children = [node.value]
+        elif name == 'Global':
+            scope.globals.update(node.names)
+        elif name == 'Nonlocal':
+            scope.nonlocals.update(node.names)
+        elif name == 'alias':
+            if node.asname is not None:
+                scope._bind(node.asname)
+            elif node.name != '*':
+                scope._bind(node.name.split('.')[0])
+        elif name in ('ExceptHandler', 'MatchAs', 'MatchStar'):
+            if isinstance(getattr(node, 'name', None), ast.AST):
+                # The targets of except clauses on Python 2.
+                children = [node.name, node.type, node.body]
+            elif getattr(node, 'name', None) is not None:
+                scope._bind(node.name)
+        elif name == 'MatchMapping':
+            if node.rest is not None:
+                scope._bind(node.rest)
+        if children is None:
+            stack.extend(
+                (child, scope)
+                for child in reversed(list(_iter_child_nodes(node)))
+            )
+        else:
+            for child in reversed(children):
+                if isinstance(child, list):
+                    stack.extend((item, scope) for item in reversed(child))
+                elif child is not None:
+                    stack.append((child, scope))
+    for scope in scopes.values():
+        if scope.kind != 'module':
+            scope.locals -= scope.globals | scope.nonlocals
+        if scope.kind == 'function' and 'super' in scope.uses:
+            scope.uses.add('__class__')
+    for scope in scopes.values():
+        if scope.kind != 'module':
+            unresolved = (scope.uses - scope.locals - scope.globals)
+            for name in unresolved | scope.nonlocals:
+                _resolve_free(scope, name)
+    return scopes
+
+
+def _resolve_free(scope, name):
+    # Marks `name` as free in `scope` and in the scopes between it and the
+    # enclosing function binding the name, where it becomes a cell.
+    passed = [scope]
+    ancestor = scope.parent
+    while ancestor.kind != 'module':
+        if ancestor.kind == 'class':
+            if name == '__class__':
+                ancestor.cells.add(name)
+                break
+        elif name in ancestor.globals:
+            return
+        elif name in ancestor.locals:
+            ancestor.cells.add(name)
+            break
+        elif name in ancestor.nonlocals:
+            break
+        passed.append(ancestor)
+        ancestor = ancestor.parent
+    else:
+        if name in scope.nonlocals:
+            raise SyntaxError(
+                'no binding for nonlocal {!r} found'.format(str(name))
+            )
+        return
+    for passed_scope in passed:
+        passed_scope.free.add(name)
+
+
+_scope_classes = frozenset([
+    'FunctionDef', 'AsyncFunctionDef', 'Lambda', 'ClassDef'
+])
+
+
+def _rewrite(tree, function):
+    """
+    Calls `function` with every node of the `tree`, the node defining the
+    scope the node is evaluated in and the list containing the node or
+    `None`, and replaces the node with the result.
+
+    Nodes are passed after their children in the order of the source code.
+    A list returned for a node in a list is spliced into that list.
+    """
+    result = [tree]
+    outer_scopes = {}
+    # The ids of the lists into which lists have been returned.
+    spliced = set()
+    stack = [(tree, tree, result, 0, None, False)]
+    while stack:
+        node, scope, container, key, siblings, visited = stack.pop()
+        if visited:
+            if spliced:
+                state = node.__dict__
+                for name, value in state.items():
+                    if id(value) in spliced:
+                        spliced.remove(id(value))
+                        state[name] = list(_flatten(value))
+            replacement = container[key] = function(node, scope, siblings)
+            if isinstance(replacement, list) and siblings is not None:
+                spliced.add(id(siblings))
+            continue
+        stack.append((node, scope, container, key, siblings, True))
+        name = node.__class__.__name__
+        if node is tree:
+            inner = outer = node
+        elif name in _scope_classes or name in _comprehension_classes:
+            inner = node
+            outer = outer_scopes[node] = scope
+        else:
+            inner = outer = scope
+        children = []
+        for field in node._fields:
+            value = getattr(node, field, None)
+            if name in _comprehension_classes or field == 'body':
+                field_scope = inner
+            elif (
+                name == 'comprehension' and field == 'iter' and
+                siblings is getattr(scope, 'generators', None) and
+                siblings[0] is node
+            ):
+                # The first iterable is evaluated in the enclosing scope.
+                field_scope = outer_scopes[scope]
+            else:
+                field_scope = outer
+            if isinstance(value, ast.AST):
+                children.append(
+                    (value, field_scope, node.__dict__, field, None, False)
+                )
+            elif isinstance(value, list):
+                children.extend(
+                    (item, field_scope, value, index, value, False)
+                    for index, item in enumerate(value)
+                    if isinstance(item, ast.AST)
+                )
+        children.reverse()
+        stack.extend(children)
+    return result[0]
+
+
+def _flatten(items):
+    for item in items:
+        if isinstance(item, list):
+            for nested in item:
+                yield nested
+        else:
+            yield item
+
+
+_missing = object()
+_integer_types = (int, ) if not PY2 else (int, long)  # noqa
+_number_types = _integer_types + (float, complex)
+_max_int_bits = 128
+_max_sequence_length = 4096
+_max_tuple_length = 256
+_max_propagated_length = 40
+_unary_operators = {
+    'UAdd': operator.pos,
+    'USub': operator.neg,
+    'Invert': operator.invert,
+    'Not': operator.not_
+}
+_binary_operators = {
+    'Add': operator.add,
+    'Sub': operator.sub,
+    'Mult': operator.mul,
+    'FloorDiv': operator.floordiv,
+    'Mod': operator.mod,
+    'Pow': operator.pow,
+    'LShift': operator.lshift,
+    'RShift': operator.rshift,
+    'BitOr': operator.or_,
+    'BitXor': operator.xor,
+    'BitAnd': operator.and_
+}
+if not PY2:
+    # Division on Python 2 depends on the future statements of the module.
+    _binary_operators['Div'] = operator.truediv
+_comparison_operators = {
+    'Eq': operator.eq,
+    'NotEq': operator.ne,
+    'Lt': operator.lt,
+    'LtE': operator.le,
+    'Gt': operator.gt,
+    'GtE': operator.ge,
+    'In': lambda a, b: a in b,
+    'NotIn': lambda a, b: a not in b
+}
+
+
+def _constant_value(node):
+    """
+    Returns the value of the literal `node` or `_missing`, negative numbers
+    and tuples of literals are considered literals as well.
+    """
+    name = node.__class__.__name__
+    if name in ('Constant', 'NameConstant'):
+        return node.value
+    elif name == 'Num':
+        return node.n
+    elif name in ('Str', 'Bytes'):
+        return node.s
+    elif name == 'Ellipsis':
+        return Ellipsis
+    elif name == 'UnaryOp' and node.op.__class__.__name__ == 'USub':
+        value = _constant_value(node.operand)
+        if isinstance(value, _number_types) and not isinstance(value, bool):
+            return -value
+    elif name == 'Tuple' and node.ctx.__class__.__name__ == 'Load':
+        values = tuple(_constant_value(element) for element in node.elts)
+        if _missing not in values:
+            return values
+    return _missing
+
+
+def _make_constant(value, node=None):
+    """
+    Returns a node for the literal `value`, with the location of `node`.
+    Negative numbers become a negation of a positive number, so that they are
+    parenthesized correctly by :func:`to_source`.
+    """
+    if (
+        isinstance(value, (_integer_types, float)) and
+        not isinstance(value, bool) and math.copysign(1, value) < 0
+    ):
+        result = ast.UnaryOp(
+            op=ast.USub(), operand=_make_constant(-value, node)
+        )
+    elif sys.version_info >= (3, 8):
+        result = ast.Constant(value=value, kind=None)
+    elif isinstance(value, tuple):
+        result = ast.Tuple(
+            elts=[_make_constant(item, node) for item in value], ctx=_load
+        )
+    elif isinstance(value, _number_types):
+        result = ast.Num(n=value)
+    elif isinstance(value, bytes):
+        result = ast.Bytes(s=value)
+    elif isinstance(value, type('')):
+        result = ast.Str(s=value)
+    elif value is Ellipsis:
+        result = ast.Ellipsis()
+    elif PY2:
+        result = ast.Name(id=repr(value), ctx=_load)
+    else:
+        result = ast.NameConstant(value=value)
+    if node is not None:
+        ast.copy_location(result, node)
+    return result
+
+
+def _is_small_literal(value):
+    # Whether a value can be used as a literal without bloating the source.
+    if isinstance(value, _integer_types):
+        return value.bit_length() <= _max_int_bits
+    elif isinstance(value, float):
+        return not (math.isinf(value) or math.isnan(value))
+    elif isinstance(value, complex):
+        return _is_small_literal(value.real) and _is_small_literal(value.imag)
+    elif isinstance(value, (bytes, type(''))):
+        return len(value) <= _max_sequence_length
+    elif isinstance(value, tuple):
+        return (
+            len(value) <= _max_tuple_length and
+            all(_is_small_literal(item) for item in value)
+        )
+    return value is None or value is Ellipsis
+
+
+def _is_safe_operation(operator_name, left, right):
+    # Whether evaluating a binary operation takes neither too long nor too
+    # much memory, before evaluating it.
+    if isinstance(left, bool) or isinstance(right, bool):
+        return operator_name not in ('Mult', 'Pow', 'LShift')
+    integers = (
+        isinstance(left, _integer_types) and
+        isinstance(right, _integer_types)
+    )
+    if operator_name == 'Pow' and integers:
+        return (
+            right < 0 or abs(left) <= 1 or
+            (left.bit_length() - 1) * right <= _max_int_bits
+        )
+    elif operator_name == 'LShift' and integers:
+        return right < 0 or left.bit_length() + right <= _max_int_bits
+    elif operator_name == 'Mult' and not integers:
+        for sequence, count in [(left, right), (right, left)]:
+            if (
+                isinstance(sequence, (bytes, type(''), tuple)) and
+                isinstance(count, _integer_types)
+            ):
+                return len(sequence) * count <= _max_sequence_length
+    elif operator_name == 'Mod':
+        # The result of formatting a string may depend on the locale.
+        return not isinstance(left, (bytes, type('')))
+    return True
+
+
+def _fold_expression(node):
+    """
+    Returns the value of the expression `node` whose operands have been
+    folded already or `_missing`.
+    """
+    name = node.__class__.__name__
+    try:
+        if name == 'UnaryOp':
+            operand = _constant_value(node.operand)
+            operator_name = node.op.__class__.__name__
+            if operand is not _missing:
+                return _unary_operators[operator_name](operand)
+        elif name == 'BinOp':
+            left = _constant_value(node.left)
+            right = _constant_value(node.right)
+            operator_name = node.op.__class__.__name__
+            if (
+                left is not _missing and right is not _missing and
+                operator_name in _binary_operators and
+                _is_safe_operation(operator_name, left, right)
+            ):
+                return _binary_operators[operator_name](left, right)
+        elif name == 'Compare':
+            left = _constant_value(node.left)
+            comparators = [
+                _constant_value(value) for value in node.comparators
+            ]
+            if left is _missing or _missing in comparators:
+                return _missing
+            for op, right in zip(node.ops, comparators):
+                compare = _comparison_operators.get(op.__class__.__name__)
+                if compare is None:
+                    return _missing
+                if not compare(left, right):
+                    return False
+                left = right
+            return True
+        elif name == 'Subscript' and node.ctx.__class__.__name__ == 'Load':
+            value = _constant_value(node.value)
+            index = node.slice
+            if index.__class__.__name__ == 'Index':
+                index = index.value
+            index = _constant_value(index)
+            if (
+                isinstance(value, (bytes, type(''), tuple)) and
+                isinstance(index, _integer_types)
+            ):
+                return value[index]
+        elif name == 'Tuple' and node.ctx.__class__.__name__ == 'Load':
+            return _constant_value(node)
+    except Exception:
+        # Expressions that raise are evaluated at runtime to raise there.
+        pass
+    return _missing
+
+
+def _fold_boolean_operation(node):
+    # Removes the constant operands of `and` or `or` which do not determine
+    # the result, unless they are the last one, and those following an
+    # operand that does.
+    stops_at = node.op.__class__.__name__ == 'Or'
+    values = []
+    for index, value in enumerate(node.values):
+        constant = _constant_value(value)
+        if constant is _missing:
+            values.append(value)
+            continue
+        try:
+            determines = bool(constant) is stops_at
+        except Exception:
+            return node
+        if determines or index == len(node.values) - 1:
+            values.append(value)
+            break
+    if len(values) == 1:
+        return values[0]
+    node.values = values
+    return node
+
+
+def fold_constants(tree):
+    """
+    Replaces expressions in the `tree` consisting only of literals, such as
+    arithmetic, concatenations, comparisons, tuples and subscripts, with the
+    literal they evaluate to and returns the tree, which is modified in
+    place.
+
+    Local variables of functions, which are assigned a literal exactly once
+    in a statement directly in the body of the function and are not
+    referenced by nested functions, are replaced with that literal after the
+    assignment. Expressions whose evaluation raises, takes a long time or
+    results in large literals, like ``'x' * 10 ** 9``, are kept.
+    """
+    if not isinstance(tree, ast.AST):
+        raise TypeError(
+            'expected AST, got {!r}'.format(tree.__class__.__name__)
+        )
+    scopes = analyze_scopes(tree)
+    constants = {}
+    folded = set()
+
+    def fold(node, scope, siblings):
+        name = node.__class__.__name__
+        if name == 'Name':
+            value = constants.get((scope, node.id), _missing)
+            if value is _missing or node.ctx.__class__.__name__ != 'Load':
+                return node
+            return _make_constant(value, node)
+        elif name == 'Assign':
+            if (
+                siblings is getattr(scope, 'body', None) and
+                scope.__class__.__name__ in _function_classes and
+                len(node.targets) == 1 and
+                node.targets[0].__class__.__name__ == 'Name'
+            ):
+                value = _constant_value(node.value)
+                identifier = node.targets[0].id
+                symbols = scopes[scope]
+                if (
+                    value is not _missing and
+                    len(repr(value)) <= _max_propagated_length and
+                    symbols.bindings.get(identifier) == 1 and
+                    identifier in symbols.locals and
+                    identifier not in symbols.cells
+                ):
+                    constants[scope, identifier] = value
+            return node
+        elif name == 'Expr':
+            if id(node.value) in folded:
+                # Evaluating a literal has no effect, we should not create
+                # docstrings either.
+                return ast.copy_location(ast.Pass(), node)
+            return node
+        elif name == 'BoolOp':
+            return _fold_boolean_operation(node)
+        elif name == 'IfExp':
+            test = _constant_value(node.test)
+            if test is not _missing:
+                return node.body if test else node.orelse
+            return node
+        value = _fold_expression(node)
+        if value is _missing or not _is_small_literal(value):
+            return node
+        if name == 'UnaryOp' and _constant_value(node) == value:
+            # Negative numbers are already literals.
+            return node
+        result = _make_constant(value, node)
+        folded.add(id(result))
+        return result
+
+    return _rewrite(tree, fold)
+
+
+_terminator_classes = frozenset(['Return', 'Raise', 'Break', 'Continue'])
+_statement_list_fields = ('body', 'orelse', 'finalbody')
+# Names of builtins that observe the local variables of a function.
+_frame_inspectors = frozenset(['locals', 'vars', 'dir', 'eval', 'exec'])
+
+
+def _bound_names(statements):
+    """
+    Returns a dictionary mapping the names bound by the `statements` in
+    their scope to the number of times they are bound and whether the
+    statements contain ``yield``, ``await``, ``global`` or ``nonlocal``,
+    which affect the scope itself.
+    """
+    counts = {}
+    affects_scope = False
+    stack = list(statements)
+    while stack:
+        node = stack.pop()
+        name = node.__class__.__name__
+        bound = None
+        if name in ('Yield', 'YieldFrom', 'Await', 'Global', 'Nonlocal'):
+            affects_scope = True
+        elif name == 'Name':
+            if node.ctx.__class__.__name__ != 'Load':
+                bound = node.id
+        elif name == 'alias':
+            if node.asname is not None:
+                bound = node.asname
+            elif node.name != '*':
+                bound = node.name.split('.')[0]
+        elif name in (
+            'FunctionDef', 'AsyncFunctionDef', 'ClassDef', 'ExceptHandler',
+            'MatchAs', 'MatchStar'
+        ):
+            bound = getattr(node, 'name', None)
+        elif name == 'MatchMapping':
+            bound = node.rest
+        if isinstance(bound, type('')):
+            counts[bound] = counts.get(bound, 0) + 1
+        for field in node._fields:
+            if field == 'body' and name in _scope_classes:
+                continue
+            value = getattr(node, field, None)
+            if isinstance(value, ast.AST):
+                stack.append(value)
+            elif isinstance(value, list):
+                stack.extend(
+                    item for item in value if isinstance(item, ast.AST)
+                )
+    return counts, affects_scope
+
+
+def _is_pure(node):
+    # Whether evaluating the expression has no effects and cannot fail.
+    name = node.__class__.__name__
+    if name == 'Lambda' or _constant_value(node) is not _missing:
+        return True
+    elif name in ('Tuple', 'List', 'Set'):
+        return all(_is_pure(element) for element in node.elts)
+    elif name == 'Dict':
+        return all(
+            key is not None and _constant_value(key) is not _missing
+            for key in node.keys
+        ) and all(_is_pure(value) for value in node.values)
+    return False
+
+
+def eliminate_dead_code(tree):
+    """
+    Removes code from the `tree` which is never executed or has no effect and
+    returns the tree, which is modified in place.
+
+    This removes statements following ``return``, ``raise``, ``break`` and
+    ``continue``, the branches of ``if`` and ``while`` statements whose test
+    is a constant, such as ``if False:`` or ``if 0:``, and assignments of
+    side effect free expressions, like literals, to local variables of
+    functions that are never used. Bodies left empty become ``pass``, which
+    is removed from bodies with other statements.
+
+    Code whose removal would change the scope, because it contains ``yield``
+    or binds a name that would otherwise no longer be local, is kept. Use
+    :func:`fold_constants` first to remove branches whose test consists only
+    of literals.
+    """
+    if not isinstance(tree, ast.AST):
+        raise TypeError(
+            'expected AST, got {!r}'.format(tree.__class__.__name__)
+        )
+    scopes = analyze_scopes(tree)
+    # The number of remaining bindings of each name in each scope.
+    remaining = dict(
+        (node, dict(scope.bindings)) for node, scope in scopes.items()
+    )
+
+    def remove(statements, scope):
+        # Returns whether the statements can be removed from the scope and
+        # updates the remaining bindings, if that is the case.
+        counts, affects_scope = _bound_names(statements)
+        if affects_scope:
+            return False
+        symbols = scopes[scope]
+        bindings = remaining[scope]
+        if symbols.kind == 'function':
+            for name, count in counts.items():
+                if (
+                    name in symbols.locals and
+                    (name in symbols.uses or name in symbols.cells) and
+                    count >= bindings.get(name, 0)
+                ):
+                    return False
+        for name, count in counts.items():
+            bindings[name] = bindings.get(name, 0) - count
+        return True
+
+    def is_unused(target, scope):
+        symbols = scopes[scope]
+        return (
+            target.__class__.__name__ == 'Name' and
+            symbols.kind == 'function' and
+            symbols.bindings.get(target.id) == 1 and
+            target.id in symbols.locals and
+            target.id not in symbols.uses and
+            target.id not in symbols.cells and
+            not _frame_inspectors & symbols.uses
+        )
+
+    def eliminate(node, scope, siblings):
+        name = node.__class__.__name__
+        body_scope = node if name in _scope_classes else scope
+        for field in _statement_list_fields:
+            statements = getattr(node, field, None)
+            if not isinstance(statements, list):
+                continue
+            for index, statement in enumerate(statements):
+                if statement.__class__.__name__ in _terminator_classes:
+                    unreachable = statements[index + 1:]
+                    if unreachable and remove(unreachable, body_scope):
+                        del statements[index + 1:]
+                    break
+            if len(statements) > 1:
+                statements[:] = [
+                    statement for statement in statements
+                    if statement.__class__.__name__ != 'Pass'
+                ] or statements[:1]
+        if name in ('If', 'While'):
+            test = _constant_value(node.test)
+            if test is _missing:
+                test = _fold_expression(node.test)
+            if test is not _missing:
+                try:
+                    test = bool(test)
+                except Exception:
+                    test = None
+                if name == 'If' and test is not None:
+                    taken, removed = (
+                        (node.body, node.orelse) if test else
+                        (node.orelse, node.body)
+                    )
+                    if remove(removed, scope):
+                        return taken
+                elif name == 'While' and test is False:
+                    if remove(node.body, scope):
+                        return node.orelse
+        elif name == 'Assign' and _is_pure(node.value):
+            targets = [
+                target for target in node.targets
+                if not is_unused(target, scope)
+            ]
+            if not targets:
+                return []
+            node.targets = targets
+        elif name in ('Try', 'TryFinally', 'TryStar'):
+            if not getattr(node, 'handlers', None) and not node.finalbody:
+                return node.body + node.orelse
+        if (
+            isinstance(getattr(node, 'body', None), list) and
+            not node.body and name not in ('Module', 'Interactive')
+        ):
+            node.body = [ast.copy_location(ast.Pass(), node)]
+        return node
+
+    return _rewrite(tree, eliminate)
+
+
+_loop_classes = frozenset(['For', 'AsyncFor', 'While'])
+
+
+def _unique_name(base, taken):
+    # Returns `base` or `base` with a numeric suffix, whichever is not
+    # `taken` yet, and adds it to `taken`.
+    name = base
+    suffix = 1
+    while name in taken:
+        suffix += 1
+        name = '{}_{}'.format(base, suffix)
+    taken.add(name)
+    return name
+
+
+def _attribute_chain(node):
+    # Returns the names in a chain of attributes like `a.b.c` or `None`.
+    chain = []
+    while node.__class__.__name__ == 'Attribute':
+        chain.append(node.attr)
+        node = node.value
+    if node.__class__.__name__ != 'Name':
+        return None
+    chain.append(node.id)
+    chain.reverse()
+    return tuple(chain)
+
+
+def _outermost_loops(statements):
+    # Yields the loops among the `statements` and nested in them, which are
+    # not nested in another loop or scope, with the list containing them.
+    stack = [(statement, statements) for statement in statements]
+    while stack:
+        node, siblings = stack.pop()
+        name = node.__class__.__name__
+        if name in _loop_classes:
+            yield node, siblings
+            stack.extend((statement, node.orelse) for statement in node.orelse)
+            continue
+        for field in _statement_list_fields + ('handlers', 'cases'):
+            value = getattr(node, field, None)
+            if isinstance(value, list) and name not in _scope_classes:
+                stack.extend((item, value) for item in value)
+
+
+def _loop_lookups(loop):
+    """
+    Returns the names and chains of attributes loaded in the `loop`, as
+    tuples of the node, the names in the chain and the list or state
+    containing the node, excluding nested scopes and the parts evaluated
+    only once.
+    """
+    lookups = []
+    stack = [
+        (statement, loop.body, index)
+        for index, statement in enumerate(loop.body)
+    ]
+    if loop.__class__.__name__ == 'While':
+        stack.append((loop.test, loop.__dict__, 'test'))
+    stack.reverse()
+    while stack:
+        node, container, key = stack.pop()
+        name = node.__class__.__name__
+        if name == 'Name':
+            if node.ctx.__class__.__name__ == 'Load':
+                lookups.append((node, (node.id, ), container, key))
+            continue
+        elif name == 'Attribute' and node.ctx.__class__.__name__ == 'Load':
+            chain = _attribute_chain(node)
+            if chain is not None:
+                lookups.append((node, chain, container, key))
+                continue
+        if name in _comprehension_classes:
+            continue
+        children = []
+        for field in node._fields:
+            if name in _scope_classes and field == 'body':
+                continue
+            value = getattr(node, field, None)
+            if isinstance(value, ast.AST):
+                children.append((value, node.__dict__, field))
+            elif isinstance(value, list):
+                children.extend(
+                    (item, value, index) for index, item in enumerate(value)
+                    if isinstance(item, ast.AST)
+                )
+        children.reverse()
+        stack.extend(children)
+    return lookups
+
+
+def hoist_lookups(tree):
+    """
+    Binds the global and builtin names and the chains of attributes, such as
+    ``math.sqrt`` or ``result.append``, loaded in loops within functions to
+    local variables before the loop and returns the tree, which is modified
+    in place.
+
+    Loading a local variable is faster than looking up a global name or an
+    attribute in every iteration. Global names are only hoisted, if no
+    function declares them ``global`` and the module binds them at most
+    once. Chains of attributes of a global name, like ``os.path.join``,
+    are hoisted as well, if they are called, other attributes may change in
+    the loop. Chains starting with a local variable are only hoisted, if
+    they consist of a single attribute that is called, like a method, and
+    the variable is not bound in the loop or by nested functions. Chains
+    are never hoisted, if one of their attributes is assigned or deleted
+    anywhere in the module or if the module uses :func:`setattr` or
+    :func:`delattr`.
+
+    Called attributes of modules and other objects are otherwise assumed
+    not to change while the loop runs. As the lookups are performed before
+    the loop, they also raise before the loop, even if its body is never
+    executed.
+    """
+    if not isinstance(tree, ast.AST):
+        raise TypeError(
+            'expected AST, got {!r}'.format(tree.__class__.__name__)
+        )
+    scopes = analyze_scopes(tree)
+    module = scopes[tree]
+    declared_global = set()
+    taken = set()
+    for scope in scopes.values():
+        declared_global |= scope.globals
+        taken |= scope.locals | scope.uses
+    # Attributes which functions called in a loop may change.
+    stored_attributes = set(
+        node.attr for node in walk_preorder(tree)
+        if node.__class__.__name__ == 'Attribute' and
+        node.ctx.__class__.__name__ != 'Load'
+    )
+    sets_attributes = not taken.isdisjoint(['setattr', 'delattr'])
+
+    def is_stable_global(name, symbols):
+        return (
+            name in symbols.uses and
+            name not in symbols.locals and
+            name not in symbols.free and
+            name not in symbols.globals and
+            name not in declared_global and
+            module.bindings.get(name, 0) <= 1
+        )
+
+    def hoist(node, scope, siblings):
+        if node.__class__.__name__ not in ('FunctionDef', 'AsyncFunctionDef'):
+            return node
+        symbols = scopes[node]
+        aliases = {}
+        for loop, loop_siblings in list(_outermost_loops(node.body)):
+            bound = _bound_names([loop])[0]
+            lookups = _loop_lookups(loop)
+            hoisted = []
+
+            def alias_for(chain):
+                if chain not in aliases:
+                    aliases[chain] = _unique_name('_' + '_'.join(chain), taken)
+                if chain not in hoisted:
+                    hoisted.append(chain)
+                return aliases[chain]
+
+            for lookup, chain, container, key in lookups:
+                root = chain[0]
+                if len(chain) > 1:
+                    if (
+                        sets_attributes or
+                        stored_attributes.intersection(chain[1:]) or
+                        # Only Call has a func field.
+                        key != 'func'
+                    ):
+                        is_stable = False
+                    elif is_stable_global(root, symbols):
+                        is_stable = True
+                    else:
+                        is_stable = (
+                            len(chain) == 2 and
+                            root in symbols.locals and
+                            root not in symbols.cells and
+                            root not in bound
+                        )
+                    if is_stable:
+                        container[key] = ast.copy_location(
+                            ast.Name(id=alias_for(chain), ctx=ast.Load()),
+                            lookup
+                        )
+                        continue
+                    while lookup.__class__.__name__ == 'Attribute':
+                        lookup = lookup.value
+                if is_stable_global(root, symbols):
+                    lookup.id = alias_for((root, ))
+            if not hoisted:
+                continue
+            assignments = []
+            for chain in hoisted:
+                value = ast.Name(id=chain[0], ctx=ast.Load())
+                for attribute in chain[1:]:
+                    value = ast.Attribute(
+                        value=value, attr=attribute, ctx=ast.Load()
+                    )
+                assignments.append(ast.Assign(
+                    targets=[ast.Name(id=aliases[chain], ctx=ast.Store())],
+                    value=value
+                ))
+            index = next(
+                index for index, statement in enumerate(loop_siblings)
+                if statement is loop
+            )
+            for assignment in assignments:
+                for child in walk_preorder(assignment):
+                    ast.copy_location(child, loop)
+            loop_siblings[index:index] = assignments
+        return node
+
+    return _rewrite(tree, hoist)
+
+
+class _InlineCandidate(object):
+    # A module level function whose calls can be replaced with its body.
+
+    def __init__(self, node, symbols):
+        self.name = node.name
+        self.parameters = [
+            argument.arg for argument in
+            getattr(node.args, 'posonlyargs', []) + node.args.args
+        ]
+        self.keywords = frozenset(argument.arg for argument in node.args.args)
+        self.body = [
+            clone(statement) for statement in _without_docstring(node.body)
+        ]
+        self.locals = symbols.locals
+        self.globals = (symbols.uses - symbols.locals) | set([node.name])
+        if (
+            len(self.body) == 1 and
+            self.body[0].__class__.__name__ == 'Return' and
+            self.body[0].value is not None and
+            # Assignment expressions would bind the variable in the scope
+            # of the caller.
+            not any(
+                child.__class__.__name__ == 'NamedExpr'
+                for child in walk_preorder(self.body[0].value)
+            )
+        ):
+            #: The returned expression, if the body consists only of a
+            #: return statement without assignment expressions.
+            self.expression = self.body[0].value
+        else:
+            self.expression = None
+
+
+def _without_docstring(body):
+    if (
+        body and body[0].__class__.__name__ == 'Expr' and
+        isinstance(_constant_value(body[0].value), type(''))
+    ):
+        return body[1:]
+    return body
+
+
+def _inline_candidate(node, symbols, threshold):
+    # Returns an _InlineCandidate for the function definition `node`, if it
+    # is small and its body can be inlined, otherwise `None`.
+    arguments = node.args
+    if (
+        node.__class__.__name__ != 'FunctionDef' or
+        node.decorator_list or
+        arguments.vararg or arguments.kwarg or arguments.kwonlyargs or
+        arguments.defaults or
+        symbols.children or symbols.globals or symbols.nonlocals or
+        # Recursive functions would be inlined into themselves.
+        node.name in symbols.uses or
+        _frame_inspectors & symbols.uses
+    ):
+        return None
+    size = 0
+    body = _without_docstring(node.body)
+    for child in chain.from_iterable(map(walk_preorder, body)):
+        size += 1
+        if size > threshold:
+            return None
+        name = child.__class__.__name__
+        if name in ('Import', 'ImportFrom', 'Match'):
+            return None
+        elif name == 'Return' and child is not node.body[-1]:
+            # Returning early would require restructuring the body.
+            return None
+    if _bound_names(node.body)[1]:
+        return None
+    return _InlineCandidate(node, symbols)
+
+
+def _resolves_globally(name, symbols):
+    # Whether `name` refers to a global in the scope described by `symbols`.
+    scope = symbols
+    while scope.kind != 'module':
+        if scope is symbols or scope.kind != 'class':
+            if name in scope.globals:
+                return True
+            elif name in scope.locals or name in scope.free:
+                return False
+        scope = scope.parent
+    return True
+
+
+def _bind_arguments(call, candidate):
+    # Returns a list of the parameter names and argument nodes passed by
+    # `call` in the order they are evaluated, or `None`.
+    if getattr(call, 'starargs', None) or getattr(call, 'kwargs', None):
+        return None
+    if len(call.args) > len(candidate.parameters) or any(
+        argument.__class__.__name__ == 'Starred' for argument in call.args
+    ):
+        return None
+    bound = list(zip(candidate.parameters, call.args))
+    for keyword in call.keywords:
+        if keyword.arg not in candidate.keywords:
+            return None
+        bound.append((keyword.arg, keyword.value))
+    names = [name for name, _ in bound]
+    if sorted(names) != sorted(candidate.parameters):
+        return None
+    return bound
+
+
+def _relocate(node, location):
+    for child in walk_preorder(node):
+        if 'lineno' in child._attributes:
+            ast.copy_location(child, location)
+    return node
+
+
+def inline_functions(tree, threshold=50):
+    """
+    Replaces calls to small module level functions with the body of the
+    function and returns the tree, which is modified in place.
+
+    A function is inlined, if its body has at most `threshold` nodes, not
+    counting the docstring, and the module binds its name exactly once. It
+    must have only positional or keyword parameters without defaults and no
+    decorators. It must not call itself, return early, import, define nested
+    functions, classes, lambdas or comprehensions, or use ``yield``,
+    ``global`` or ``nonlocal``.
+
+    The calls of functions consisting of a single ``return`` statement are
+    replaced with the returned expression, if all arguments are names or
+    literals and the expression contains no assignment expressions. Other
+    calls are inlined, if they are the value of an expression statement, an
+    assignment or a return statement within a function. The arguments are
+    then assigned to renamed local variables before the body, whose
+    variables are renamed as well. Calls are not inlined where a local
+    variable shadows a global used by the function.
+    """
+    if not isinstance(tree, ast.AST):
+        raise TypeError(
+            'expected AST, got {!r}'.format(tree.__class__.__name__)
+        )
+    scopes = analyze_scopes(tree)
+    module = scopes[tree]
+    declared_global = set()
+    taken = set()
+    for scope in scopes.values():
+        declared_global |= scope.globals
+        taken |= scope.locals | scope.uses
+    candidates = {}
+    for statement in getattr(tree, 'body', []):
+        if (
+            statement.__class__.__name__ == 'FunctionDef' and
+            module.bindings.get(statement.name) == 1 and
+            statement.name not in declared_global
+        ):
+            candidate = _inline_candidate(
+                statement, scopes[statement], threshold
+            )
+            if candidate is not None:
+                candidates[statement.name] = candidate
+    renames = {}
+
+    def candidate_for(call, scope):
+        if (
+            call.__class__.__name__ != 'Call' or
+            call.func.__class__.__name__ != 'Name'
+        ):
+            return None, None
+        candidate = candidates.get(call.func.id)
+        if candidate is None or any(
+            not _resolves_globally(name, scopes[scope])
+            for name in candidate.globals
+        ):
+            return None, None
+        return candidate, _bind_arguments(call, candidate)
+
+    def rename(candidate, scope, name):
+        key = scope, candidate.name, name
+        if key not in renames:
+            renames[key] = _unique_name(
+                '_{}_{}'.format(candidate.name, name), taken
+            )
+        return renames[key]
+
+    def inline_expression(call, candidate, bound):
+        substitutions = dict(bound)
+        expression = clone(candidate.expression)
+        result = [expression]
+        stack = [(expression, result, 0)]
+        while stack:
+            node, container, key = stack.pop()
+            if node.__class__.__name__ == 'Name' and node.id in substitutions:
+                container[key] = clone(substitutions[node.id])
+                continue
+            for field in node._fields:
+                value = getattr(node, field, None)
+                if isinstance(value, ast.AST):
+                    stack.append((value, node.__dict__, field))
+                elif isinstance(value, list):
+                    stack.extend(
+                        (item, value, index)
+                        for index, item in enumerate(value)
+                        if isinstance(item, ast.AST)
+                    )
+        return _relocate(result[0], call)
+
+    def inline_statements(statement, call, candidate, bound, scope):
+        statements = [
+            ast.Assign(
+                targets=[ast.Name(
+                    id=rename(candidate, scope, name), ctx=ast.Store()
+                )],
+                value=argument
+            )
+            for name, argument in bound
+        ]
+        body = [clone(node) for node in candidate.body]
+        for node in chain.from_iterable(map(walk_preorder, body)):
+            name = node.__class__.__name__
+            if name == 'Name' and node.id in candidate.locals:
+                node.id = rename(candidate, scope, node.id)
+            elif name == 'ExceptHandler' and node.name in candidate.locals:
+                node.name = rename(candidate, scope, node.name)
+        value = None
+        if body and body[-1].__class__.__name__ == 'Return':
+            value = body.pop().value
+        statements.extend(body)
+        kind = statement.__class__.__name__
+        if kind == 'Return':
+            statements.append(ast.Return(value=value))
+        elif kind == 'Assign':
+            statements.append(ast.Assign(
+                targets=statement.targets,
+                value=_make_constant(None) if value is None else value
+            ))
+        elif value is not None and not _is_pure(value) and not (
+            value.__class__.__name__ == 'Name' and
+            value.id in renames.values()
+        ):
+            statements.append(ast.Expr(value=value))
+        for node in statements:
+            _relocate(node, statement)
+        return statements or [_relocate(ast.Pass(), statement)]
+
+    def inline(node, scope, siblings):
+        name = node.__class__.__name__
+        if name == 'Call' and scopes[scope].kind != 'class':
+            candidate, bound = candidate_for(node, scope)
+            if (
+                candidate is not None and bound is not None and
+                candidate.expression is not None and
+                all(
+                    argument.__class__.__name__ == 'Name' or
+                    _constant_value(argument) is not _missing
+                    for _, argument in bound
+                )
+            ):
+                return inline_expression(node, candidate, bound)
+        elif (
+            name in ('Expr', 'Assign', 'Return') and
+            siblings is not None and node.value is not None and
+            scope.__class__.__name__ in ('FunctionDef', 'AsyncFunctionDef')
+        ):
+            candidate, bound = candidate_for(node.value, scope)
+            if candidate is not None and bound is not None:
+                return inline_statements(
+                    node, node.value, candidate, bound, scope
+                )
+        return node
+
+    return _rewrite(tree, inline)
+
+
+_accumulator_methods = {'List': 'append', 'Set': 'add'}
+_guarding_classes = frozenset([
+    'Try', 'TryExcept', 'TryFinally', 'TryStar', 'With', 'AsyncWith'
+])
+# Nodes which cannot be moved into a comprehension.
+_suspending_classes = frozenset(['NamedExpr', 'Yield', 'YieldFrom', 'Await'])
+
+
+def _empty_container(node, symbols, is_builtin):
+    # Returns the name of the comprehension creating containers like the
+    # expression `node`, if it creates an empty list, set or dict, otherwise
+    # `None`.
+    name = node.__class__.__name__
+    if name == 'List' and not node.elts:
+        return 'List'
+    elif name == 'Dict' and not node.keys:
+        return 'Dict'
+    elif (
+        name == 'Call' and node.func.__class__.__name__ == 'Name' and
+        node.func.id == 'set' and is_builtin('set', symbols) and
+        not node.args and not node.keywords and
+        not getattr(node, 'starargs', None) and
+        not getattr(node, 'kwargs', None)
+    ):
+        return 'Set'
+    return None
+
+
+def _accumulation(loop, accumulator, kind):
+    # Returns the generators and the parts of the element added to the
+    # `accumulator` by the `loop`, if the loop consists only of nested loops
+    # and if statements around a single statement adding to it, otherwise
+    # `None`.
+    generators = []
+    node = loop
+    while True:
+        name = node.__class__.__name__
+        if name == 'For' and not node.orelse:
+            generators.append(ast.comprehension(
+                target=node.target, iter=node.iter, ifs=[]
+            ))
+            if 'is_async' in ast.comprehension._fields:
+                generators[-1].is_async = 0
+        elif name == 'If' and not node.orelse:
+            generators[-1].ifs.append(node.test)
+        else:
+            break
+        if len(node.body) != 1:
+            return None
+        node = node.body[0]
+    if kind == 'Dict':
+        if (
+            name != 'Assign' or len(node.targets) != 1 or
+            node.targets[0].__class__.__name__ != 'Subscript'
+        ):
+            return None
+        target = node.targets[0]
+        key = target.slice
+        if key.__class__.__name__ == 'Index':
+            key = key.value
+        if (
+            target.value.__class__.__name__ != 'Name' or
+            target.value.id != accumulator or
+            key.__class__.__name__ in ('Slice', 'ExtSlice')
+        ):
+            return None
+        return generators, [key, node.value]
+    if name != 'Expr' or node.value.__class__.__name__ != 'Call':
+        return None
+    call = node.value
+    method = call.func
+    if (
+        method.__class__.__name__ != 'Attribute' or
+        method.attr != _accumulator_methods[kind] or
+        method.value.__class__.__name__ != 'Name' or
+        method.value.id != accumulator or
+        len(call.args) != 1 or call.keywords or
+        call.args[0].__class__.__name__ == 'Starred' or
+        getattr(call, 'starargs', None) or getattr(call, 'kwargs', None)
+    ):
+        return None
+    return generators, [call.args[0]]
+
+
+def _target_names(target):
+    # Returns the names bound by the loop `target` or `None`, if it assigns
+    # to anything but names.
+    names = []
+    stack = [target]
+    while stack:
+        node = stack.pop()
+        name = node.__class__.__name__
+        if name == 'Name':
+            names.append(node.id)
+        elif name in ('Tuple', 'List'):
+            stack.extend(node.elts)
+        elif name == 'Starred':
+            stack.append(node.value)
+        else:
+            return None
+    return names
+
+
+def _exposed_uses(statements):
+    # Returns a dict mapping names to the nodes loading or deleting them,
+    # except those in the body of a for loop assigning the name, which cannot
+    # observe the value a previous loop left behind, unless the body binds
+    # the name as well.
+    uses = {}
+    stack = [(statement, frozenset()) for statement in statements]
+    while stack:
+        node, shadowed = stack.pop()
+        name = node.__class__.__name__
+        used = None
+        if name == 'Name' and node.ctx.__class__.__name__ != 'Store':
+            used = node
+        elif name == 'AugAssign' and node.target.__class__.__name__ == 'Name':
+            # The target is loaded as well.
+            used = node.target
+        if used is not None and used.id not in shadowed:
+            uses.setdefault(used.id, []).append(used)
+        if name in ('For', 'AsyncFor'):
+            rebound = _bound_names(node.body)[0]
+            body_shadowed = shadowed.union(
+                name for name in _target_names(node.target) or []
+                if name not in rebound
+            )
+            stack.extend((statement, body_shadowed) for statement in node.body)
+            children = [node.target, node.iter] + node.orelse
+        else:
+            children = _iter_child_nodes(node)
+        stack.extend((child, shadowed) for child in children)
+    return uses
+
+
+def use_comprehensions(tree):
+    """
+    Replaces loops within functions, which only add to an empty list, set or
+    dict assigned right before them, with a comprehension and returns the
+    tree, which is modified in place::
+
+        result = []
+        for item in items:
+            if item:
+                result.append(item * 2)
+
+    becomes ``result = [item * 2 for item in items if item]``. Nested loops
+    become additional ``for`` clauses of the comprehension and ``if``
+    statements without an ``else`` become conditions.
+
+    Loops are only replaced, if the variables they assign are not used
+    outside of them, as they do not outlive a comprehension, and the loop is
+    not nested in a ``try`` or ``with`` statement, which could observe a
+    partially filled container. Comprehensions of dicts require either the
+    key or the value to be a name or a literal, as the order in which they
+    are evaluated differs.
+    """
+    if not isinstance(tree, ast.AST):
+        raise TypeError(
+            'expected AST, got {!r}'.format(tree.__class__.__name__)
+        )
+    scopes = analyze_scopes(tree)
+    module = scopes[tree]
+    declared_global = set()
+    for scope in scopes.values():
+        declared_global |= scope.globals
+
+    def is_builtin(name, symbols):
+        return (
+            _resolves_globally(name, symbols) and
+            name not in module.bindings and name not in declared_global
+        )
+
+    def statement_lists(function):
+        # Yields the lists of statements in the function, which are not
+        # nested in another scope or in a statement handling exceptions.
+        stack = [function.body]
+        while stack:
+            statements = stack.pop()
+            yield statements
+            for node in statements:
+                name = node.__class__.__name__
+                if name in _scope_classes or name in _guarding_classes:
+                    continue
+                for field in _statement_list_fields:
+                    if getattr(node, field, None):
+                        stack.append(getattr(node, field))
+                for case in getattr(node, 'cases', None) or []:
+                    stack.append(case.body)
+
+    def convert(node, scope, siblings):
+        if node.__class__.__name__ not in ('FunctionDef', 'AsyncFunctionDef'):
+            return node
+        symbols = scopes[node]
+        if symbols.uses & (_frame_inspectors | set(['super'])):
+            return node
+        exposed = _exposed_uses(node.body)
+        for statements in list(statement_lists(node)):
+            index = 0
+            while index < len(statements) - 1:
+                assignment, loop = statements[index:index + 2]
+                index += 1
+                if (
+                    assignment.__class__.__name__ != 'Assign' or
+                    len(assignment.targets) != 1 or
+                    assignment.targets[0].__class__.__name__ != 'Name' or
+                    loop.__class__.__name__ != 'For'
+                ):
+                    continue
+                accumulator = assignment.targets[0].id
+                kind = _empty_container(assignment.value, symbols, is_builtin)
+                if (
+                    kind is None or
+                    accumulator not in symbols.locals or
+                    accumulator in symbols.cells
+                ):
+                    continue
+                accumulation = _accumulation(loop, accumulator, kind)
+                if accumulation is None:
+                    continue
+                generators, element = accumulation
+                if kind == 'Dict' and not any(
+                    part.__class__.__name__ == 'Name' or
+                    _constant_value(part) is not _missing
+                    for part in element
+                ):
+                    continue
+                targets = [
+                    _target_names(generator.target) for generator in generators
+                ]
+                if None in targets:
+                    continue
+                nodes = list(walk_preorder(loop))
+                ids = set(map(id, nodes))
+                if (
+                    # The accumulator must only be used to add the element.
+                    sum(
+                        child.__class__.__name__ == 'Name' and
+                        child.id == accumulator
+                        for child in nodes
+                    ) != 1 or
+                    any(
+                        child.__class__.__name__ in _suspending_classes
+                        for child in nodes
+                    ) or
+                    not all(
+                        name in symbols.locals and
+                        name not in symbols.cells and
+                        all(id(use) in ids for use in exposed.get(name, []))
+                        for name in chain.from_iterable(targets)
+                    )
+                ):
+                    continue
+                if kind == 'Dict':
+                    comprehension = ast.DictComp(
+                        key=element[0], value=element[1],
+                        generators=generators
+                    )
+                else:
+                    comprehension = getattr(ast, kind + 'Comp')(
+                        elt=element[0], generators=generators
+                    )
+                assignment.value = ast.copy_location(
+                    comprehension, assignment.value
+                )
+                del statements[index]
+        return node
+
+    return _rewrite(tree, convert)
+
+
+# Tuples are not included, as they may contain unhashable items.
+_hashable_annotations = frozenset([
+    'bool', 'bytes', 'complex', 'float', 'frozenset', 'int', 'str'
+])
+# Builtins which neither have side effects nor depend on mutable state.
+_pure_builtins = frozenset([
+    'abs', 'all', 'any', 'ascii', 'bin', 'bool', 'bytes', 'callable', 'chr',
+    'complex', 'dict', 'divmod', 'enumerate', 'filter', 'float', 'format',
+    'frozenset', 'hash', 'hex', 'int', 'isinstance', 'issubclass', 'iter',
+    'len', 'list', 'map', 'max', 'min', 'next', 'oct', 'ord', 'pow', 'range',
+    'repr', 'reversed', 'round', 'set', 'slice', 'sorted', 'str', 'sum',
+    'tuple', 'zip', 'True', 'False', 'None', 'Exception', 'ArithmeticError',
+    'IndexError', 'KeyError', 'LookupError', 'OverflowError', 'TypeError',
+    'ValueError', 'ZeroDivisionError'
+])
+
+
+class MemoizationReport(object):
+    """
+    Records the functions memoized by :func:`memoize_functions` and the
+    reasons why other functions have not been memoized.
+    """
+
+    def __init__(self):
+        #: The names of the memoized functions in the order of the source.
+        self.memoized = []
+        #: Maps the names of the functions, which have not been memoized, to
+        #: a description of the reason.
+        self.rejected = OrderedDict()
+
+    def summary(self):
+        """
+        Returns a description of the memoized and rejected functions with one
+        line per function.
+        """
+        lines = ['memoized {}'.format(name) for name in self.memoized]
+        lines.extend(
+            'skipped {}: {}'.format(name, reason)
+            for name, reason in self.rejected.items()
+        )
+        return '\n'.join(lines)
+
+
+def _insert_module_preamble(module, statements):
+    # Inserts the `statements` into the body of the `module` after the
+    # docstring and the future imports, which have to come first.
+    body = module.body
+    index = len(body) - len(_without_docstring(body))
+    while (
+        index < len(body) and
+        body[index].__class__.__name__ == 'ImportFrom' and
+        body[index].module == '__future__'
+    ):
+        index += 1
+    for statement in statements:
+        if body:
+            _relocate(statement, body[min(index, len(body) - 1)])
+        else:
+            ast.fix_missing_locations(statement)
+    body[index:index] = statements
+
+
+def memoize_functions(tree, maxsize=128, marker=None, report=None):
+    """
+    Decorates pure module level functions with :func:`functools.lru_cache`,
+    caching up to `maxsize` results, and returns the `tree`, which has to be
+    a module and is modified in place. The import of
+    :func:`~functools.lru_cache` is inserted at the top of the module.
+    Arguments of different types are cached separately, even if they are
+    equal like ``1`` and ``1.0``.
+
+    A function is considered pure, if all its parameters and its return value
+    are annotated with hashable builtin types like :class:`int`,
+    :class:`str` or :class:`frozenset`, and it only uses its parameters, local
+    variables, builtins without side effects, module level constants and
+    other pure functions. It must not be decorated or define nested
+    functions, classes, lambdas or comprehensions.
+
+    If a `marker` is given, functions decorated with a decorator of that
+    name are memoized as well, without checking whether they are pure. The
+    marker is replaced with the cache.
+
+    If a :class:`MemoizationReport` is passed as `report`, the memoized
+    functions and the reasons why other module level functions have not
+    been memoized are recorded in it.
+    """
+    if tree.__class__.__name__ != 'Module':
+        raise TypeError(
+            'expected Module, got {!r}'.format(tree.__class__.__name__)
+        )
+    if report is None:
+        report = MemoizationReport()
+    scopes = analyze_scopes(tree)
+    module = scopes[tree]
+    declared_global = set()
+    taken = set()
+    for scope in scopes.values():
+        declared_global |= scope.globals
+        taken |= scope.locals | scope.uses
+
+    def is_builtin(name, symbols):
+        return (
+            _resolves_globally(name, symbols) and
+            name not in module.bindings and name not in declared_global
+        )
+
+    def is_hashable(annotation):
+        if annotation is None:
+            return False
+        if annotation.__class__.__name__ == 'Name':
+            name = annotation.id
+        else:
+            name = _constant_value(annotation)
+        return name in _hashable_annotations and is_builtin(name, module)
+
+    def is_marked(node):
+        return any(
+            decorator.__class__.__name__ == 'Name' and
+            decorator.id == marker
+            for decorator in node.decorator_list
+        )
+
+    constants = set()
+    functions = OrderedDict()
+    for statement in tree.body:
+        name = statement.__class__.__name__
+        if name == 'Assign':
+            if (
+                len(statement.targets) == 1 and
+                statement.targets[0].__class__.__name__ == 'Name' and
+                _constant_value(statement.value) is not _missing
+            ):
+                constants.add(statement.targets[0].id)
+        elif name in ('FunctionDef', 'AsyncFunctionDef'):
+            functions[statement.name] = statement
+    constants = set(
+        name for name in constants
+        if module.bindings[name] == 1 and name not in declared_global
+    )
+
+    def rejection(node):
+        # Returns the reason why the module level function `node` is not
+        # pure or the names of the module level functions it calls.
+        symbols = scopes[node]
+        arguments = node.args
+        parameters = (
+            getattr(arguments, 'posonlyargs', []) + arguments.args +
+            arguments.kwonlyargs
+        )
+        parameters.extend(
+            parameter for parameter in [arguments.vararg, arguments.kwarg]
+            if parameter is not None
+        )
+        if node.decorator_list:
+            return 'decorated'
+        elif (
+            module.bindings[node.name] != 1 or node.name in declared_global
+        ):
+            return 'bound more than once'
+        elif not is_hashable(node.returns) or not all(
+            is_hashable(parameter.annotation) for parameter in parameters
+        ):
+            return 'not annotated with hashable types'
+        elif symbols.children:
+            return 'defines nested scopes'
+        elif _bound_names(node.body)[1]:
+            return 'uses yield, await, global or nonlocal'
+        called = set()
+        for name in sorted(symbols.uses - symbols.locals):
+            if name in functions and name not in constants:
+                called.add(name)
+            elif name not in constants and not (
+                name in _pure_builtins and is_builtin(name, symbols)
+            ):
+                return 'uses {!r}'.format(str(name))
+        return called
+
+    pure = OrderedDict()
+    for name, node in functions.items():
+        if node.__class__.__name__ != 'FunctionDef':
+            report.rejected[name] = 'asynchronous'
+        elif marker is None or not is_marked(node):
+            reason = rejection(node)
+            if isinstance(reason, set):
+                pure[name] = reason
+            else:
+                report.rejected[name] = reason
+    changed = True
+    while changed:
+        changed = False
+        for name, called in list(pure.items()):
+            impure = sorted(
+                callee for callee in called
+                if callee not in pure and not is_marked(functions[callee])
+            )
+            if impure:
+                del pure[name]
+                report.rejected[name] = 'calls {!r}'.format(str(impure[0]))
+                changed = True
+    alias = _unique_name('_lru_cache', taken)
+
+    def cache(node):
+        return _relocate(template(
+            '$cache(maxsize=$maxsize, typed=True)', mode='eval'
+        ).instantiate(
+            cache=alias, maxsize=_make_constant(maxsize)
+        ).body, node)
+
+    for node in walk_preorder(tree):
+        name = node.__class__.__name__
+        if name not in ('FunctionDef', 'AsyncFunctionDef'):
+            continue
+        if marker is not None and is_marked(node):
+            if name == 'AsyncFunctionDef':
+                # Caching coroutines would return exhausted coroutines.
+                report.rejected[node.name] = 'asynchronous'
+                continue
+            node.decorator_list = [
+                cache(decorator) if (
+                    decorator.__class__.__name__ == 'Name' and
+                    decorator.id == marker
+                ) else decorator
+                for decorator in node.decorator_list
+            ]
+        elif node.name not in pure or functions[node.name] is not node:
+            continue
+        else:
+            node.decorator_list = [cache(node)]
+        report.memoized.append(node.name)
+    if report.memoized:
+        _insert_module_preamble(
+            tree,
+            template('from functools import lru_cache as $alias').instantiate(
+                alias=alias
+            ).body
+        )
+    return tree
+
+
+# Nodes which suspend the execution of the function containing them.
+_suspension_classes = frozenset(['Yield', 'YieldFrom', 'Await'])
+
+
+class ProbeTable(object):
+    """
+    A table of the call counts and times of the functions instrumented with
+    :func:`instrument_functions`, preallocated for `size` functions.
+
+    Use :func:`probe_table` to get the table instrumented code writes to.
+    """
+
+    def __init__(self, size=4096):
+        #: The module and qualified names of the functions in the order of
+        #: their slots.
+        self.names = []
+        #: The number of calls of each function.
+        self.counts = array('L', [0]) * size
+        #: The time spent in each function in seconds, including the time
+        #: spent in the functions called by it.
+        self.times = array('d', [0.0]) * size
+
+    def register(self, module, names):
+        """
+        Allocates slots for the functions with the qualified `names` in the
+        `module` and returns the index of the first slot.
+        """
+        offset = len(self.names)
+        if offset + len(names) > len(self.counts):
+            raise ValueError('probe table is full')
+        self.names.extend('{}.{}'.format(module, name) for name in names)
+        return offset
+
+    def reset(self):
+        """
+        Resets all counts and times to zero.
+        """
+        size = len(self.counts)
+        self.counts[:] = array('L', [0]) * size
+        self.times[:] = array('d', [0.0]) * size
+
+    def report(self, limit=None):
+        """
+        Returns a table of the functions that have been called as a string,
+        sorted by the time spent in them and the number of calls.
+        """
+        slots = sorted(
+            (slot for slot in range(len(self.names)) if self.counts[slot]),
+            key=lambda slot: (self.times[slot], self.counts[slot]),
+            reverse=True
+        )[:limit]
+        lines = ['{:<40} {:>10} {:>12} {:>12}'.format(
+            'function', 'calls', 'time', 'per call'
+        )]
+        for slot in slots:
+            lines.append('{:<40} {:>10} {:>12.6f} {:>12.6f}'.format(
+                self.names[slot],
+                self.counts[slot],
+                self.times[slot],
+                self.times[slot] / self.counts[slot]
+            ))
+        return '\n'.join(lines)
+
+
+_probe_tables = {}
+
+
+def probe_table(name='default', size=4096):
+    """
+    Returns the :class:`ProbeTable` called `name`, which is created with
+    `size` slots, if it does not exist yet.
+    """
+    try:
+        return _probe_tables[name]
+    except KeyError:
+        table = _probe_tables[name] = ProbeTable(size)
+        return table
+
+
+def instrument_functions(tree, pattern=None, marker=None, table='default'):
+    """
+    Instruments the functions, whose qualified name matches the glob
+    `pattern` or which are decorated with a decorator called `marker`, to
+    count their calls and measure the time spent in them, and returns the
+    `tree`, which has to be a module and is modified in place. The marker is
+    removed.
+
+    When the module is executed, the functions are registered in the
+    :class:`ProbeTable` returned by :func:`probe_table` for the name
+    `table`, which their probes write to, so the module imports
+    :mod:`zweig`. A probe only calls a timer at the beginning and end of a
+    call and increments two preallocated arrays, so that functions can be
+    instrumented in production. The increments are not synchronized, calls
+    in concurrent threads may occasionally be lost.
+
+    Generators and coroutines are not instrumented, as the time they are
+    suspended would be included.
+    """
+    if tree.__class__.__name__ != 'Module':
+        raise TypeError(
+            'expected Module, got {!r}'.format(tree.__class__.__name__)
+        )
+    if pattern is None and marker is None:
+        raise TypeError('expected a pattern or a marker')
+    taken = set()
+    for scope in analyze_scopes(tree).values():
+        taken |= scope.locals | scope.uses
+    aliases = dict(
+        (name, _unique_name('_probe_' + name, taken))
+        for name in ['timer', 'table', 'counts', 'times', 'offset', 'start']
+    )
+    qualified_names = {}
+    stack = [(statement, '') for statement in tree.body]
+    while stack:
+        node, prefix = stack.pop()
+        name = node.__class__.__name__
+        if name in ('FunctionDef', 'AsyncFunctionDef', 'ClassDef'):
+            qualified_names[node] = prefix + node.name
+            prefix = qualified_names[node] + (
+                '.' if name == 'ClassDef' else '.<locals>.'
+            )
+        stack.extend((child, prefix) for child in _iter_child_nodes(node))
+    suspending = set()
+    instrumented = []
+
+    def instrument(node, scope, siblings):
+        name = node.__class__.__name__
+        if name in _suspension_classes:
+            suspending.add(scope)
+        if name not in ('FunctionDef', 'AsyncFunctionDef'):
+            return node
+        selected = (
+            pattern is not None and
+            fnmatchcase(qualified_names[node], pattern)
+        )
+        if marker is not None:
+            decorators = [
+                decorator for decorator in node.decorator_list
+                if decorator.__class__.__name__ != 'Name' or
+                decorator.id != marker
+            ]
+            selected = selected or decorators != node.decorator_list
+            node.decorator_list = decorators
+        if not selected or name != 'FunctionDef' or node in suspending:
+            return node
+        body = _without_docstring(node.body)
+        probe = template(
+            '$start = $timer()\n'
+            'try:\n'
+            '    pass\n'
+            'finally:\n'
+            '    $counts[$offset + $index] += 1\n'
+            '    $times[$offset + $index] += $timer() - $start\n'
+        ).instantiate(
+            index=_make_constant(len(instrumented)),
+            start=aliases['start'],
+            timer=aliases['timer'],
+            counts=aliases['counts'],
+            times=aliases['times'],
+            offset=aliases['offset']
+        ).body
+        for statement in probe:
+            # The body may consist only of the docstring.
+            _relocate(statement, (body or node.body)[0])
+        if body:
+            probe[1].body = body
+        node.body = node.body[:len(node.body) - len(body)] + probe
+        instrumented.append(qualified_names[node])
+        return node
+
+    _rewrite(tree, instrument)
+    if instrumented:
+        _insert_module_preamble(tree, template(
+            'from timeit import default_timer as $timer\n'
+            'from zweig import probe_table as $table\n'
+            '$counts = $table($name).counts\n'
+            '$times = $table($name).times\n'
+            '$offset = $table($name).register(__name__, $names)\n'
+        ).instantiate(
+            name=_make_constant(table),
+            names=_make_constant(tuple(instrumented)),
+            timer=aliases['timer'],
+            table=aliases['table'],
+            counts=aliases['counts'],
+            times=aliases['times'],
+            offset=aliases['offset']
+        ).body)
+    return tree
+
+
+class NodeProfile(object):
+    """
+    The time spent executing a node according to a profile, as determined by
+    :func:`annotate_profile`.
+    """
+
+    def __init__(self, calls=None, self_time=0.0, cumulative_time=0.0):
+        #: The number of calls of a function or `None`, if unknown.
+        self.calls = calls
+        #: The time spent executing the node itself in seconds, excluding the
+        #: time spent in called functions and, unless the node is a function,
+        #: in nested statements.
+        self.self_time = self_time
+        #: The time spent executing the node in seconds, including the time
+        #: spent in nested statements and called functions.
+        self.cumulative_time = cumulative_time
+
+    def describe(self):
+        """
+        Returns a one line description of the profile.
+        """
+        description = 'cumulative {:.6f}s, self {:.6f}s'.format(
+            self.cumulative_time, self.self_time
+        )
+        if self.calls is not None:
+            description += ', {} calls'.format(self.calls)
+        return description
+
+    def __repr__(self):
+        return '<{} {}>'.format(self.__class__.__name__, self.describe())
+
+
+def _normalize_filename(filename):
+    if filename.startswith('<'):
+        # Pseudo filenames such as <string> are not paths.
+        return filename
+    return os.path.normcase(os.path.abspath(filename))
+
+
+def annotate_profile(tree, filename, stats=None, samples=None,
+                     interval=0.001):
+    """
+    Maps the profile of the code compiled from the `tree` with the given
+    `filename` onto its nodes and returns an ordered dictionary mapping the
+    statements, that have been profiled, to :class:`NodeProfile` instances
+    in the order of the source code.
+
+    The profile is either given as `stats`, which may be a
+    :class:`pstats.Stats` or :class:`cProfile.Profile` instance or the path
+    to a file written by :mod:`cProfile`, or as `samples` taken by a
+    sampling profiler. The former only contains functions, while the latter
+    describes every statement. Each sample is a sequence of ``(filename,
+    lineno)`` tuples, with one tuple for each frame of the sampled stack
+    from the outermost to the innermost frame. Every sample represents
+    `interval` seconds.
+
+    The profiles can be rendered with :func:`to_source` or :func:`dump`::
+
+        profiles = annotate_profile(tree, 'app.py', stats='app.prof')
+        print(to_source(tree, comments=dict(
+            (node, profile.describe()) for node, profile in profiles.items()
+        )))
+    """
+    if (stats is None) == (samples is None):
+        raise TypeError('expected either stats or samples')
+    filename = _normalize_filename(filename)
+    profiles = {}
+    # Maps line numbers to the statements, which include the line, from the
+    # outermost to the innermost statement.
+    line_statements = {}
+    first_lines = {}
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, ast.stmt):
+            first = min([node.lineno] + [
+                decorator.lineno
+                for decorator in getattr(node, 'decorator_list', [])
+            ])
+            end = getattr(node, 'end_lineno', None)
+            if end is None:
+                end = max(
+                    child.lineno for child in walk_preorder(node)
+                    if 'lineno' in child._attributes
+                )
+            for line in range(first, end + 1):
+                line_statements.setdefault(line, []).append(node)
+            if node.__class__.__name__ in ('FunctionDef', 'AsyncFunctionDef'):
+                # Code objects of decorated functions start at the first
+                # decorator.
+                first_lines[first] = node
+        stack.extend(reversed(list(_iter_child_nodes(node))))
+    if stats is not None:
+        if not hasattr(stats, 'stats'):
+            import pstats
+            stats = pstats.Stats(stats)
+        for (path, line, _), entry in stats.stats.items():
+            node = first_lines.get(line)
+            if node is not None and _normalize_filename(path) == filename:
+                calls, self_time, cumulative_time = entry[1:4]
+                profiles[node] = NodeProfile(
+                    calls, self_time, cumulative_time
+                )
+    else:
+        for sample in samples:
+            included = set()
+            statements = []
+            for path, line in sample:
+                if (
+                    line in line_statements and
+                    _normalize_filename(path) == filename
+                ):
+                    statements = line_statements[line]
+                    included.update(statements)
+                else:
+                    statements = []
+            for node in included:
+                profile = profiles.get(node)
+                if profile is None:
+                    profile = profiles[node] = NodeProfile()
+                profile.cumulative_time += interval
+            if statements:
+                # The innermost frame is executing the innermost statement
+                # in the innermost function.
+                profiles[statements[-1]].self_time += interval
+                function = next((
+                    node for node in reversed(statements)
+                    if node.__class__.__name__ in (
+                        'FunctionDef', 'AsyncFunctionDef'
+                    )
+                ), None)
+                if function is not None and function is not statements[-1]:
+                    profiles[function].self_time += interval
+    return OrderedDict(
+        (node, profiles[node]) for node in walk_preorder(tree)
+        if node in profiles
+    )
+
+
+class Pass(object):
+    """
+    A transformation, which a :class:`PassManager` can fuse with other passes
+    into a single traversal of a tree.
+
+    Like an :class:`ast.NodeTransformer` a pass handles nodes of a class
+    ``X`` with a ``visit_X`` method, which returns the node, a replacement,
+    a list of nodes to splice into the list containing the node or `None` to
+    remove the node. These methods declare the node classes a pass handles,
+    other nodes are not passed to it. Unlike with a transformer, the
+    children of a node have been visited, when the method is called, so
+    :meth:`generic_visit` does nothing.
+    """
+
+    #: The names of the passes, which have to handle a node before this one.
+    requires = ()
+
+    @property
+    def name(self):
+        """
+        The name by which other passes require this one, by default the name
+        of the class.
+        """
+        return self.__class__.__name__
+
+    @property
+    def node_types(self):
+        """
+        The names of the node classes handled by this pass.
+        """
+        return [
+            name[len('visit_'):] for name in dir(self)
+            if name.startswith('visit_')
+        ]
+
+    def generic_visit(self, node):
+        """
+        Returns the `node`, so that methods ported from an
+        :class:`ast.NodeTransformer` may still call this method.
+        """
+        return node
+
+
+def _pass_name(transform):
+    if isinstance(transform, Pass):
+        return transform.name
+    # Functions may be configured with functools.partial.
+    return getattr(transform, 'func', transform).__name__
+
+
+class PassManager(object):
+    """
+    Runs passes over trees in the order required by their dependencies.
+
+    The `passes` are :class:`Pass` instances or functions taking and
+    returning a tree, such as :func:`fold_constants`, optionally with a
+    ``requires`` attribute naming the passes which have to run before them.
+    Passes run in the order they have been added, unless a pass requires a
+    pass added later.
+
+    Consecutive :class:`Pass` instances are fused into a single traversal of
+    the tree, which passes each node after its children to the passes
+    handling its class. A pass therefore sees a node after the passes it
+    requires have handled the node and after all passes have handled the
+    children. Functions traverse the tree on their own.
+
+    If `timing` is true, the time spent in each pass is measured.
+    """
+
+    def __init__(self, passes=(), timing=False):
+        #: The passes in the order they have been added.
+        self.passes = []
+        self.timing = timing
+        #: Maps the names of the passes to the time spent in them in
+        #: seconds, if `timing` is enabled.
+        self.timings = OrderedDict()
+        for transform in passes:
+            self.add(transform)
+
+    def add(self, transform):
+        """
+        Adds the pass `transform`.
+        """
+        self.passes.append(transform)
+        self.timings.setdefault(_pass_name(transform), 0.0)
+
+    def ordered(self):
+        """
+        Returns the passes in the order they run in.
+
+        Raises :exc:`ValueError`, if a pass requires an unknown pass or if
+        the requirements are cyclic.
+        """
+        names = set(_pass_name(transform) for transform in self.passes)
+        for transform in self.passes:
+            for required in getattr(transform, 'requires', ()):
+                if required not in names:
+                    raise ValueError('{} requires unknown pass {}'.format(
+                        _pass_name(transform), required
+                    ))
+        remaining = list(self.passes)
+        ordered = []
+        while remaining:
+            for index, transform in enumerate(remaining):
+                pending = set(
+                    _pass_name(other) for other in remaining
+                    if other is not transform
+                )
+                if pending.isdisjoint(getattr(transform, 'requires', ())):
+                    ordered.append(remaining.pop(index))
+                    break
+            else:
+                raise ValueError('cyclic requirements between {}'.format(
+                    ', '.join(_pass_name(transform) for transform in remaining)
+                ))
+        return ordered
+
+    def run(self, tree):
+        """
+        Runs the passes over the `tree` and returns the resulting tree.
+        """
+        stages = []
+        for transform in self.ordered():
+            if not isinstance(transform, Pass):
+                stages.append(transform)
+            elif stages and isinstance(stages[-1], list):
+                stages[-1].append(transform)
+            else:
+                stages.append([transform])
+        for stage in stages:
+            if isinstance(stage, list):
+                tree = self._traverse(tree, stage)
+            elif self.timing:
+                start = default_timer()
+                tree = stage(tree)
+                self.timings[_pass_name(stage)] += default_timer() - start
+            else:
+                tree = stage(tree)
+        return tree
+
+    def _traverse(self, tree, passes):
+        # Maps node class names to the positions of the passes handling them
+        # and their methods, ordered by position.
+        handlers = {}
+        for position, transform in enumerate(passes):
+            for name in transform.node_types:
+                handlers.setdefault(name, []).append(
+                    (position, getattr(transform, 'visit_' + name))
+                )
+        times = [0.0] * len(passes)
+        timing = self.timing
+
+        def visit(node, scope, siblings):
+            position = 0
+            while True:
+                for handler_position, handler in handlers.get(
+                    node.__class__.__name__, ()
+                ):
+                    if handler_position < position:
+                        continue
+                    position = handler_position + 1
+                    if timing:
+                        start = default_timer()
+                        result = handler(node)
+                        times[handler_position] += default_timer() - start
+                    else:
+                        result = handler(node)
+                    if result is not node:
+                        break
+                else:
+                    return node
+                if result is None:
+                    return [] if siblings is not None else None
+                elif isinstance(result, list):
+                    return result
+                # The remaining passes handle the replacement, which may be
+                # of another class.
+                node = result
+
+        tree = _rewrite(tree, visit)
+        if timing:
+            for transform, time in zip(passes, times):
+                self.timings[_pass_name(transform)] += time
+        return tree
+
+
+_replace = getattr(os, 'replace', os.rename)
+
+
+class CodeCache(object):
+    """
+    Caches the code objects compiled by :func:`compile_cached` in memory
+    and, if a `directory` is given, on disk.
+
+    At most `maxsize` code objects are kept in memory, the least recently
+    used one is evicted first. On disk code objects are stored with
+    :mod:`marshal` like in ``.pyc`` files, one file per code object, so that
+    they are shared between processes. Files written by another version of
+    Python are ignored, as are errors reading or writing them.
+    """
+
+    def __init__(self, directory=None, maxsize=128):
+        self.directory = directory
+        self.maxsize = maxsize
+        #: The number of lookups of a cached code object.
+        self.hits = 0
+        #: The number of lookups of code objects that had to be compiled.
+        self.misses = 0
+        self._codes = OrderedDict()
+
+    def get(self, key):
+        """
+        Returns the code object cached under `key` or `None`.
+        """
+        try:
+            code = self._codes.pop(key)
+        except KeyError:
+            code = self._load(key)
+            if code is None:
+                self.misses += 1
+                return None
+        self.hits += 1
+        self._remember(key, code)
+        return code
+
+    def add(self, key, code):
+        """
+        Caches the `code` object under `key`.
+        """
+        self._codes.pop(key, None)
+        self._remember(key, code)
+        self._store(key, code)
+
+    def _remember(self, key, code):
+        self._codes[key] = code
+        while len(self._codes) > self.maxsize:
+            self._codes.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.code')
+
+    def _load(self, key):
+        if self.directory is None:
+            return None
+        import marshal
+        try:
+            with open(self._path(key), 'rb') as code_file:
+                if code_file.read(len(_magic_number)) != _magic_number:
+                    return None
+                code = marshal.load(code_file)
+        except (EnvironmentError, EOFError, ValueError, TypeError):
+            return None
+        return code if isinstance(code, CodeType) else None
+
+    def _store(self, key, code):
+        if self.directory is None:
+            return
+        import marshal
+        import tempfile
+        temporary = None
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            # Concurrent readers must never see a partially written file.
+            descriptor, temporary = tempfile.mkstemp(
+                suffix='.tmp', dir=self.directory
+            )
+            with os.fdopen(descriptor, 'wb') as code_file:
+                code_file.write(_magic_number)
+                marshal.dump(code, code_file)
+            _replace(temporary, self._path(key))
+        except EnvironmentError:
+            if temporary is not None and os.path.exists(temporary):
+                os.remove(temporary)
+
+
+_code_cache = CodeCache()
+
+
+# Maps node classes to their fields in reverse order.
+_reversed_fields = {}
+
+
+def _code_key(tree, filename, mode):
+    # Hashes the classes and fields of the nodes but not their locations,
+    # which do not matter as the code is compiled from the generated source.
+    # Each node class has a fixed number of fields and lists and strings are
+    # prefixed with their length, so that the encoding is unambiguous.
+    tokens = [
+        repr(_magic_number), str(sys.flags.optimize), __version__,
+        '{}:'.format(len(filename)), filename, mode
+    ]
+    stack = [tree]
+    while stack:
+        value = stack.pop()
+        value_class = value.__class__
+        if isinstance(value, ast.AST):
+            try:
+                fields = _reversed_fields[value_class]
+            except KeyError:
+                fields = _reversed_fields[value_class] = tuple(
+                    reversed(value._fields)
+                )
+            tokens.append(value_class.__name__)
+            stack.extend([getattr(value, field, None) for field in fields])
+        elif value_class is list:
+            tokens.append('[{}'.format(len(value)))
+            stack.extend(reversed(value))
+        elif isinstance(value, type('')):
+            tokens.append('s{}:'.format(len(value)))
+            tokens.append(value)
+        else:
+            tokens.append('{}:{!r}'.format(value_class.__name__, value))
+    return hashlib.sha1(
+        '\x00'.join(tokens).encode('utf-8', 'backslashreplace')
+    ).hexdigest()
+
+
+def compile_cached(tree, filename='<unknown>', mode='exec', cache=None):
+    """
+    Compiles the source generated from the `tree` by :func:`to_source` like
+    :func:`compile` and returns the code object.
+
+    The code object is cached under a hash of the structure of the tree, the
+    `filename` and the `mode`, so compiling an equal tree again returns the
+    cached code object without generating and compiling the source. The
+    locations of the nodes are not part of the hash, the code objects refer
+    to the lines of the generated source.
+
+    Code objects are cached in the given :class:`CodeCache` or in a cache
+    in memory shared by all calls without one.
+    """
+    if cache is None:
+        cache = _code_cache
+    key = _code_key(tree, filename, mode)
+    code = cache.get(key)
+    if code is None:
+        code = compile(to_source(tree), filename, mode, 0, True)
+        cache.add(key, code)
+    return code
+
+
+_placeholder_re = re.compile(r'\$([A-Za-z_][A-Za-z0-9_]*)')
+_placeholder_prefix = '__zweig_placeholder_'
+_templates = {}
+
+
+def template(source, mode='exec'):
+    """
+    Returns a :class:`Template` for the `source`, which may contain
+    placeholders such as ``$name`` wherever an identifier is allowed.
+
+    Templates are cached, so calling this repeatedly with the same `source`
+    parses it only once.
+    """
+    try:
+        return _templates[source, mode]
+    except KeyError:
+        result = _templates[source, mode] = Template(source, mode)
+        return result
+
+
+class Template(object):
+    """
+    A parsed piece of source code with placeholders, which can be
+    instantiated any number of times without parsing the source again.
+
+    Use :func:`template` to create templates, so that they are cached.
+    """
+
+    def __init__(self, source, mode='exec'):
+        #: The source code of the template including the placeholders.
+        self.source = source
+        #: The mode the source has been parsed in, as in :func:`ast.parse`.
+        self.mode = mode
+        self.tree = ast.parse(
+            _placeholder_re.sub(_placeholder_prefix + r'\1', source),
+            mode=mode
+        )
+        placeholders = set()
+        for node in walk_preorder(self.tree):
+            if node.__class__.__name__ in ('Constant', 'Str', 'Bytes'):
+                # The substitution above does not know about string
+                # literals, so we have to undo it for them.
+                for name, value in ast.iter_fields(node):
+                    if isinstance(value, (str, bytes)):
+                        setattr(node, name, _restore_placeholders(value))
+                continue
+            for name, value in ast.iter_fields(node):
+                identifiers = value if isinstance(value, list) else [value]
+                placeholders.update(
+                    identifier[len(_placeholder_prefix):]
+                    for identifier in identifiers
+                    if isinstance(identifier, str) and
+                    identifier.startswith(_placeholder_prefix)
+                )
+        #: The names of the placeholders in the template.
+        self.placeholders = frozenset(placeholders)
+
+    def instantiate(self, **substitutions):
+        """
+        Returns a new tree with the placeholders replaced by the given
+        `substitutions`.
+
+        A substitution can be a string, which replaces the placeholder as an
+        identifier, an expression node, which replaces a placeholder used as
+        an expression, or a list of statement nodes, which replaces a
+        placeholder used as an expression statement. Nodes are copied, and
+        expression contexts are set appropriately if a placeholder is used
+        as a target.
+        """
+        missing = self.placeholders.difference(substitutions)
+        if missing:
+            raise TypeError(
+                'missing substitution for ${}'.format(sorted(missing)[0])
+            )
+        unknown = set(substitutions).difference(self.placeholders)
+        if unknown:
+            raise TypeError(
+                'unknown placeholder ${}'.format(sorted(unknown)[0])
+            )
+        substitutions = dict(
+            (_placeholder_prefix + name, value)
+            for name, value in substitutions.items()
+        )
+        tree = clone(self.tree)
+        stack = [tree]
+        while stack:
+            node = stack.pop()
+            for name, value in ast.iter_fields(node):
+                if isinstance(value, list):
+                    value = _substitute_in_list(value, substitutions)
+                    setattr(node, name, value)
+                    stack.extend(
+                        item for item in value if isinstance(item, ast.AST)
+                    )
+                elif isinstance(value, ast.AST):
+                    value = _substitute(value, substitutions)
+                    setattr(node, name, value)
+                    stack.append(value)
+                elif isinstance(value, str) and value in substitutions:
+                    value = _substitute_identifier(value, substitutions)
+                    setattr(node, name, value)
+        return tree
+
+
+def _restore_placeholders(value):
+    if isinstance(value, bytes):
+        return value.replace(_placeholder_prefix.encode('ascii'), b'$')
+    return value.replace(_placeholder_prefix, '$')
+
+
+def _substitute_identifier(identifier, substitutions):
+    substitution = substitutions[identifier]
+    if not isinstance(substitution, str):
+        raise TypeError(
+            'expected identifier for ${}, got {!r}'.format(
+                identifier[len(_placeholder_prefix):],
+                substitution.__class__.__name__
+            )
+        )
+    return substitution
+
+
+def _substitute(node, substitutions):
+    if not isinstance(node, ast.Name) or node.id not in substitutions:
+        return node
+    substitution = substitutions[node.id]
+    if isinstance(substitution, str):
+        node.id = substitution
+        return node
+    if not isinstance(substitution, ast.expr):
+        raise TypeError(
+            'expected identifier or expression for ${}, got {!r}'.format(
+                node.id[len(_placeholder_prefix):],
+                substitution.__class__.__name__
+            )
+        )
+    replacement = _copy_into_place(substitution, node)
+    if isinstance(node.ctx, (ast.Store, ast.Del)):
+        if not is_possible_target(replacement):
+            raise ValueError(
+                '{} cannot be used as a target for ${}'.format(
+                    replacement.__class__.__name__,
+                    node.id[len(_placeholder_prefix):]
+                )
+            )
+        set_target_contexts(replacement)
+        if isinstance(node.ctx, ast.Del):
+            for target in walk_preorder(replacement):
+                if isinstance(getattr(target, 'ctx', None), ast.Store):
+                    target.ctx = ast.Del()
+    return replacement
+
+
+def _substitute_in_list(nodes, substitutions):
+    result = []
+    for node in nodes:
+        if (
+            isinstance(node, ast.Expr) and
+            isinstance(node.value, ast.Name) and
+            node.value.id in substitutions and
+            isinstance(substitutions[node.value.id], list)
+        ):
+            result.extend(
+                _copy_into_place(statement, node)
+                for statement in substitutions[node.value.id]
+            )
+        elif isinstance(node, str) and node in substitutions:
+            result.append(_substitute_identifier(node, substitutions))
+        elif isinstance(node, ast.AST):
+            result.append(_substitute(node, substitutions))
+        else:
+            result.append(node)
+    return result
+
+
+def _copy_into_place(node, placeholder):
+    copy = ast.copy_location(clone(node, strip_locations=True), placeholder)
+    return ast.fix_missing_locations(copy)
+
+
+# Matches strings, comments and backslash continuations. Named groups would
+# prevent the regular expression engine from quickly skipping to possible
+# matches, which makes a big difference here.
+_string_pattern = r"""
+    '''[^'\\]*(?:(?:\\.|'(?!''))[^'\\]*)*'''
+  | \"\"\"[^"\\]*(?:(?:\\.|"(?!""))[^"\\]*)*\"\"\"
+  | '[^'\\\n]*(?:\\.[^'\\\n]*)*'
+  | "[^"\\\n]*(?:\\.[^"\\\n]*)*"
+  | \#[^\n]*
+  | \\\r?\n
+"""
+_string_re = re.compile(_string_pattern, re.VERBOSE | re.DOTALL)
+_logical_line_re = re.compile(
+    r"(?P<skip>" + _string_pattern + r""")
+  | (?P<open>[(\[{])
+  | (?P<close>[)\]}])
+  | (?P<newline>\n)
+    """,
+    re.VERBOSE | re.DOTALL
+)
+_line_start_re = re.compile(r'^[^\s#]', re.MULTILINE)
+_definition_re = re.compile(r'(?:async\s+def|def|class)\b')
+
+
+def _top_level_statements(source):
+    # Yields the offsets of the lines that could start a top level statement,
+    # lines within strings or continued with a backslash are skipped. Lines
+    # within brackets are not, these have to be skipped by the caller.
+    masked = [
+        match.span() for match in _string_re.finditer(source)
+        if '\n' in match.group()
+    ]
+    masked.reverse()
+    for match in _line_start_re.finditer(source):
+        offset = match.start()
+        while masked and masked[-1][1] < offset:
+            masked.pop()
+        # A continuation ends at the start of the line it continues, so the
+        # end of a masked span is considered part of it.
+        if not masked or offset <= masked[-1][0]:
+            yield offset
+
+
+def _logical_line_end(source, offset):
+    # Returns the offset after the newline ending the logical line starting
+    # at `offset`.
+    depth = 0
+    for match in _logical_line_re.finditer(source, offset):
+        kind = match.lastgroup
+        if kind == 'open':
+            depth += 1
+        elif kind == 'close':
+            depth -= 1
+        elif kind == 'newline' and depth <= 0:
+            return match.end()
+    return len(source)
+
+
+def parse_lazy(source, filename='<unknown>'):
+    """
+    Parses the `source` like :func:`ast.parse` but defers parsing the bodies
+    of top level functions and classes until they are accessed.
+
+    Until then these definitions have a placeholder body, so no nodes are
+    allocated for the bodies, if only the top level definitions and their
+    signatures are inspected. The returned tree can otherwise be used like
+    any other, functions such as :func:`walk_preorder`, :func:`dump`,
+    :func:`to_source` or :func:`compile` simply cause the bodies to be parsed
+    as they access them.
+    """
+    if isinstance(source, bytes):
+        encoding = tokenize.detect_encoding(BytesIO(source).readline)[0]
+        source = source.decode(encoding)
+    lines = source.split('\n')
+    starts = []
+    line = previous = end = 0
+    for offset in _top_level_statements(source):
+        if offset < end:
+            # The line continues the previous statement within brackets.
+            continue
+        line += source.count('\n', previous, offset)
+        previous = offset
+        end = _logical_line_end(source, offset)
+        starts.append((line, offset, end))
+    skeleton = list(lines)
+    bodies = {}
+    for index, (start, offset, header_end) in enumerate(starts):
+        if not _definition_re.match(source, offset):
+            continue
+        end = starts[index + 1][0] if index + 1 < len(starts) else len(lines)
+        first = start
+        while index > 0 and lines[starts[index - 1][0]].startswith('@'):
+            index -= 1
+            first = starts[index][0]
+        body_start = start + source.count('\n', offset, header_end)
+        if not any(
+            line.strip() and not line.lstrip().startswith('#')
+            for line in lines[body_start:end]
+        ):
+            # The body is on the same line as the header.
+            continue
+        skeleton[body_start] = ' pass'
+        for line in range(body_start + 1, end):
+            skeleton[line] = ''
+        for line in range(first, start + 1):
+            bodies[line + 1] = '\n'.join(lines[body_start:end]), body_start + 1
+    try:
+        tree = ast.parse('\n'.join(skeleton), filename)
+    except SyntaxError:
+        # Either the source is invalid or a line within brackets in a body
+        # has been mistaken for a top level statement, parsing the entire
+        # source gives us the correct error or tree.
+        return ast.parse(source, filename)
+    for index, node in enumerate(tree.body):
+        lazy_class = _lazy_classes.get(node.__class__)
+        if lazy_class is not None and node.lineno in bodies:
+            body_source, body_lineno = bodies[node.lineno]
+            lazy = lazy_class.__new__(lazy_class)
+            lazy.__dict__.update(node.__dict__)
+            lazy.__dict__.update(
+                _body_source=body_source,
+                _body_lineno=body_lineno,
+                _filename=filename
+            )
+            tree.body[index] = lazy
+    return tree
+
+
+def _get_lazy_body(node):
+    state = node.__dict__
+    if '_body_source' in state:
+        module = ast.parse(
+            'if 1:\n' + state.pop('_body_source') + '\n', state['_filename']
+        )
+        body = module.body[0].body
+        for statement in body:
+            ast.increment_lineno(statement, state['_body_lineno'] - 2)
+        for name in ('end_lineno', 'end_col_offset'):
+            if getattr(body[-1], name, None) is not None:
+                state[name] = getattr(body[-1], name)
+        state['body'] = body
+    return state['body']
+
+
+def _set_lazy_body(node, body):
+    node.__dict__.pop('_body_source', None)
+    node.__dict__['body'] = body
+
+
+# Subclasses of the definition nodes whose body is parsed on first access.
+# They have the same names as their base classes, so that visitors treat them
+# the same way.
+_lazy_classes = dict(
+    (
+        node_class,
+        type(str(node_class.__name__), (node_class, ), {
+            '__module__': __name__,
+            'body': property(_get_lazy_body, _set_lazy_body)
+        })
+    )
+    for node_class in [
+        ast.FunctionDef, getattr(ast, 'AsyncFunctionDef', None), ast.ClassDef
+    ]
+    if node_class is not None
+)
+
+
+class SourceIndex(object):
+    """
+    An index of the line offsets in a `source` string, which allows
+    extracting the original source code of nodes in constant time.
+    """
+
+    def __init__(self, source):
+        #: The indexed source code.
+        self.source = source
+        self.line_offsets = [0]
+        self.line_offsets.extend(
+            match.end() for match in re.finditer('\n', source)
+        )
+        try:
+            source.encode('ascii')
+        except UnicodeEncodeError:
+            self.is_ascii = False
+        else:
+            self.is_ascii = True
+
+    def offset(self, lineno, col_offset):
+        """
+        Returns the offset in :attr:`source` of the position given by a line
+        number and a column offset, as used by :mod:`ast`.
+        """
+        start = self.line_offsets[lineno - 1]
+        if self.is_ascii:
+            return start + col_offset
+        # Column offsets are given in bytes of the UTF-8 encoded line.
+        line = self.source[start:start + col_offset]
+        return start + len(
+            line.encode('utf-8')[:col_offset].decode('utf-8', 'replace')
+        )
+
+    def segment(self, node):
+        """
+        Returns the original source code of the `node`, or `None` if the
+        node lacks location information.
+        """
+        try:
+            lineno = node.lineno
+            end_lineno = node.end_lineno
+            col_offset = node.col_offset
+            end_col_offset = node.end_col_offset
+        except AttributeError:
+            return None
+        if end_lineno is None or end_col_offset is None:
+            return None
+        return self.source[
+            self.offset(lineno, col_offset):
+            self.offset(end_lineno, end_col_offset)
+        ]
+
+
+_source_indices = OrderedDict()
+
+
+def node_source(node, source):
+    """
+    Returns the exact text of the `node` in the `source` it has been parsed
+    from, or `None` if the node lacks location information.
+
+    The line offsets of the most recently used sources are kept, so
+    repeated calls with the same `source` take constant time. Use
+    :class:`SourceIndex` directly to control this yourself.
+    """
+    try:
+        index = _source_indices.pop(source)
+    except KeyError:
+        index = SourceIndex(source)
+        if len(_source_indices) >= 16:
+            _source_indices.popitem(last=False)
+    _source_indices[source] = index
+    return index.segment(node)
+
+
+class CompactNode(object):
+    """
+    Base class of the node classes used by :func:`to_compact`.
+
+    For every :class:`ast.AST` subclass there is a compact counterpart of the
+    same name, which stores the fields and attributes in `__slots__` instead
+    of a per-instance `__dict__` and sequences as tuples instead of lists.
+    Fields and attributes missing on the original node are left unset, so
+    the conversion back with :func:`from_compact` is lossless.
+    """
+    __slots__ = ()
+
+    #: The :class:`ast.AST` subclass this class corresponds to.
+    _ast_class = None
+    _fields = ()
+    _attributes = ()
+
+    def __repr__(self):
+        return '<compact {} at 0x{:x}>'.format(
+            self.__class__.__name__, id(self)
+        )
+
+    def __reduce__(self):
+        # The node classes are created on demand, so they cannot be found
+        # by pickle through their name.
+        return _restore_node, (
+            self._ast_class,
+            self.__class__.__bases__[0],
+            [
+                (name, getattr(self, name))
+                for name in chain(self._fields, self._attributes)
+                if hasattr(self, name)
+            ]
+        )
+
+
+def _restore_node(ast_class, base, fields):
+    node = _node_class(ast_class, base)()
+    for name, value in fields:
+        object.__setattr__(node, name, value)
+    return node
+
+
+class FrozenNode(CompactNode):
+    """
+    Base class of the immutable node classes used by :func:`freeze`.
+
+    Frozen nodes are compact nodes whose fields cannot be changed. Instead
+    :meth:`replace` and :func:`replace_at` return new nodes that share all
+    untouched subtrees with the original, which makes keeping snapshots of a
+    tree cheap. :func:`from_compact` converts frozen trees back into
+    :mod:`ast` trees.
+    """
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        raise AttributeError(
+            '{!r} object is immutable'.format(self.__class__.__name__)
+        )
+
+    def __delattr__(self, name):
+        raise AttributeError(
+            '{!r} object is immutable'.format(self.__class__.__name__)
+        )
+
+    def replace(self, **fields):
+        """
+        Returns a copy of this node with the given `fields` or attributes
+        replaced. :mod:`ast` nodes and lists are frozen as necessary.
+        """
+        node = self.__class__.__new__(self.__class__)
+        for name in chain(self._fields, self._attributes):
+            if name in fields:
+                value = _convert_to_compact(fields.pop(name), FrozenNode)
+            else:
+                try:
+                    value = getattr(self, name)
+                except AttributeError:
+                    continue
+            object.__setattr__(node, name, value)
+        if fields:
+            raise TypeError(
+                '{} has no field {!r}'.format(
+                    self.__class__.__name__, sorted(fields)[0]
+                )
+            )
+        return node
+
+
+class _NodeList(tuple):
+    # Distinguishes sequences of nodes from tuples that happen to be field
+    # values, such as the value of a constant, during the conversion back.
+    __slots__ = ()
+
+
+_node_classes = {}
+_shared_nodes = {}
+
+
+def _node_class(ast_class, base):
+    try:
+        return _node_classes[ast_class, base]
+    except KeyError:
+        fields = tuple(ast_class._fields)
+        attributes = tuple(ast_class._attributes)
+        node_class = _node_classes[ast_class, base] = type(
+            str(ast_class.__name__),
+            (base, ),
+            {
+                '__slots__': fields + attributes,
+                '_ast_class': ast_class,
+                '_fields': fields,
+                '_attributes': attributes
+            }
+        )
+        return node_class
+
+
+def _convert_to_compact(value, base):
+    if isinstance(value, ast.AST):
+        ast_class = value.__class__
+        if not ast_class._fields and not ast_class._attributes:
+            try:
+                return _shared_nodes[ast_class, base]
+            except KeyError:
+                node = _shared_nodes[ast_class, base] = (
+                    _node_class(ast_class, base)()
+                )
+                return node
+        node = _node_class(ast_class, base)()
+        for name in chain(node._fields, node._attributes):
+            try:
+                field = getattr(value, name)
+            except AttributeError:
+                continue
+            object.__setattr__(node, name, _convert_to_compact(field, base))
+        return node
+    elif isinstance(value, list):
+        return _NodeList(_convert_to_compact(item, base) for item in value)
+    return value
+
+
+def to_compact(tree):
+    """
+    Converts the `tree` into an equivalent tree of :class:`CompactNode`
+    instances.
+
+    Compact trees require considerably less memory. Nodes without fields or
+    attributes, like :class:`ast.Load`, are shared between all compact
+    trees. :func:`walk_preorder`, :func:`to_source`, :func:`dump` and
+    :func:`is_possible_target` accept compact trees as well.
+    """
+    if not isinstance(tree, ast.AST):
+        raise TypeError(
+            'expected AST, got {!r}'.format(tree.__class__.__name__)
+        )
+    return _convert_to_compact(tree, CompactNode)
+
+
+def freeze(tree):
+    """
+    Converts the `tree` into an equivalent tree of :class:`FrozenNode`
+    instances.
+    """
+    if not isinstance(tree, ast.AST):
+        raise TypeError(
+            'expected AST, got {!r}'.format(tree.__class__.__name__)
+        )
+    return _convert_to_compact(tree, FrozenNode)
+
+
+def replace_at(tree, path, node):
+    """
+    Returns a copy of the frozen `tree` in which the node at `path` is
+    replaced with `node`.
+
+    The `path` is a sequence of field names and list indices leading from
+    the root to the node, e.g. ``('body', 0, 'value')``. Only the nodes along
+    the path are copied, everything else is shared with the original `tree`,
+    so this takes time proportional to the depth of the node.
+    """
+    if not isinstance(tree, FrozenNode):
+        raise TypeError(
+            'expected FrozenNode, got {!r}'.format(tree.__class__.__name__)
+        )
+    parents = []
+    current = tree
+    for step in path:
+        parents.append((current, step))
+        if isinstance(current, _NodeList):
+            current = current[step]
+        else:
+            current = getattr(current, step)
+    replacement = _convert_to_compact(node, FrozenNode)
+    for parent, step in reversed(parents):
+        if isinstance(parent, _NodeList):
+            items = list(parent)
+            items[step] = replacement
+            replacement = _NodeList(items)
+        else:
+            replacement = parent.replace(**{step: replacement})
+    return replacement
+
+
+def from_compact(tree):
+    """
+    Converts a tree of :class:`CompactNode` instances back into an
+    equivalent :mod:`ast` tree.
+    """
+    def _convert(value):
+        if isinstance(value, CompactNode):
+            node = value._ast_class()
+            for name in chain(value._fields, value._attributes):
+                try:
+                    field = getattr(value, name)
+                except AttributeError:
+                    continue
+                setattr(node, name, _convert(field))
+            return node
+        elif isinstance(value, _NodeList):
+            return [_convert(item) for item in value]
+        return value
+    if not isinstance(tree, CompactNode):
+        raise TypeError(
+            'expected CompactNode, got {!r}'.format(tree.__class__.__name__)
+        )
+    return _convert(tree)
+
+
+def iter_source_files(paths):
+    """
+    Yields the given `paths`, replacing directories with the paths of the
+    Python files they contain, recursively and in a stable order.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    if filename.endswith('.py'):
+                        yield os.path.join(root, filename)
+        else:
+            yield path
+
+
+def _difference(a, b):
+    """
+    Returns a description of the first structural difference between the
+    trees `a` and `b` ignoring location attributes, or `None`.
+    """
+    stack = [(a, b)]
+    while stack:
+        a, b = stack.pop()
+        if isinstance(a, ast.AST):
+            if a.__class__ is not b.__class__:
+                return '{} at line {} became {}'.format(
+                    a.__class__.__name__,
+                    getattr(a, 'lineno', '?'),
+                    b.__class__.__name__
+                )
+            for name in a._fields:
+                stack.append((getattr(a, name, None), getattr(b, name, None)))
+        elif isinstance(a, list):
+            if not isinstance(b, list) or len(a) != len(b):
+                return 'list of {} nodes became {!r}'.format(len(a), b)
+            stack.extend(zip(a, b))
+        elif a != b or a.__class__ is not b.__class__:
+            return '{!r} became {!r}'.format(a, b)
+    return None
+
+
+class _Timeout(Exception):
+    pass
+
+
+def _raise_timeout(signum, frame):
+    raise _Timeout()
+
+
+class VerificationResult(object):
+    """
+    The result of verifying a single file with :func:`verify`.
+    """
+
+    def __init__(self, path, error=None, nodes=0, size=0, time=0.0):
+        #: The path of the verified file.
+        self.path = path
+        #: A description of the problem found or `None`.
+        self.error = error
+        #: The number of nodes in the tree of the file.
+        self.nodes = nodes
+        #: The size of the file in bytes.
+        self.size = size
+        #: The time the verification took in seconds.
+        self.time = time
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return '<{} {!r} {}>'.format(
+            self.__class__.__name__,
+            self.path,
+            'ok' if self.ok else self.error
+        )
+
+
+class VerificationReport(object):
+    """
+    The results of :func:`verify` for all files.
+    """
+
+    def __init__(self, results, time):
+        #: A list of :class:`VerificationResult` instances.
+        self.results = results
+        #: The time the entire verification took in seconds.
+        self.time = time
+
+    @property
+    def failures(self):
+        return [result for result in self.results if not result.ok]
+
+    @property
+    def nodes(self):
+        return sum(result.nodes for result in self.results)
+
+    @property
+    def size(self):
+        return sum(result.size for result in self.results)
+
+    def summary(self):
+        """
+        Returns a one line summary of the verification.
+        """
+        time = self.time or float('inf')
+        return (
+            '{} files, {} failures, {} nodes in {:.2f}s '
+            '({:.0f} files/s, {:.0f} nodes/s, {:.0f} bytes/s)'.format(
+                len(self.results), len(self.failures), self.nodes, self.time,
+                len(self.results) / time, self.nodes / time, self.size / time
+            )
+        )
+
+
+def verify_file(path, timeout=None):
+    """
+    Verifies that the tree of the file at `path` survives a round trip
+    through :func:`to_source` and returns a :class:`VerificationResult`.
+
+    If `timeout` is given and the platform supports :func:`signal.setitimer`,
+    the verification is aborted after `timeout` seconds.
+    """
+    start = default_timer()
+    use_timer = timeout is not None and hasattr(signal, 'setitimer')
+    if use_timer:
+        try:
+            previous_handler = signal.signal(signal.SIGALRM, _raise_timeout)
+        except ValueError:
+            # Signal handlers can only be set in the main thread.
+            use_timer = False
+        else:
+            signal.setitimer(signal.ITIMER_REAL, timeout)
+    nodes = size = 0
+    try:
+        with open(path, 'rb') as source_file:
+            source = source_file.read()
+        size = len(source)
+        try:
+            tree = ast.parse(source, path)
+        except SyntaxError as error:
+            return VerificationResult(
+                path, 'cannot parse original: {}'.format(error), 0, size,
+                default_timer() - start
+            )
+        nodes = sum(1 for _ in walk_preorder(tree))
+        generated = to_source(tree)
+        try:
+            regenerated = ast.parse(generated, path)
+        except SyntaxError as exception:
+            # The name bound by except is deleted at the end of the clause.
+            error = 'cannot parse generated source: {}'.format(exception)
+        else:
+            error = _difference(tree, regenerated)
+    except _Timeout:
+        error = 'timed out after {}s'.format(timeout)
+    except Exception as exception:
+        error = '{}: {}'.format(exception.__class__.__name__, exception)
+    finally:
+        if use_timer:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous_handler)
+    return VerificationResult(
+        path, error, nodes, size, default_timer() - start
+    )
+
+
+def verify(paths, processes=None, timeout=60, callback=None):
+    """
+    Verifies every Python file in `paths`, which may include directories,
+    with :func:`verify_file` and returns a :class:`VerificationReport`.
+
+    The files are verified in a pool of `processes` worker processes, which
+    defaults to the number of CPUs. With a single process no pool is used.
+    If a `callback` is given, it is called with each
+    :class:`VerificationResult` as soon as it is available.
+    """
+    start = default_timer()
+    paths = list(iter_source_files(paths))
+    verify_path = partial(verify_file, timeout=timeout)
+    results = []
+    if processes == 1:
+        pool = None
+        iterator = (verify_path(path) for path in paths)
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+        iterator = pool.imap_unordered(verify_path, paths, chunksize=4)
+    try:
+        for result in iterator:
+            results.append(result)
+            if callback is not None:
+                callback(result)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return VerificationReport(results, default_timer() - start)
+
+
+_function_classes = frozenset(['FunctionDef', 'AsyncFunctionDef', 'Lambda'])
+_nesting_classes = frozenset([
+    'For', 'AsyncFor', 'While', 'If', 'With', 'AsyncWith', 'Try',
+    'TryStar', 'TryExcept', 'TryFinally', 'ClassDef', 'Match', 'match_case'
+])
+
+
+class TreeStatistics(object):
+    """
+    Statistics about a number of trees collected by
+    :func:`collect_statistics`.
+
+    The statistics are stored in :mod:`numpy` arrays if NumPy is installed
+    and in :class:`array.array` instances otherwise.
+    """
+
+    def __init__(self, node_types, node_type_counts, depth_histogram,
+                 functions, function_node_counts, function_max_nesting):
+        #: A list of the names of the node classes found.
+        self.node_types = node_types
+        #: The number of nodes of each class in :attr:`node_types`.
+        self.node_type_counts = node_type_counts
+        #: The number of nodes at each depth, with the roots at depth 0.
+        self.depth_histogram = depth_histogram
+        #: A list of ``(tree_index, qualified_name, lineno)`` tuples for
+        #: every function and lambda found, in the order they were found.
+        self.functions = functions
+        #: The number of nodes in each function in :attr:`functions`,
+        #: excluding the nodes of nested functions.
+        self.function_node_counts = function_node_counts
+        #: The maximum number of nested compound statements in each
+        #: function in :attr:`functions`.
+        self.function_max_nesting = function_max_nesting
+
+    @property
+    def max_depth(self):
+        return len(self.depth_histogram) - 1
+
+    def counts(self):
+        """
+        Returns a dictionary mapping the node class names to the number of
+        nodes of that class.
+        """
+        return dict(zip(self.node_types, map(int, self.node_type_counts)))
+
+
+def _bincount(values, length, weights_maximum=None):
+    # Counts the occurrences of each integer in `values`, or if
+    # `weights_maximum` is given, the maximum of those values for each
+    # integer, without NumPy.
+    result = array('L', [0]) * length
+    if weights_maximum is None:
+        for value in values:
+            result[value] += 1
+    else:
+        for value, weight in zip(values, weights_maximum):
+            if weight > result[value]:
+                result[value] = weight
+    return result
+
+
+def collect_statistics(trees):
+    """
+    Walks the given `trees` once and returns :class:`TreeStatistics` with
+    the number of nodes per class, the distribution of node depths and the
+    number of nodes and the maximum nesting of compound statements per
+    function.
+
+    The walk only records the class, depth, function and nesting of each
+    node in arrays, the aggregation is vectorized with NumPy if it is
+    installed.
+    """
+    type_indices = {}
+    types = array('H')
+    depths = array('L')
+    # Index of the innermost function containing the node, or -1.
+    owners = array('l')
+    nestings = array('L')
+    functions = []
+    for tree_index, tree in enumerate(trees):
+        stack = [(tree, 0, -1, 0, '')]
+        while stack:
+            node, depth, owner, nesting, scope = stack.pop()
+            name = node.__class__.__name__
+            try:
+                types.append(type_indices[name])
+            except KeyError:
+                types.append(type_indices.setdefault(name, len(type_indices)))
+            depths.append(depth)
+            if name in _function_classes:
+                function_name = getattr(node, 'name', '<lambda>')
+                scope += function_name
+                functions.append(
+                    (tree_index, scope, getattr(node, 'lineno', None))
+                )
+                owner = len(functions) - 1
+                nesting = 0
+                scope += '.'
+            elif name == 'ClassDef':
+                scope += node.name + '.'
+            owners.append(owner)
+            if owner != -1 and name in _nesting_classes:
+                nesting += 1
+            nestings.append(nesting)
+            depth += 1
+            stack.extend(
+                (child, depth, owner, nesting, scope)
+                for child in reversed(list(_iter_child_nodes(node)))
+            )
+    node_types = sorted(type_indices, key=type_indices.get)
+    numpy = _import_numpy()
+    if numpy is None:
+        node_type_counts = _bincount(types, len(node_types))
+        depth_histogram = _bincount(depths, max(depths) + 1 if depths else 0)
+        function_owners = [
+            (owner, nesting) for owner, nesting in zip(owners, nestings)
+            if owner != -1
+        ]
+        function_node_counts = _bincount(
+            (owner for owner, _ in function_owners), len(functions)
+        )
+        function_max_nesting = _bincount(
+            [owner for owner, _ in function_owners], len(functions),
+            [nesting for _, nesting in function_owners]
+        )
+    else:
+        types, depths, owners, nestings = map(
+            numpy.asarray, [types, depths, owners, nestings]
+        )
+        node_type_counts = numpy.bincount(types, minlength=len(node_types))
+        depth_histogram = numpy.bincount(depths)
+        in_function = owners != -1
+        function_node_counts = numpy.bincount(
+            owners[in_function], minlength=len(functions)
+        )
+        function_max_nesting = numpy.zeros(
+            len(functions), dtype=nestings.dtype
+        )
+        numpy.maximum.at(
+            function_max_nesting, owners[in_function], nestings[in_function]
+        )
+    return TreeStatistics(
+        node_types, node_type_counts, depth_histogram, functions,
+        function_node_counts, function_max_nesting
+    )
+
+
+def _import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+_index_schema = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS occurrences (
+    file INTEGER NOT NULL REFERENCES files (id),
+    name TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    lineno INTEGER,
+    col_offset INTEGER
+);
+CREATE INDEX IF NOT EXISTS occurrences_by_name ON occurrences (name, kind);
+CREATE INDEX IF NOT EXISTS occurrences_by_file ON occurrences (file);
+"""
+
+
+def _file_hash(path):
+    with open(path, 'rb') as source_file:
+        return hashlib.sha1(source_file.read()).hexdigest()
+
+
+def _identifier_occurrences(tree):
+    """
+    Yields a tuple of the name, the kind, either ``'definition'`` or
+    ``'usage'``, the line number and the column offset of every identifier
+    in the `tree`.
+
+    Nodes without a position, such as aliases of imports on older versions
+    of Python, are attributed to the position of the preceding node.
+    """
+    lineno = col_offset = None
+    for node in walk_preorder(tree):
+        if getattr(node, 'lineno', None) is not None:
+            lineno = node.lineno
+            col_offset = node.col_offset
+        name = node.__class__.__name__
+        if name == 'Name':
+            if node.ctx.__class__.__name__ in ('Store', 'Param'):
+                kind = 'definition'
+            else:
+                kind = 'usage'
+            yield node.id, kind, lineno, col_offset
+        elif name == 'Attribute':
+            kind = 'definition' if isinstance(node.ctx, ast.Store) else 'usage'
+            yield node.attr, kind, lineno, col_offset
+        elif name in ('FunctionDef', 'AsyncFunctionDef', 'ClassDef'):
+            yield node.name, 'definition', lineno, col_offset
+        elif name == 'arg':
+            yield node.arg, 'definition', lineno, col_offset
+        elif name == 'alias':
+            if node.asname is not None:
+                yield node.asname, 'definition', lineno, col_offset
+                yield node.name, 'usage', lineno, col_offset
+            elif node.name != '*':
+                yield node.name.split('.')[0], 'definition', lineno, col_offset
+        elif name in ('Global', 'Nonlocal'):
+            for identifier in node.names:
+                yield identifier, 'usage', lineno, col_offset
+        elif name == 'keyword':
+            if node.arg is not None:
+                yield node.arg, 'usage', lineno, col_offset
+        elif name in ('ExceptHandler', 'MatchAs', 'MatchStar'):
+            if getattr(node, 'name', None) is not None:
+                yield node.name, 'definition', lineno, col_offset
+        elif name == 'MatchMapping':
+            if node.rest is not None:
+                yield node.rest, 'definition', lineno, col_offset
+        elif name == 'ImportFrom':
+            if node.module is not None:
+                yield node.module, 'usage', lineno, col_offset
+
+
+def _index_file(path):
+    # Returns a tuple of the path, the hash and the identifier occurrences
+    # of a file, to be used in a worker process.
+    with open(path, 'rb') as source_file:
+        source = source_file.read()
+    try:
+        tree = ast.parse(source, path)
+    except (SyntaxError, ValueError):
+        occurrences = []
+    else:
+        occurrences = list(_identifier_occurrences(tree))
+    return path, hashlib.sha1(source).hexdigest(), occurrences
+
+
+class IdentifierIndex(object):
+    """
+    An index of where identifiers are defined and used in Python files,
+    persisted in the SQLite database at `path`.
+
+    Names, attributes, arguments, imported names and the names of functions
+    and classes are recorded. Assigning to a name or attribute, binding it
+    as an argument, in an import or an ``except`` clause counts as a
+    definition, everything else as a usage. Files are only parsed again by
+    :meth:`update`, if their content has changed.
+    """
+
+    def __init__(self, path=':memory:'):
+        #: The path of the database.
+        self.path = path
+        import sqlite3
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(_index_schema)
+
+    def close(self):
+        """
+        Closes the connection to the database.
+        """
+        self.connection.close()
+
+    def update(self, paths, processes=1):
+        """
+        Indexes every Python file in `paths`, which may include directories,
+        whose content changed since it has last been indexed and removes
+        files which no longer exist from the index.
+
+        Changed files are parsed in a pool of `processes` worker processes,
+        with ``None`` using one per CPU. Returns a list of the paths of the
+        files that have been indexed.
+        """
+        known = dict(self.connection.execute('SELECT path, hash FROM files'))
+        changed = [
+            path for path in (
+                os.path.abspath(path) for path in iter_source_files(paths)
+            )
+            if known.get(path) != _file_hash(path)
+        ]
+        removed = [path for path in known if not os.path.exists(path)]
+        if processes == 1 or len(changed) < 2:
+            pool = None
+            results = (_index_file(path) for path in changed)
+        else:
+            import multiprocessing
+            pool = multiprocessing.Pool(processes)
+            results = pool.imap_unordered(_index_file, changed, chunksize=4)
+        try:
+            with self.connection:
+                for path in removed:
+                    self._remove(path)
+                for path, file_hash, occurrences in results:
+                    self._remove(path)
+                    file_id = self.connection.execute(
+                        'INSERT INTO files (path, hash) VALUES (?, ?)',
+                        (path, file_hash)
+                    ).lastrowid
+                    self.connection.executemany(
+                        'INSERT INTO occurrences VALUES (?, ?, ?, ?, ?)',
+                        (
+                            (file_id, ) + occurrence
+                            for occurrence in occurrences
+                        )
+                    )
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        return changed
+
+    def _remove(self, path):
+        self.connection.execute(
+            'DELETE FROM occurrences WHERE file IN '
+            '(SELECT id FROM files WHERE path = ?)',
+            (path, )
+        )
+        self.connection.execute('DELETE FROM files WHERE path = ?', (path, ))
+
+    def _query(self, name, kind):
+        return self.connection.execute(
+            'SELECT path, lineno, col_offset FROM occurrences '
+            'JOIN files ON files.id = occurrences.file '
+            'WHERE name = ? AND kind = ? '
+            'ORDER BY path, lineno, col_offset',
+            (name, kind)
+        ).fetchall()
+
+    def definitions(self, name):
+        """
+        Returns a list of tuples of the path, the line number and the column
+        offset of each definition of the identifier `name`.
+        """
+        return self._query(name, 'definition')
+
+    def usages(self, name):
+        """
+        Returns a list of tuples of the path, the line number and the column
+        offset of each usage of the identifier `name`.
+        """
+        return self._query(name, 'usage')
+
+
+def _run_command(command, path):
+    # Runs one of the commands of main on a single file and returns a tuple
+    # of the path, the output, the number of nodes, the node counts by class
+    # and an error message.
+    stats = NodeStats()
+    try:
+        with open(path, 'rb') as source_file:
+            tree = ast.parse(source_file.read(), path)
+        nodes = list(walk_preorder(tree, stats))
+        if command == 'dump':
+            output = dump(tree) + '\n'
+        elif command == 'regenerate':
+            output = to_source(tree)
+        else:
+            output = '{}: {} nodes\n'.format(path, len(nodes))
+    except Exception as exception:
+        return path, '', 0, {}, '{}: {}'.format(
+            exception.__class__.__name__, exception
+        )
+    return path, output, len(nodes), stats.calls, None
+
+
+def main(argv=None):
+    """
+    The entry point of the command line interface, run as
+    ``python -m zweig``.
+    """
+    parser = argparse.ArgumentParser(
+        prog='zweig',
+        description='Process the trees of Python files.'
+    )
+    parser.add_argument(
+        'command', choices=['dump', 'regenerate', 'stats', 'verify'],
+        help=(
+            'dump the trees, regenerate the source code with to_source, show '
+            'node statistics or verify that the trees survive a round trip'
+        )
+    )
+    parser.add_argument(
+        'paths', nargs='+', metavar='path',
+        help='files or directories containing Python files'
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1,
+        help='number of processes to use, 0 uses one per CPU'
+    )
+    parser.add_argument(
+        '--timeout', type=float, default=60,
+        help='seconds after which the verification of a file is aborted'
+    )
+    arguments = parser.parse_args(argv)
+    processes = arguments.jobs or None
+
+    if arguments.command == 'verify':
+        def report_failure(result):
+            if not result.ok:
+                sys.stdout.write('{}: {}\n'.format(result.path, result.error))
+                sys.stdout.flush()
+        report = verify(
+            arguments.paths, processes=processes, timeout=arguments.timeout,
+            callback=report_failure
+        )
+        sys.stderr.write(report.summary() + '\n')
+        return 1 if report.failures else 0
+
+    start = default_timer()
+    paths = list(iter_source_files(arguments.paths))
+    run = partial(_run_command, arguments.command)
+    if processes == 1:
+        pool = None
+        results = (run(path) for path in paths)
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap(run, paths)
+    total_nodes = errors = 0
+    calls = {}
+    try:
+        for path, output, nodes, node_calls, error in results:
+            if error is not None:
+                errors += 1
+                sys.stderr.write('{}: {}\n'.format(path, error))
+                continue
+            if arguments.command != 'stats' and len(paths) > 1:
+                sys.stdout.write('# {}\n'.format(path))
+            sys.stdout.write(output)
+            sys.stdout.flush()
+            total_nodes += nodes
+            for name, count in node_calls.items():
+                calls[name] = calls.get(name, 0) + count
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    if arguments.command == 'stats':
+        # Only the nodes are counted, NodeStats.report would show empty
+        # time columns.
+        sys.stdout.write('{:<20} {:>10}\n'.format('node', 'nodes'))
+        for name, count in sorted(
+            calls.items(), key=lambda item: (-item[1], item[0])
+        ):
+            sys.stdout.write('{:<20} {:>10}\n'.format(name, count))
+    time = default_timer() - start
+    sys.stderr.write(
+        '{} files, {} errors, {} nodes in {:.2f}s ({:.0f} nodes/s)\n'.format(
+            len(paths), errors, total_nodes, time,
+            total_nodes / time if time else 0
+        )
+    )
+    return 1 if errors else 0
+
+
+if sys.version_info >= (3, 6):
+    from _zweig_async import aiter_trees, aparse_and_walk, ato_source
+
+
+if __name__ == '__main__':
+    sys.exit(main())